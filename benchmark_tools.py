@@ -0,0 +1,286 @@
+"""
+Developed by Arman Avesta, MD, PhD
+FNNDSC | Boston Children's Hospital | Harvard Medical School
+
+This module contains a reproducible, offline benchmark of rigid_registration on synthetic phantoms.
+
+Each case generates a head-like phantom, moves it with a known Euler3D transform, remaps its intensities and adds
+noise, then registers it with rigid_registration, as the plugin does, and times every stage of the pipeline
+(read_fixed: reading the fixed image and building its pyramid; read, mask, init, optimize, resample, write) and
+measures how far the recovered transform is from the truth in mm and degrees. Every preset registers the same
+phantom pairs, and results are saved as JSON so that presets and releases can be compared. With several
+--optimizers, every preset is also run with each optimizer, and the summary reports the fraction of cases that
+converged (mean error below --converged_mm), to pick the fastest optimizer that still converges. A case whose
+registration fails is recorded with its error and counts as not converged; the other cases still run.
+
+Usage:
+    python benchmark_tools.py --sizes 128 256 --cases 3 --presets fast balanced accurate --output bench.json
+    python benchmark_tools.py --sizes 128 --cases 5 --optimizers gradient_descent regular_step lbfgs powell amoeba
+    python benchmark_tools.py --sizes 512 --cases 1 --low_memory
+"""
+
+# ----------------------------------------------- ENVIRONMENT SETUP ---------------------------------------------------
+# Project imports:
+from registration_tools import rigid_registration, PRESETS, LOW_MEMORY_OVERRIDES, INITIALIZATIONS, OPTIMIZERS, \
+    MAX_MULTI_START
+from mask_tools import FOREGROUND_MASKS
+from profiling_tools import TimingProfiler
+from images_register import __version__
+
+# System imports:
+import SimpleITK as sitk
+import numpy as np
+import json
+import os
+import platform
+import tempfile
+import time
+import traceback
+from argparse import ArgumentParser, ArgumentDefaultsHelpFormatter
+from os.path import join
+
+# ---------------------------------------------- HELPER FUNCTIONS -----------------------------------------------------
+
+def make_phantom(size, rng):
+    """
+    Head-like 3D phantom of size^3 voxels (1 mm isotropic): a bright skull shell around a textured brain with a few
+    Gaussian blobs, so that mutual information has structure to lock onto at every pyramid level.
+
+    The texture is generated at 1/4 resolution and upsampled, which keeps 512^3 phantoms cheap to build.
+    """
+    coarse_size = max(8, size // 4)
+    noise = sitk.GetImageFromArray(rng.standard_normal((coarse_size,) * 3).astype(np.float32))
+    noise.SetSpacing((size / coarse_size,) * 3)
+    texture = sitk.SmoothingRecursiveGaussian(noise, 2.0 * size / coarse_size)
+    grid = sitk.Image([size] * 3, sitk.sitkFloat32)
+    texture = sitk.GetArrayFromImage(sitk.Resample(texture, grid, sitk.Transform(), sitk.sitkLinear, 0.0))
+    texture /= max(float(texture.std()), 1e-6)
+
+    z, y, x = np.ogrid[:size, :size, :size]
+    center = (size - 1) / 2
+
+    def ellipsoid(rx, ry, rz, cx=0.0, cy=0.0, cz=0.0):
+        return (((x - center - cx * size) / (rx * size)) ** 2 + ((y - center - cy * size) / (ry * size)) ** 2
+                + ((z - center - cz * size) / (rz * size)) ** 2)
+
+    head = ellipsoid(0.40, 0.45, 0.38) < 1
+    brain = ellipsoid(0.36, 0.41, 0.34) < 1
+    volume = np.where(head, 900.0, 0.0).astype(np.float32)
+    volume[brain] = 300.0 + 60.0 * texture[brain]
+    for cx, cy, cz, radius, value in [(0.12, -0.10, 0.05, 0.06, 500.0), (-0.15, 0.08, -0.04, 0.05, 150.0),
+                                      (0.02, 0.20, 0.10, 0.04, 650.0)]:
+        blob = np.exp(-ellipsoid(radius, radius, radius, cx, cy, cz))
+        volume += (value * blob * brain).astype(np.float32)
+
+    phantom = sitk.GetImageFromArray(volume)
+    return phantom
+
+
+def random_rigid_transform(image, rng, max_rotation_deg, max_translation_mm):
+    """
+    Euler3D transform about the image center with uniformly drawn rotations and translations.
+    """
+    center = image.TransformContinuousIndexToPhysicalPoint([(n - 1) / 2 for n in image.GetSize()])
+    transform = sitk.Euler3DTransform()
+    transform.SetCenter(center)
+    transform.SetRotation(*np.deg2rad(rng.uniform(-max_rotation_deg, max_rotation_deg, 3)))
+    transform.SetTranslation(rng.uniform(-max_translation_mm, max_translation_mm, 3).tolist())
+    return transform
+
+
+def make_moving(phantom, true_transform, rng, noise_fraction):
+    """
+    Moves the phantom with true_transform, remaps its intensities with a monotonic non-linear curve (as between two
+    scanners or contrasts), and adds Gaussian noise.
+    """
+    moved = sitk.GetArrayFromImage(sitk.Resample(phantom, phantom, true_transform, sitk.sitkLinear, 0.0))
+    peak = max(float(moved.max()), 1e-6)
+    remapped = 2000.0 * (np.clip(moved, 0, None) / peak) ** 0.7
+    remapped += rng.normal(0.0, noise_fraction * 2000.0, remapped.shape)
+    moving = sitk.GetImageFromArray(remapped.astype(np.float32))
+    moving.CopyInformation(phantom)
+    return moving
+
+
+def transform_error(estimated, true_transform, image):
+    """
+    Error of an estimated fixed-to-moving transform against the transform that generated the moving image, over the
+    grid of image (an image, or an sitk.ImageFileReader that read the image information).
+
+    Returns:
+        dict with the mean and maximum displacement error (mm) over the image corners and center, and the residual
+        rotation angle (degrees).
+    """
+    inverse = true_transform.GetInverse()
+    size = image.GetSize()
+    corners = [(i * (size[0] - 1), j * (size[1] - 1), k * (size[2] - 1))
+               for i in (0, 1) for j in (0, 1) for k in (0, 1)]
+    direction = np.asarray(image.GetDirection()).reshape(3, 3)
+    points = [tuple(np.asarray(image.GetOrigin()) + direction @ (np.asarray(image.GetSpacing()) * index))
+              for index in corners + [tuple((n - 1) / 2 for n in size)]]
+    errors = [np.linalg.norm(np.subtract(estimated.TransformPoint(p), inverse.TransformPoint(p))) for p in points]
+
+    rotation = np.asarray(sitk.Euler3DTransform(estimated).GetMatrix()).reshape(3, 3) \
+        @ np.asarray(true_transform.GetMatrix()).reshape(3, 3)
+    angle = np.degrees(np.arccos(np.clip((np.trace(rotation) - 1) / 2, -1.0, 1.0)))
+    return dict(error_mm_mean=float(np.mean(errors)), error_mm_max=float(np.max(errors)), error_deg=float(angle))
+
+
+# ----------------------------------------------- MAIN FUNCTIONS ------------------------------------------------------
+
+def make_case(size, seed, workdir, max_rotation_deg=10.0, max_translation_mm=10.0, noise_fraction=0.02):
+    """
+    Generates one phantom pair and saves it to workdir.
+
+    Returns:
+        (fixed_path, moving_path, true_transform)
+    """
+    rng = np.random.default_rng(seed)
+    phantom = make_phantom(size, rng)
+    true_transform = random_rigid_transform(phantom, rng, max_rotation_deg, max_translation_mm)
+    moving = make_moving(phantom, true_transform, rng, noise_fraction)
+
+    fixed_path = join(workdir, f'fixed_{size}_{seed}.nii.gz')
+    moving_path = join(workdir, f'moving_{size}_{seed}.nii.gz')
+    sitk.WriteImage(phantom, fixed_path)
+    sitk.WriteImage(moving, moving_path)
+    return fixed_path, moving_path, true_transform
+
+
+def run_case(fixed_path, moving_path, true_transform, parameters, workdir, output_format=None):
+    """
+    Registers one phantom pair with rigid_registration (the path of the plugin, including the low-memory reading and
+    slab resampling of the parameters) and returns its stage timings and accuracy.
+    """
+    registered_path = join(workdir, 'registered' + (output_format.extension if output_format else '.nii.gz'))
+    transform_path = join(workdir, 'transform.mat')
+
+    profiler = TimingProfiler(record_iterations=False)
+    record = rigid_registration(fixed_path, moving_path, registered_path, transform_path, parameters, hook=profiler,
+                                output_format=output_format)
+    seconds = {stage: times['wall_seconds'] for stage, times in profiler.stages.items()}
+    seconds['total'] = sum(seconds.values())
+
+    for path in (registered_path, transform_path):
+        os.remove(path)
+
+    fixed_header = sitk.ImageFileReader()
+    fixed_header.SetFileName(fixed_path)
+    fixed_header.ReadImageInformation()
+    return dict(true_parameters=list(true_transform.GetParameters()),
+                estimated_parameters=list(record.parameters), seconds=seconds, flags=list(record.flags),
+                levels=[{k: v for k, v in level.items() if k != 'metric_trace'} for level in profiler.levels],
+                **transform_error(record.transform(), true_transform, fixed_header))
+
+
+def run_benchmark(sizes, cases, presets=('balanced',), seed=0, overrides=None, optimizers=None, converged_mm=2.0,
+                  low_memory=False, **case_kwargs):
+    """
+    Runs `cases` phantom pairs at each size with each preset and returns the benchmark report (JSON-serializable
+    dict). Every preset registers the same phantom pairs. overrides (dict) replaces settings of every preset. With
+    optimizers (list of OPTIMIZERS), each preset is run with every optimizer, as '<preset>/<optimizer>'. A case has
+    converged if its mean error is below converged_mm; a case whose registration raised is recorded with the
+    traceback as its error, and has not converged. low_memory applies LOW_MEMORY_OVERRIDES to every preset before
+    overrides, as the --low_memory flag of the plugin does.
+    """
+    overrides = overrides or {}
+    base = {preset: PRESETS[preset].with_overrides(**LOW_MEMORY_OVERRIDES) if low_memory else PRESETS[preset]
+            for preset in presets}
+    if optimizers:
+        parameters = {f'{preset}/{optimizer}': base[preset].with_overrides(**overrides, optimizer=optimizer)
+                      for preset in presets for optimizer in optimizers}
+        presets = list(parameters)
+    else:
+        parameters = {preset: base[preset].with_overrides(**overrides) for preset in presets}
+    results = []
+    with tempfile.TemporaryDirectory() as workdir:
+        for size in sizes:
+            for case in range(cases):
+                fixed_path, moving_path, true_transform = make_case(size, seed + case, workdir, **case_kwargs)
+                for preset in presets:
+                    try:
+                        result = run_case(fixed_path, moving_path, true_transform, parameters[preset], workdir)
+                    except Exception as error:
+                        print(f'{preset}, size {size}^3, case {case}: FAILED: {error}', flush=True)
+                        results.append(dict(preset=preset, size=size, seed=seed + case, converged=False,
+                                            error=traceback.format_exc()))
+                        continue
+                    result['converged'] = result['error_mm_mean'] < converged_mm
+                    print(f"{preset}, size {size}^3, case {case}: {result['seconds']['total']:.1f} s, "
+                          f"error {result['error_mm_mean']:.2f} mm / {result['error_deg']:.2f} deg", flush=True)
+                    results.append(dict(preset=preset, size=size, seed=seed + case, **result))
+                os.remove(fixed_path)
+                os.remove(moving_path)
+
+    summary = {}
+    for preset in presets:
+        for size in sizes:
+            rows = [r for r in results if r['preset'] == preset and r['size'] == size]
+            completed = [r for r in rows if 'error' not in r]
+            summary.setdefault(preset, {})[str(size)] = dict(
+                seconds_median={stage: float(np.median([r['seconds'][stage] for r in completed]))
+                                for stage in (completed[0]['seconds'] if completed else ())},
+                error_mm_median=float(np.median([r['error_mm_mean'] for r in completed])) if completed else None,
+                error_deg_median=float(np.median([r['error_deg'] for r in completed])) if completed else None,
+                converged_fraction=float(np.mean([r['converged'] for r in rows])),
+                failed=len(rows) - len(completed))
+
+    return dict(version=__version__, parameters={preset: parameters[preset].to_dict() for preset in presets},
+                case_parameters=dict(case_kwargs, converged_mm=converged_mm),
+                platform=dict(python=platform.python_version(), simpleitk=sitk.Version.VersionString(),
+                              machine=platform.machine(),
+                              threads=sitk.ProcessObject.GetGlobalDefaultNumberOfThreads()),
+                summary=summary, cases=results)
+
+
+# -------------------------------------------------- CODE TESTING -----------------------------------------------------
+
+if __name__ == '__main__':
+    parser = ArgumentParser(description='Benchmark rigid registration speed and accuracy on synthetic phantoms.',
+                            formatter_class=ArgumentDefaultsHelpFormatter)
+    parser.add_argument('--sizes', type=int, nargs='+', default=[128, 256], help='phantom edge lengths (voxels)')
+    parser.add_argument('--cases', type=int, default=3, help='number of phantom pairs per size')
+    parser.add_argument('--presets', type=str, nargs='+', default=['balanced'], choices=sorted(PRESETS),
+                        help='registration presets to compare')
+    parser.add_argument('--initialization', type=str, default=None, choices=INITIALIZATIONS,
+                        help='initialization of every preset (default: the preset value)')
+    parser.add_argument('--foreground_mask', type=str, default=None, choices=FOREGROUND_MASKS,
+                        help='foreground masks of every preset (default: the preset value)')
+    parser.add_argument('--time_budget', type=float, default=None,
+                        help='time budget (seconds) of the optimization of every case (default: the preset value)')
+    parser.add_argument('--early_stop_iterations', type=int, default=None,
+                        help='early stop of every pyramid level (default: the preset value)')
+    parser.add_argument('--optimizers', type=str, nargs='+', default=None, choices=OPTIMIZERS,
+                        help='run every preset with each of these optimizers (default: the preset value)')
+    parser.add_argument('--multi_start', type=int, default=None, choices=range(1, MAX_MULTI_START + 1),
+                        help='number of starting transforms of every case (default: the preset value)')
+    parser.add_argument('--low_memory', action='store_true',
+                        help='apply the memory-lean settings of the plugin (--low_memory) to every preset')
+    parser.add_argument('--working_shrink', type=int, default=None,
+                        help='working resolution shrink of every preset (default: the preset value)')
+    parser.add_argument('--slab_size', type=int, default=None,
+                        help='slices resampled at a time by every preset (default: the preset value)')
+    parser.add_argument('--converged_mm', type=float, default=2.0,
+                        help='mean error (mm) below which a case counts as converged')
+    parser.add_argument('--seed', type=int, default=0, help='seed of the first case')
+    parser.add_argument('--max_rotation_deg', type=float, default=10.0, help='largest rotation about each axis')
+    parser.add_argument('--max_translation_mm', type=float, default=10.0, help='largest translation along each axis')
+    parser.add_argument('--noise', type=float, default=0.02, help='noise std as a fraction of the intensity range')
+    parser.add_argument('--threads', type=int, default=0, help='SimpleITK threads (0 keeps the default)')
+    parser.add_argument('--output', type=str, default='bench.json', help='path of the JSON report')
+    args = parser.parse_args()
+
+    if args.threads > 0:
+        sitk.ProcessObject.SetGlobalDefaultNumberOfThreads(args.threads)
+    report = run_benchmark(args.sizes, args.cases, presets=args.presets, seed=args.seed,
+                           overrides=dict(initialization=args.initialization, foreground_mask=args.foreground_mask,
+                                          time_budget_seconds=args.time_budget,
+                                          early_stop_iterations=args.early_stop_iterations,
+                                          multi_start=args.multi_start, working_shrink=args.working_shrink,
+                                          resample_slab_size=args.slab_size),
+                           optimizers=args.optimizers, converged_mm=args.converged_mm, low_memory=args.low_memory,
+                           max_rotation_deg=args.max_rotation_deg, max_translation_mm=args.max_translation_mm,
+                           noise_fraction=args.noise)
+    with open(args.output, 'w') as file:
+        json.dump(report, file, indent=2)
+    print(f'Benchmark report saved to {args.output}')
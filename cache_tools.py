@@ -0,0 +1,182 @@
+"""
+Developed by Arman Avesta, MD, PhD
+FNNDSC | Boston Children's Hospital | Harvard Medical School
+
+This module contains the content-addressed on-disk cache of registration results, so that image pairs which did not
+change between runs are never registered twice.
+"""
+
+# ----------------------------------------------- ENVIRONMENT SETUP ---------------------------------------------------
+# Project imports:
+from io_tools import atomic_output
+from dicom_tools import dicom_files
+
+# System imports:
+import hashlib
+import json
+import os
+import shutil
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from os.path import join, exists, getsize
+
+# Names of the files stored in each cache entry:
+TRANSFORM_FILE = 'transform.mat'
+REGISTERED_IMAGE_FILE = 'registered_image'
+
+# Number of files hashed concurrently by file_digests (hashlib releases the GIL while hashing):
+HASH_THREADS = 8
+
+# ---------------------------------------------- HELPER FUNCTIONS -----------------------------------------------------
+
+def file_digest(path, chunk_size=1 << 20):
+    """
+    SHA-256 hex digest of the bytes of a file, read in chunks so that large volumes are never loaded at once. For a
+    DICOM series folder, the digest covers the name and bytes of every DICOM file in it.
+    """
+    digest = hashlib.sha256()
+    for file_path in dicom_files(path) if os.path.isdir(path) else [path]:
+        if file_path != path:
+            digest.update(os.path.basename(file_path).encode() + b'\0')
+        with open(file_path, 'rb') as file:
+            for chunk in iter(lambda: file.read(chunk_size), b''):
+                digest.update(chunk)
+    return digest.hexdigest()
+
+
+def file_digests(paths):
+    """
+    file_digest of many files, computed concurrently.
+
+    Returns:
+        dict mapping each path to its digest, in the order of paths.
+    """
+    with ThreadPoolExecutor(max_workers=HASH_THREADS) as pool:
+        return dict(zip(paths, pool.map(file_digest, paths)))
+
+
+def registration_key(fixed_digest, moving_digest, settings):
+    """
+    Cache key of one registration: hash of the fixed image bytes, the moving image bytes and all registration
+    settings (the order of the settings does not matter).
+    """
+    payload = json.dumps(dict(fixed=fixed_digest, moving=moving_digest, settings=settings), sort_keys=True,
+                         default=str)
+    return hashlib.sha256(payload.encode()).hexdigest()
+
+
+def _dir_size(path):
+    """
+    Total size of the files of a cache entry. Files or entries removed meanwhile (e.g. evicted by another process
+    sharing the cache) count as 0 bytes.
+    """
+    try:
+        names = os.listdir(path)
+    except FileNotFoundError:
+        return 0
+    size = 0
+    for name in names:
+        try:
+            size += getsize(join(path, name))
+        except FileNotFoundError:
+            pass
+    return size
+
+
+def _last_use(path):
+    """
+    Modification time of a cache entry, or None if it was removed meanwhile.
+    """
+    try:
+        return os.path.getmtime(path)
+    except FileNotFoundError:
+        return None
+
+
+# ----------------------------------------------- MAIN FUNCTIONS ------------------------------------------------------
+
+class ResultCache:
+    """
+    On-disk cache of registration results keyed by registration_key.
+
+    Each entry is a folder named after its key that holds the transform and, optionally, the registered image.
+    Entries are written to a temporary folder and renamed into place, so an interrupted run never leaves a partial
+    entry. The modification time of an entry records its last use; when the cache grows beyond max_bytes the least
+    recently used entries are evicted.
+
+    Attributes
+        cache_dir : str: Root folder of the cache.
+        max_bytes : int: Size limit of the cache.
+        hits, misses : int: Lookup counters of this run.
+    """
+    def __init__(self, cache_dir, max_bytes):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        os.makedirs(cache_dir, exist_ok=True)
+
+    def _entry(self, key):
+        return join(self.cache_dir, key)
+
+    def restore(self, key, transform_matrix_path, registered_image_path=None):
+        """
+        Copies a cached result to the given output paths.
+
+        Returns:
+            None on a miss; otherwise whether the registered image was restored too (False means only the transform
+            was cached, and the caller should resample the moving image with it).
+        """
+        entry = self._entry(key)
+        try:
+            with atomic_output(transform_matrix_path) as temporary_path:
+                shutil.copyfile(join(entry, TRANSFORM_FILE), temporary_path)
+            image_restored = False
+            if registered_image_path is not None and exists(join(entry, REGISTERED_IMAGE_FILE)):
+                with atomic_output(registered_image_path) as temporary_path:
+                    shutil.copyfile(join(entry, REGISTERED_IMAGE_FILE), temporary_path)
+                image_restored = True
+            os.utime(entry)
+        except FileNotFoundError:
+            # Not cached, or evicted meanwhile by another process sharing the cache
+            self.misses += 1
+            return None
+        self.hits += 1
+        return image_restored
+
+    def store(self, key, transform_matrix_path, registered_image_path=None):
+        """
+        Adds a result to the cache (the registered image is stored only if registered_image_path is given), then
+        evicts least recently used entries until the cache fits in max_bytes.
+        """
+        entry = self._entry(key)
+        staging = join(self.cache_dir, f'.staging-{uuid.uuid4().hex}')
+        os.makedirs(staging)
+        shutil.copyfile(transform_matrix_path, join(staging, TRANSFORM_FILE))
+        if registered_image_path is not None:
+            shutil.copyfile(registered_image_path, join(staging, REGISTERED_IMAGE_FILE))
+        # ignore_errors: another process sharing the cache may evict the entry meanwhile
+        shutil.rmtree(entry, ignore_errors=True)
+        os.rename(staging, entry)
+        self.evict(keep=key)
+
+    def evict(self, keep=None):
+        """
+        Removes least recently used entries until the cache fits in max_bytes. The entry named keep is never evicted.
+        Entries removed meanwhile by another process sharing the cache are skipped.
+        """
+        entries = [join(self.cache_dir, name) for name in os.listdir(self.cache_dir) if not name.startswith('.')]
+        last_use = {entry: _last_use(entry) for entry in entries}
+        entries = [entry for entry in entries if last_use[entry] is not None]
+        sizes = {entry: _dir_size(entry) for entry in entries}
+        total = sum(sizes.values())
+        for entry in sorted(entries, key=last_use.get):
+            if total <= self.max_bytes:
+                break
+            if keep is not None and entry == self._entry(keep):
+                continue
+            shutil.rmtree(entry, ignore_errors=True)
+            total -= sizes[entry]
+
+    def summary(self):
+        return f'Result cache: {self.hits} hits, {self.misses} misses ({self.cache_dir}).'
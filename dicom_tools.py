@@ -0,0 +1,274 @@
+"""
+Developed by Arman Avesta, MD, PhD
+FNNDSC | Boston Children's Hospital | Harvard Medical School
+
+This module reads DICOM series directly, so that studies do not have to be converted to NIfTI first (see
+archives/dcm2nii.py): a folder that holds the slices of a DICOM series can be given wherever a .nii.gz image is
+expected.
+
+The headers of the slices are read concurrently and the slices are sorted by their position along the slice normal
+(not by file name or instance number). The voxel data is then decoded by sitk.ImageSeriesReader in runs of
+consecutive slices, concurrently (SimpleITK releases the GIL while it decodes), and pasted into one 3D image whose
+slice spacing is measured from the slice positions.
+"""
+
+# ----------------------------------------------- ENVIRONMENT SETUP ---------------------------------------------------
+# Project imports:
+from os_tools import subfiles, available_cpus
+
+# System imports:
+import SimpleITK as sitk
+import numpy as np
+import os
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass
+from functools import lru_cache
+
+# Number of threads reading slice headers and decoding runs of slices concurrently (at most):
+DICOM_READ_THREADS = 8
+
+# Number of consecutive slices one sitk.ImageSeriesReader decodes at a time:
+DICOM_RUN_SLICES = 16
+
+# Number of series geometries kept in memory, so that the slice headers of a series are read once for its manifest
+# entry, its pixel type and its decoding:
+GEOMETRY_CACHE_SIZE = 64
+
+# Largest relative deviation of a slice gap from the median gap of a series:
+SLICE_GAP_TOLERANCE = 0.01
+
+# DICOM tags of the slice headers:
+SERIES_UID_TAG = '0020|000e'
+FRAME_OF_REFERENCE_TAG = '0020|0052'
+RESCALE_TAGS = ('0028|1053', '0028|1052')
+
+# ---------------------------------------------- HELPER FUNCTIONS -----------------------------------------------------
+
+def _is_dicom_file(path):
+    """
+    Whether a file starts with the DICOM preamble (128 bytes followed by 'DICM').
+    """
+    try:
+        with open(path, 'rb') as file:
+            return file.read(132)[128:] == b'DICM'
+    except OSError:
+        return False
+
+
+def dicom_files(folder):
+    """
+    DICOM files directly inside folder (sorted by name; subfolders are not searched).
+    """
+    return [path for path in subfiles(folder, complete_path=True) if _is_dicom_file(path)]
+
+
+def is_dicom_series(path):
+    """
+    Whether path is a folder that directly holds DICOM files. Files are only opened until the first DICOM file is
+    found.
+    """
+    if not os.path.isdir(path):
+        return False
+    with os.scandir(path) as entries:
+        return any(entry.is_file() and _is_dicom_file(entry.path) for entry in entries)
+
+
+def _slice_header(path):
+    reader = sitk.ImageFileReader()
+    reader.SetFileName(path)
+    reader.ReadImageInformation()
+    metadata = {tag: reader.GetMetaData(tag).strip() if reader.HasMetaDataKey(tag) else ''
+                for tag in (SERIES_UID_TAG, FRAME_OF_REFERENCE_TAG) + RESCALE_TAGS}
+    return dict(path=path, size=reader.GetSize(), origin=reader.GetOrigin(), spacing=reader.GetSpacing(),
+                direction=reader.GetDirection(), pixel_id=reader.GetPixelID(), series_uid=metadata[SERIES_UID_TAG],
+                frame_of_reference=metadata[FRAME_OF_REFERENCE_TAG],
+                rescale=tuple(metadata[tag] for tag in RESCALE_TAGS))
+
+
+def _n_threads(n_tasks):
+    return max(1, min(DICOM_READ_THREADS, available_cpus(), n_tasks))
+
+
+def _pixel_dtype(pixel_id):
+    return sitk.GetArrayViewFromImage(sitk.Image(1, 1, pixel_id)).dtype
+
+
+@dataclass(frozen=True)
+class SeriesGeometry:
+    """
+    Geometry of a DICOM series, read from the headers of its slices.
+
+    Attributes
+        files : tuple of str: Paths to the slices of the series, sorted along the slice normal.
+        size : tuple of int: Dimensions of the 3D image (voxels).
+        origin : tuple of float: Position of the first voxel (mm).
+        spacing : tuple of float: Voxel size (mm); the slice spacing is the median gap between slice positions.
+        direction : tuple of float: Direction cosines of the 3D image.
+        pixel_id : int: Pixel type of the decoded image (float32 if the slices are rescaled differently).
+        file_bytes : int: Total size of the slice files.
+        n_series : int: Number of series in the folder (only the one with the most slices is read).
+        frame_of_reference : str: Frame of reference UID of the series (empty if the slices do not have one).
+        error : str: Why the series cannot be read as one 3D image; None if it can.
+    """
+    files: tuple
+    size: tuple = ()
+    origin: tuple = ()
+    spacing: tuple = ()
+    direction: tuple = ()
+    pixel_id: int = sitk.sitkFloat32
+    file_bytes: int = 0
+    n_series: int = 1
+    frame_of_reference: str = ''
+    error: str = None
+
+    @property
+    def dtype(self):
+        return _pixel_dtype(self.pixel_id)
+
+
+# ----------------------------------------------- MAIN FUNCTIONS ------------------------------------------------------
+
+def sub_dicom_series(root, complete_path=True, recursive=False):
+    """
+    Folders below root that hold a DICOM series: its direct subfolders, or with recursive, subfolders at any depth
+    (hidden folders are skipped).
+    """
+    res = []
+    folders = [entry.name for entry in os.scandir(root) if entry.is_dir() and not entry.name.startswith('.')]
+    while folders:
+        folder = folders.pop()
+        path = os.path.join(root, folder)
+        if is_dicom_series(path):
+            res.append(path if complete_path else folder)
+        if recursive:
+            folders.extend(os.path.join(folder, entry.name) for entry in os.scandir(path)
+                           if entry.is_dir() and not entry.name.startswith('.'))
+    return sorted(res)
+
+
+def series_geometry(folder):
+    """
+    Reads the headers of the slices of the DICOM series in folder concurrently and sorts the slices along the slice
+    normal. If the folder holds several series, the one with the most slices is used. A single multi-frame file is
+    read as it is. The geometry is cached until files are added to or removed from the folder.
+
+    Returns:
+        SeriesGeometry (with error set if the slices do not form a regular 3D image).
+    """
+    return _cached_series_geometry(folder, os.stat(folder).st_mtime_ns)
+
+
+@lru_cache(maxsize=GEOMETRY_CACHE_SIZE)
+def _cached_series_geometry(folder, modification_time):
+    files = dicom_files(folder)
+    if not files:
+        return SeriesGeometry((), error='no DICOM files')
+    with ThreadPoolExecutor(max_workers=_n_threads(len(files))) as pool:
+        headers = list(pool.map(_slice_header, files))
+
+    series = {}
+    for header in headers:
+        series.setdefault(header['series_uid'], []).append(header)
+    slices = max(series.values(), key=len)
+    file_bytes = sum(os.path.getsize(header['path']) for header in slices)
+    first = slices[0]
+    if len(slices) == 1:
+        return SeriesGeometry((first['path'],), size=first['size'], origin=first['origin'], spacing=first['spacing'],
+                              direction=first['direction'], pixel_id=first['pixel_id'], file_bytes=file_bytes,
+                              n_series=len(series), frame_of_reference=first['frame_of_reference'])
+
+    def invalid(error):
+        return SeriesGeometry(tuple(header['path'] for header in slices), n_series=len(series), error=error)
+
+    if any(header['size'][2] != 1 for header in slices):
+        return invalid('multi-frame files in a series of several files')
+    if len({header['size'] for header in slices}) > 1:
+        return invalid('slices of different dimensions')
+    direction = np.asarray(first['direction']).reshape(3, 3)
+    if any(not np.allclose(np.asarray(header['direction']).reshape(3, 3), direction, atol=1e-4) for header in slices):
+        return invalid('slices of different orientations')
+
+    # Sort the slices by their position along the normal of the slices
+    normal = direction[:, 2]
+    positions = np.asarray([np.dot(header['origin'], normal) for header in slices])
+    order = np.argsort(positions, kind='stable')
+    slices, positions = [slices[index] for index in order], positions[order]
+    gaps = np.diff(positions)
+    gap = float(np.median(gaps))
+    if gap <= 0 or np.any(np.abs(gaps - gap) > SLICE_GAP_TOLERANCE * gap):
+        error = 'several slices at the same position (several volumes in one series?)' if np.any(gaps <= 0) \
+            else f'irregular slice spacing ({gaps.min():.3g} to {gaps.max():.3g} mm)'
+        return invalid(error)
+
+    same_rescale = len({header['rescale'] for header in slices}) == 1
+    return SeriesGeometry(tuple(header['path'] for header in slices),
+                          size=(slices[0]['size'][0], slices[0]['size'][1], len(slices)), origin=slices[0]['origin'],
+                          spacing=(slices[0]['spacing'][0], slices[0]['spacing'][1], gap),
+                          direction=slices[0]['direction'],
+                          pixel_id=slices[0]['pixel_id'] if same_rescale else sitk.sitkFloat32,
+                          file_bytes=file_bytes, n_series=len(series),
+                          frame_of_reference=slices[0]['frame_of_reference'])
+
+
+def read_dicom_series(folder, pixel_id=None, geometry=None):
+    """
+    Decodes the DICOM series in folder into one 3D image. Runs of DICOM_RUN_SLICES consecutive slices are decoded
+    concurrently by sitk.ImageSeriesReader and pasted into the image as they complete, so that at most one run per
+    thread is held on top of the image. With a single thread, one reader decodes every slice.
+
+    Parameters
+        pixel_id : int: Pixel type of the image (default: that of the series, see SeriesGeometry).
+        geometry : SeriesGeometry: Geometry of the series, if it was already read (see series_geometry).
+
+    Returns:
+        sitk.Image
+    """
+    geometry = geometry or series_geometry(folder)
+    if geometry.error is not None:
+        raise ValueError(f'cannot read the DICOM series in {folder}: {geometry.error}')
+    pixel_id = geometry.pixel_id if pixel_id is None else pixel_id
+    if len(geometry.files) == 1:
+        return sitk.ReadImage(geometry.files[0], pixel_id)
+
+    def decode(run):
+        first, files = run
+        reader = sitk.ImageSeriesReader()
+        reader.SetFileNames(files)
+        reader.SetOutputPixelType(pixel_id)
+        return first, reader.Execute()
+
+    runs = [(first, geometry.files[first:first + DICOM_RUN_SLICES])
+            for first in range(0, len(geometry.files), DICOM_RUN_SLICES)]
+    n_threads = _n_threads(len(runs))
+    if n_threads == 1:
+        _, image = decode((0, list(geometry.files)))
+    else:
+        image = sitk.Image(geometry.size, pixel_id)
+        with ThreadPoolExecutor(max_workers=n_threads) as pool:
+            for first, decoded in pool.map(decode, runs):
+                image[:, :, first:first + decoded.GetSize()[2]] = decoded
+    image.SetOrigin(geometry.origin)
+    image.SetSpacing(geometry.spacing)
+    image.SetDirection(geometry.direction)
+    return image
+
+
+def ras_affine(origin, spacing, direction):
+    """
+    NIfTI (RAS+) affine of a SimpleITK (LPS+) image geometry.
+
+    Returns:
+        4x4 numpy array.
+    """
+    affine = np.eye(4)
+    affine[:3, :3] = np.asarray(direction).reshape(3, 3) * np.asarray(spacing)
+    affine[:3, 3] = origin
+    affine[:2] = -affine[:2]
+    return affine
+
+
+def read_series_pixel_id(folder):
+    """
+    Pixel type of the image read_dicom_series decodes from folder (only the slice headers are read).
+    """
+    return series_geometry(folder).pixel_id
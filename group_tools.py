@@ -0,0 +1,122 @@
+"""
+Developed by Arman Avesta, MD, PhD
+FNNDSC | Boston Children's Hospital | Harvard Medical School
+
+This module groups sibling moving images: the series of one imaging session (e.g. T1, T2 and FLAIR MRI) that were
+acquired in the same scanner frame of reference, so that one and the same transform aligns all of them to the fixed
+image. Only a representative of each group is registered; its transform is applied to its siblings, which are only
+resampled.
+
+Siblings are either found in the input manifest (images of one session whose NIfTI affines match: same origin,
+direction and voxel size, see manifest_tools.ImageHeader), or declared in a JSON sidecar that lists the groups by
+name:
+
+    {"session1": ["session1/t1.nii.gz", "session1/t2.nii.gz", "session1/flair"], "session2": [...]}
+
+Images are named relative to the folder of the moving images. The first image of a declared group is its
+representative; in a group of matching affines, the image with the most voxels is. 4D images are never grouped,
+since each of their timepoints has its own transform.
+
+Matching affines alone do not make siblings: images of different subjects resampled onto one standard grid (e.g. a
+preprocessed cohort) all have the same affine. Images are therefore only grouped by affine within one session: the
+same DICOM frame of reference, or the same parent folder for images without one (see session_key). Matching affines
+across sessions is opt-in (find_siblings(across_sessions=True)).
+"""
+
+# ----------------------------------------------- ENVIRONMENT SETUP ---------------------------------------------------
+# Project imports:
+from io_tools import atomic_output
+
+# System imports:
+import json
+import shutil
+from os.path import join, normpath, dirname
+
+# ---------------------------------------------- HELPER FUNCTIONS -----------------------------------------------------
+
+def session_key(header):
+    """
+    Session an image was acquired in: the DICOM frame of reference UID of a DICOM series that has one, otherwise the
+    folder that holds the image.
+    """
+    if header.frame_of_reference:
+        return 'frame_of_reference', header.frame_of_reference
+    return 'folder', dirname(normpath(header.path))
+
+
+def affine_groups(manifest, across_sessions=False):
+    """
+    Groups the valid images of a manifest of one session (see session_key) whose affines match (images whose header
+    has no affine are left out).
+
+    Parameters
+        across_sessions : bool: Group images of different sessions whose affines match too.
+
+    Returns:
+        list of groups of two or more image paths, the image with the most voxels first (ties by path).
+    """
+    groups = {}
+    for path, header in manifest.items():
+        if header.valid and header.affine:
+            key = header.affine if across_sessions else (session_key(header), header.affine)
+            groups.setdefault(key, []).append(path)
+    return [sorted(paths, key=lambda path: (-manifest[path].n_voxels, path))
+            for paths in groups.values() if len(paths) > 1]
+
+
+def load_sibling_groups(groups_path, moving_folder_path):
+    """
+    Reads the groups declared in a JSON sidecar: an object mapping each group name to a list of image names, or a
+    list of such lists.
+
+    Returns:
+        list of groups of image paths (joined to moving_folder_path), in the order of the sidecar.
+    """
+    with open(groups_path) as file:
+        declared = json.load(file)
+    groups = list(declared.values()) if isinstance(declared, dict) else declared
+    if not isinstance(groups, list) or not all(isinstance(group, list) and all(isinstance(name, str)
+                                                                               for name in group) for group in groups):
+        raise ValueError(f'{groups_path} must map each group name to a list of image names')
+    return [[normpath(join(moving_folder_path, name)) for name in group] for group in groups]
+
+
+def copy_transform(source_path, transform_matrix_path):
+    """
+    Copies the transform of a representative to a sibling (written atomically, see io_tools.atomic_output).
+    """
+    with atomic_output(transform_matrix_path) as temporary_path:
+        shutil.copyfile(source_path, temporary_path)
+
+
+# ----------------------------------------------- MAIN FUNCTIONS ------------------------------------------------------
+
+def find_siblings(manifest, eligible, declared_groups=(), match_affines=False, across_sessions=False):
+    """
+    Chooses the representative of every sibling of a batch. Declared groups are taken first; with match_affines,
+    the remaining images of each session are grouped by affine (see affine_groups). Groups are restricted to the
+    eligible images (e.g. the valid images that fit in memory) that are not 4D, and the first eligible image of each
+    group becomes its representative.
+
+    Parameters
+        manifest : dict mapping each moving image path to its manifest_tools.ImageHeader.
+        eligible : collection of the moving image paths that may be grouped.
+        declared_groups : list of groups of moving image paths (see load_sibling_groups).
+        match_affines : bool: Whether images of one session whose affines match are grouped too.
+        across_sessions : bool: With match_affines, group images of different sessions whose affines match too
+            (only safe if no two sessions share a grid).
+
+    Returns:
+        siblings : dict mapping each sibling path to the path of its representative (representatives are not keys).
+    """
+    eligible = {normpath(path): path for path in eligible if manifest[path].n_timepoints == 1}
+    siblings, grouped = {}, set()
+    groups = [[eligible[path] for path in group if path in eligible] for group in declared_groups]
+    if match_affines:
+        groups += affine_groups({path: manifest[path] for path in eligible.values()}, across_sessions)
+    for group in groups:
+        group = [path for path in group if path not in grouped]
+        grouped.update(group)
+        for sibling in group[1:]:
+            siblings[sibling] = group[0]
+    return siblings
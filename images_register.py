@@ -7,10 +7,32 @@ This module contains argument parsing and main function for the images_register
 """
 # --------------------------------------------- ENVIRONMENT SETUP -----------------------------------------------------
 # Project imports:
-from registration_tools import rigid_registration
-from os_tools import sub_niftis
+from registration_tools import register_batch, resample_batch, RegistrationService, PRESETS, INTERPOLATORS, \
+    INITIALIZATIONS, OPTIMIZERS, MAX_MULTI_START, TIMESERIES_REFERENCES, LOW_MEMORY_OVERRIDES
+from os_tools import sub_niftis, image_stem, peak_rss_mib, reserve_cpus
+from dicom_tools import sub_dicom_series
+from cache_tools import ResultCache, file_digest, file_digests, registration_key
+from journal_tools import CompletionJournal, JOURNAL_FILE
+from profiling_tools import profile_next_to_outputs
+from manifest_tools import build_manifest, save_manifest, read_header, longest_first, split_shards, \
+    merge_shard_outputs, MANIFEST_FILE, BATCH_REPORT_FILE
+from io_tools import OutputFormat, COMPRESSIONS, OUTPUT_DTYPES, remove_partial_outputs
+from mask_tools import FOREGROUND_MASKS
+from resource_tools import plan_resources
+from timeseries_tools import MOTION_SUFFIX
+from pairs_tools import register_pairs, save_pair_results, prepared_bytes, PAIR_TRANSFORMS_FILE, PAIR_METRICS_FILE
+from visualization_tools import QCRenderer, QC_WORKERS
+from group_tools import find_siblings, load_sibling_groups, copy_transform
+from store_tools import save_transform_store, load_store_records, read_transform_record, merge_transform_stores, \
+    TRANSFORM_STORE_FILE
+from service_tools import ImageWatcher, SocketQueue, WatchLoop, save_service_report, SERVICE_REPORT_FILE
 
 # System imports:
+import json
+import numpy as np
+import os
+import sys
+import time
 from os.path import join
 from pathlib import Path
 from argparse import ArgumentParser, Namespace, ArgumentDefaultsHelpFormatter
@@ -73,17 +95,654 @@ Outputs:
         moving_image3.nii.gz, etc.
     output_dir/moving_images_folder/moving_image1_transform.mat, moving_image2_transform.mat, 
         moving_image3_transform.mat, etc.    
+
+Any image can also be a folder holding the slices of a DICOM series, which is read directly (without conversion to
+NIfTI); its outputs are named after the folder: input_dir/moving_images_folder/series1/*.dcm -->
+output_dir/moving_images_folder/series1_registered.nii.gz and series1_transform.mat.
+
+A 4D moving image is registered timepoint by timepoint into one registered 4D image, and the transforms of its
+timepoints are stacked into one motion parameter file: <moving image name>_motion.tsv (instead of _transform.mat).
+
+With --transform_store, the transforms of all the 3D moving images are also saved together in one NumPy file,
+output_dir/moving_images_folder/transforms.npz, with the final metric value, iteration count and time of each
+registration (see store_tools).
+
+With --watch, the plugin runs as a service that registers the moving images as they appear in the moving images
+folder, with the fixed image and the worker processes kept warm (see service_tools).
 """
 
 parser.add_argument('--fixed_image', type=str, default='fixed_image.nii.gz',
-                    help='relative path to the fixed image in relation to input folder')
+                    help='relative path to the fixed image in relation to input folder (.nii.gz file or DICOM '
+                         'series folder)')
 parser.add_argument('--moving_image', type=str, default='moving_image.nii.gz',
                     help='relative path to the moving image in relation to input folder.'
-                         'The moving image must be in .nii.gz format.')
+                         'The moving image must be a .nii.gz file or a folder holding a DICOM series.')
 parser.add_argument('--moving_images_folder', type=str, default='None',
                     help='relative path to the folder containing multiple moving images.'
                          'Every image in this folder will be registered to the fixed image.'
-                         'All moving images must be in .nii.gz format.')
+                         'Moving images are .nii.gz files or subfolders holding a DICOM series.')
+parser.add_argument('--recursive', action='store_true',
+                    help='also register the moving images in the subfolders of moving_images_folder; the outputs '
+                         'mirror the subfolder structure.')
+parser.add_argument('--shard', type=str, default='None',
+                    help='process only shard i of N of moving_images_folder, given as i/N (1 <= i <= N), so that N '
+                         'plugin instances can share a batch. The shards are disjoint, deterministic and balanced by '
+                         'total voxel count.')
+parser.add_argument('--merge_shards', action='store_true',
+                    help='do not register: merge the input_manifest.json and batch_report.json files (and timing '
+                         'profiles) of the shards of a batch, found anywhere in the input folder, into one manifest '
+                         'and report in the output folder.')
+parser.add_argument('--jobs', type=int, default=1,
+                    help='number of moving images registered in parallel (worker processes) when '
+                         'moving_images_folder is given. 0 uses one worker per available CPU. The CPU budget (cgroup '
+                         'CPU quota in a container) is split between workers and the threads each registration uses '
+                         'internally, and fewer workers are used if the memory limit cannot hold them.')
+parser.add_argument('--all_pairs', action='store_true',
+                    help='register every image of moving_images_folder with every other one and save only the '
+                         'transforms and metric values of all the pairs (pairwise_transforms.npz and '
+                         'pairwise_metrics.csv); fixed_image is not used.')
+parser.add_argument('--fixed_images_folder', type=str, default='None',
+                    help='register every image of moving_images_folder with every image of this folder (e.g. '
+                         'several templates) and save only the transforms and metric values of all the pairs '
+                         '(pairwise_transforms.npz and pairwise_metrics.csv); fixed_image is not used.')
+parser.add_argument('--pair_cache_gb', type=float, default=2.0,
+                    help='with --all_pairs or --fixed_images_folder, memory of the prepared images (decoded, masked '
+                         'and pyramid built) each worker keeps to reuse them across pairs.')
+parser.add_argument('--watch', action='store_true',
+                    help='service mode: keep running and register the moving images as they appear in '
+                         '--moving_images_folder (or are queued on --watch_socket), with the fixed image and the '
+                         'worker processes kept warm; per-image latency percentiles are saved in '
+                         f'{SERVICE_REPORT_FILE}. Stops on Ctrl-C or SIGTERM after the registrations in progress.')
+parser.add_argument('--watch_socket', type=str, default='None',
+                    help='with --watch, absolute path of a local (Unix) socket on which other processes queue moving '
+                         'images, one path per line (absolute, or relative to the moving images folder).')
+parser.add_argument('--watch_timeout', type=float, default=0.0,
+                    help='with --watch, stop after this many seconds without any new image (0: run until stopped).')
+parser.add_argument('--transform_only', action='store_true',
+                    help='save only the transform matrices; skip resampling and saving the registered images. '
+                         'They can be produced later with --apply_transforms.')
+parser.add_argument('--apply_transforms', action='store_true',
+                    help='do not register: read existing <moving image name>_transform.mat files and resample the '
+                         'moving images onto the fixed image grid with --final_interpolator.')
+parser.add_argument('--transforms_folder', type=str, default='None',
+                    help='relative path to the folder holding the transform matrices for --apply_transforms '
+                         '(default: the folder of the moving images).')
+parser.add_argument('--preset', type=str, default='balanced', choices=sorted(PRESETS),
+                    help='registration speed / accuracy trade-off. fast: no full-resolution pyramid level, fewer '
+                         'samples and iterations, linear final interpolation. balanced: the historical settings. '
+                         'accurate: 5x more metric samples and up to 300 iterations per level.')
+parser.add_argument('--shrink_factors', type=str, default='None',
+                    help='comma-separated shrink factor of each pyramid level, e.g. 4,2,1 (overrides the preset)')
+parser.add_argument('--smoothing_sigmas', type=str, default='None',
+                    help='comma-separated smoothing sigma (mm) of each pyramid level, e.g. 2,1,0 '
+                         '(overrides the preset)')
+parser.add_argument('--histogram_bins', type=int, default=0,
+                    help='histogram bins of the mutual information metric (0 keeps the preset value)')
+parser.add_argument('--sampling_percentage', type=float, default=0.0,
+                    help='fraction of fixed image voxels sampled by the metric, e.g. 0.01 (0 keeps the preset value)')
+parser.add_argument('--learning_rate', type=float, default=0.0,
+                    help='gradient descent learning rate; initial step of regular_step and powell, and initial '
+                         'simplex size of amoeba (0 keeps the preset value)')
+parser.add_argument('--iterations', type=int, default=0,
+                    help='maximum optimizer iterations per pyramid level (0 keeps the preset value)')
+parser.add_argument('--optimizer', type=str, default='None', choices=['None'] + list(OPTIMIZERS),
+                    help='optimizer of every pyramid level: gradient_descent (historical), regular_step (gradient '
+                         'descent with a step halved whenever the gradient changes direction), lbfgs (quasi-Newton), '
+                         'or the derivative-free powell and amoeba (None keeps the preset value). '
+                         'benchmark_tools.py --optimizers compares them.')
+parser.add_argument('--multi_start', type=int, default=0, choices=range(0, MAX_MULTI_START + 1),
+                    help='optimize the coarsest pyramid level from this many starting transforms concurrently (the '
+                         'initial transform and rotations of it by 10 degrees about each axis) and continue from the '
+                         'best one (0 keeps the preset value, 1).')
+parser.add_argument('--final_interpolator', type=str, default='None', choices=['None'] + sorted(INTERPOLATORS),
+                    help='interpolator of the registered image (None keeps the preset value)')
+parser.add_argument('--time_budget', type=float, default=0.0,
+                    help='wall time (seconds) allowed to register each image (0 keeps the preset value, no limit). '
+                         'When it runs out, the best transform seen so far is kept and the image is flagged in '
+                         'batch_report.json.')
+parser.add_argument('--early_stop_iterations', type=int, default=0,
+                    help='stop a pyramid level once the metric has not improved by more than --early_stop_tolerance '
+                         'for this many iterations, keeping the best transform of the level (0 keeps the preset '
+                         'value, disabled).')
+parser.add_argument('--early_stop_tolerance', type=float, default=0.0,
+                    help='relative metric improvement that resets --early_stop_iterations (0 keeps the preset value, '
+                         '1e-4).')
+parser.add_argument('--low_memory', action='store_true',
+                    help='memory-lean mode: images are decoded in their own data type, registered on copies reduced '
+                         'by --working_shrink (default 2), and resampled --slab_size slices at a time (default 32); '
+                         'images are registered one at a time without read-ahead (see --prefetch).')
+parser.add_argument('--working_shrink', type=int, default=0,
+                    help='register on copies of the images block-averaged by this factor (0 keeps the preset value, '
+                         'or 2 with --low_memory); shrink factors stay relative to the full resolution.')
+parser.add_argument('--slab_size', type=int, default=0,
+                    help='resample the registered images this many slices at a time (0 keeps the preset value, '
+                         'whole volumes, or 32 with --low_memory).')
+parser.add_argument('--initialization', type=str, default='None', choices=['None'] + list(INITIALIZATIONS),
+                    help='initial transform. geometry: align the image centers; moments: also match the principal '
+                         'axes of the two heads; search: also search a grid of rotations. moments and search find '
+                         'the translation by FFT cross-correlation on 4 mm copies of the images, which helps when the '
+                         'patient is positioned differently (None keeps the preset value).')
+parser.add_argument('--foreground_mask', type=str, default='None', choices=['None'] + list(FOREGROUND_MASKS),
+                    help='otsu: compute a mask of the head of every image (Otsu thresholds and morphology on a 2 mm '
+                         'copy), crop the images to it before building the pyramid, and sample the metric only '
+                         'inside the fixed image mask; none: use every voxel (None keeps the preset value).')
+parser.add_argument('--fixed_mask', type=str, default='None',
+                    help='relative path to a mask of the fixed image in relation to input folder (non-zero voxels are '
+                         'foreground), used instead of the computed fixed image mask.')
+parser.add_argument('--timeseries_reference', type=str, default='None',
+                    choices=['None'] + list(TIMESERIES_REFERENCES),
+                    help='target of the timepoints of 4D moving images: the fixed image, or the first or middle '
+                         'timepoint of the series itself (motion correction, on the grid of the moving image). None '
+                         'keeps the preset value (fixed).')
+parser.add_argument('--group_siblings', action='store_true',
+                    help='register only one representative of each group of moving images of one session (same DICOM '
+                         'frame of reference, or same folder) whose affines match (same origin, direction and voxel '
+                         'size) and apply its transform to the others, which are only resampled.')
+parser.add_argument('--group_siblings_across_sessions', action='store_true',
+                    help='with --group_siblings, also group moving images of different folders or frames of '
+                         'reference whose affines match. Only safe if the affine identifies the session: images of '
+                         'different subjects resampled onto one standard grid all match.')
+parser.add_argument('--sibling_groups', type=str, default='None',
+                    help='JSON file in the input folder declaring groups of sibling moving images, e.g. '
+                         '{"session1": ["t1.nii.gz", "t2.nii.gz", "flair.nii.gz"]} (names relative to '
+                         'moving_images_folder); the first image of each group is registered and its transform is '
+                         'applied to the others.')
+parser.add_argument('--output_compression', type=str, default='gzip', choices=COMPRESSIONS,
+                    help='encoding of the registered images. gzip: .nii.gz; none: uncompressed .nii (fastest to '
+                         'write); parallel_gzip: .nii.gz compressed in independent blocks by several threads, readable '
+                         'by any gzip / NIfTI reader.')
+parser.add_argument('--compression_level', type=int, default=-1,
+                    help='gzip level of the registered images, 1 (fastest) to 9 (smallest); -1 uses the default.')
+parser.add_argument('--output_dtype', type=str, default='float32', choices=OUTPUT_DTYPES,
+                    help='data type of the registered images: float32, or the original data type of each moving '
+                         'image (integer images are rounded and clipped), which is smaller and faster to write.')
+parser.add_argument('--profile', action='store_true',
+                    help='record wall and CPU time of each registration stage and the metric value, iteration count '
+                         'and elapsed time of each pyramid level; saved as <moving image name>_profile.json next to '
+                         'the outputs.')
+parser.add_argument('--transform_store', action='store_true',
+                    help=f'also save the transforms of all the registrations in one NumPy file, '
+                         f'{TRANSFORM_STORE_FILE}, indexed by moving image name, with the final metric value, '
+                         'iteration count and time of each registration (see store_tools.load_transform_parameters).')
+parser.add_argument('--qc', action='store_true',
+                    help='save a quality control montage of each registered image as <moving image name>_qc.png '
+                         'next to the outputs: mid-slices of the fixed, moving and registered images and the '
+                         'overlay of the fixed (magenta) and registered (green) images, rendered in the background '
+                         'while the registrations run.')
+parser.add_argument('--prefetch', type=int, default=2,
+                    help='when registrations run in a single process, number of moving images a reader thread '
+                         'decodes ahead of the registration and of outputs queued for a writer thread. '
+                         '0 disables the read / register / write pipeline.')
+parser.add_argument('--resume', action='store_true',
+                    help='skip the moving images that a previous run into the same output folder completed (see '
+                         'completed.jsonl) with the same fixed image, moving image and settings, and whose outputs '
+                         'still exist; interrupted or changed images are processed again.')
+parser.add_argument('--cache_dir', type=str, default='None',
+                    help='absolute path to a folder that caches registration results between runs. Image pairs '
+                         'whose fixed image, moving image and registration settings did not change are restored '
+                         'from the cache instead of being registered again.')
+parser.add_argument('--cache_size_gb', type=float, default=10.0,
+                    help='size limit of the result cache; least recently used results are evicted beyond it.')
+parser.add_argument('--cache_transforms_only', action='store_true',
+                    help='cache only the transforms (not the registered images); on a cache hit the moving image '
+                         'is resampled with the cached transform.')
+
+# ------------------------------------------------ HELPER FUNCTIONS ---------------------------------------------------
+
+def list_images(folder_path, recursive=False):
+    """
+    Names (relative to folder_path) of the NIfTI images and DICOM series folders below folder_path.
+    """
+    return sorted(sub_niftis(folder_path, complete_path=False, recursive=recursive) +
+                  sub_dicom_series(folder_path, complete_path=False, recursive=recursive))
+
+
+def registration_parameters(options):
+    """
+    Registration parameters of the chosen preset with the individual overrides given on the command line.
+    """
+    def floats(text):
+        return None if text == 'None' else tuple(float(value) for value in text.split(','))
+
+    shrink_factors = floats(options.shrink_factors)
+    parameters = PRESETS[options.preset]
+    if options.low_memory:
+        parameters = parameters.with_overrides(**LOW_MEMORY_OVERRIDES)
+    return parameters.with_overrides(
+        shrink_factors=None if shrink_factors is None else tuple(int(factor) for factor in shrink_factors),
+        smoothing_sigmas=floats(options.smoothing_sigmas),
+        histogram_bins=options.histogram_bins or None,
+        sampling_percentage=options.sampling_percentage or None,
+        learning_rate=options.learning_rate or None,
+        iterations=options.iterations or None,
+        final_interpolator=None if options.final_interpolator == 'None' else options.final_interpolator,
+        working_shrink=options.working_shrink or None,
+        resample_slab_size=options.slab_size or None,
+        initialization=None if options.initialization == 'None' else options.initialization,
+        foreground_mask=None if options.foreground_mask == 'None' else options.foreground_mask,
+        time_budget_seconds=options.time_budget or None,
+        early_stop_iterations=options.early_stop_iterations or None,
+        early_stop_tolerance=options.early_stop_tolerance or None,
+        optimizer=None if options.optimizer == 'None' else options.optimizer,
+        multi_start=options.multi_start or None,
+        timeseries_reference=None if options.timeseries_reference == 'None' else options.timeseries_reference)
+
+
+def save_settings(output_folder, preset, parameters, output_format, fixed_mask_path=None):
+    """
+    Records the effective registration settings next to the outputs (registration_settings.json).
+    """
+    with open(join(output_folder, 'registration_settings.json'), 'w') as file:
+        json.dump(dict(version=__version__, preset=preset, parameters=parameters.to_dict(),
+                       output_format=output_format.to_dict(), fixed_mask=fixed_mask_path), file, indent=2)
+
+
+def registration_keys(fixed_image_path, jobs, parameters, output_format, fixed_mask_path=None, siblings=None,
+                      fixed_digest=None):
+    """
+    Registration key of every job (see cache_tools.registration_key), which identifies its result in the cache and
+    in the completion journal. The moving images are hashed concurrently. The key of a sibling also holds the
+    content of its representative, whose transform it takes.
+
+    Parameters
+        fixed_image_path : str: path to the fixed image.
+        jobs : list of (moving_image_path, registered_image_path, transform_matrix_path) tuples.
+        parameters : RegistrationParameters: registration settings (part of the key).
+        output_format : OutputFormat: encoding of the registered images (part of the key).
+        fixed_mask_path : str: mask of the fixed image supplied by the user, if any (its content is part of the key).
+        siblings : dict mapping each sibling moving_image_path to its representative (see group_tools).
+        fixed_digest : str: digest of the fixed image, if it was already computed (see cache_tools.file_digest).
+
+    Returns:
+        keys : dict mapping each moving_image_path to its key.
+    """
+    fixed_digest = fixed_digest or file_digest(fixed_image_path)
+    settings = dict(parameters.to_dict(), output_format=output_format.to_dict())
+    if fixed_mask_path is not None:
+        settings['fixed_mask'] = file_digest(fixed_mask_path)
+    moving_digests = file_digests([job[0] for job in jobs])
+    siblings = siblings or {}
+
+    def job_settings(moving_image_path):
+        if moving_image_path not in siblings:
+            return settings
+        return dict(settings, representative=moving_digests[siblings[moving_image_path]])
+
+    return {moving_image_path: registration_key(fixed_digest, moving_digest, job_settings(moving_image_path))
+            for moving_image_path, moving_digest in moving_digests.items()}
+
+
+def restore_from_cache(cache, jobs, keys):
+    """
+    Restores every job whose result is in the cache and returns the jobs that still need to be registered.
+
+    Parameters
+        cache : ResultCache: the result cache.
+        jobs : list of (moving_image_path, registered_image_path, transform_matrix_path) tuples.
+        keys : dict mapping each moving_image_path to its key (see registration_keys).
+
+    Returns:
+        (misses, to_resample): misses is the list of jobs to register; to_resample lists the
+        (moving_image_path, transform_matrix_path, registered_image_path) hits whose registered image was not cached.
+    """
+    misses, to_resample = [], []
+    for moving_image_path, registered_image_path, transform_matrix_path in jobs:
+        key = keys[moving_image_path]
+        image_restored = cache.restore(key, transform_matrix_path, registered_image_path)
+        if image_restored is None:
+            misses.append((moving_image_path, registered_image_path, transform_matrix_path))
+        elif not image_restored and registered_image_path is not None:
+            to_resample.append((moving_image_path, transform_matrix_path, registered_image_path))
+    return misses, to_resample
+
+
+def parse_shard(text):
+    """
+    'i/N' --> (i, N), or None for 'None'.
+    """
+    if text == 'None':
+        return None
+    try:
+        index, n_shards = (int(value) for value in text.split('/'))
+    except ValueError:
+        sys.exit(f'--shard must be given as i/N, not {text}')
+    if not 1 <= index <= n_shards:
+        sys.exit(f'--shard {text}: i must be between 1 and N')
+    return index, n_shards
+
+
+def report_peak_memory(n_jobs):
+    """
+    Prints the peak resident memory of the plugin process and, when the images were processed by a pool of
+    n_jobs > 1 worker processes, of the largest worker, to size memory limits.
+
+    Returns:
+        (peak_rss_mib, workers_peak_rss_mib)
+    """
+    peak, workers_peak = peak_rss_mib(), peak_rss_mib(children=True) if n_jobs != 1 else 0.0
+    message = f'Peak memory: {peak:.0f} MiB'
+    if workers_peak > 0:
+        message += f' (largest worker process: {workers_peak:.0f} MiB)'
+    print(message)
+    return peak, workers_peak
+
+
+def read_fixed_header(fixed_image_path):
+    """
+    Reads the header of the fixed image (see manifest_tools.ImageHeader) and exits if it is invalid or 4D.
+    """
+    fixed_header = read_header(fixed_image_path)
+    if not fixed_header.valid:
+        sys.exit(f'Invalid fixed image {fixed_image_path}: {fixed_header.error}')
+    if fixed_header.n_timepoints > 1:
+        sys.exit(f'Invalid fixed image {fixed_image_path}: 4D image of shape {fixed_header.shape} (3D expected)')
+    return fixed_header
+
+
+def discover_inputs(fixed_image_path, moving_folder_path, moving_images_list, output_folder, shard=None):
+    """
+    Reads the headers of the fixed and moving images (without decoding voxel data), selects the moving images of the
+    shard, saves their manifest (input_manifest.json) and reports invalid inputs before any registration starts.
+    Exits if the fixed image is invalid.
+
+    Returns:
+        (moving_images_list, manifest, invalid, fixed_header): the moving images of the shard (all of them if shard is
+        None); manifest maps each of their paths to its manifest_tools.ImageHeader; invalid maps the path of every
+        invalid moving image to the reason; fixed_header is the ImageHeader of the fixed image.
+    """
+    fixed_header = read_fixed_header(fixed_image_path)
+    manifest = build_manifest([join(moving_folder_path, moving_image) for moving_image in moving_images_list])
+    if shard is not None:
+        index, n_shards = shard
+        sizes = {moving_image: manifest[join(moving_folder_path, moving_image)].n_voxels
+                 for moving_image in moving_images_list}
+        selected = set(split_shards(sizes, n_shards)[index - 1])
+        moving_images_list = [moving_image for moving_image in moving_images_list if moving_image in selected]
+        manifest = {join(moving_folder_path, moving_image): manifest[join(moving_folder_path, moving_image)]
+                    for moving_image in moving_images_list}
+        print(f'Shard {index}/{n_shards}: {len(moving_images_list)} of {len(sizes)} moving images.')
+    save_manifest(manifest, join(output_folder, MANIFEST_FILE), None if shard is None else '{}/{}'.format(*shard))
+    invalid = {path: f'invalid input: {header.error}' for path, header in manifest.items() if not header.valid}
+    for path, error in invalid.items():
+        print(f'Skipping {path}: {error}', file=sys.stderr)
+    return moving_images_list, manifest, invalid, fixed_header
+
+
+def group_siblings(options, inputdir, moving_folder, manifest, jobs):
+    """
+    Finds the sibling moving images of the jobs (see group_tools.find_siblings) and prints the groups found. Exits if
+    the sidecar declaring the groups cannot be read.
+
+    Returns:
+        siblings : dict mapping each sibling moving image path to the path of its representative.
+    """
+    if not options.group_siblings and options.sibling_groups == 'None':
+        return {}
+    declared = []
+    if options.sibling_groups != 'None':
+        try:
+            declared = load_sibling_groups(join(inputdir, options.sibling_groups), join(inputdir, moving_folder))
+        except (OSError, ValueError) as error:
+            sys.exit(f'Cannot read the sibling groups {options.sibling_groups}: {error}')
+    siblings = find_siblings(manifest, [job[0] for job in jobs], declared, match_affines=options.group_siblings,
+                             across_sessions=options.group_siblings_across_sessions)
+    print(f'Sibling groups: {len(set(siblings.values()))} representatives are registered and their transforms '
+          f'applied to {len(siblings)} siblings.')
+    return siblings
+
+
+def plan_batch(fixed_header, jobs, manifest, parameters, output_format, options, resample_output=True):
+    """
+    Plans the workers, threads and read-ahead of the jobs within the CPU quota and memory limit of the plugin (see
+    resource_tools.plan_resources), leaving one CPU to each QC renderer (with --qc), sets the threads of this process
+    and prints the plan.
+
+    Returns:
+        (plan, serial, refused): serial is the set of moving image paths to register alone; refused maps the paths
+        of the images that do not fit in memory to the reason.
+    """
+    headers = {job[0]: manifest[job[0]] for job in jobs}
+    itemsizes = {path: header.voxel_bytes // max(1, header.n_voxels) if output_format.dtype == 'moving' else 4
+                 for path, header in headers.items()}
+    plan, serial, refused = plan_resources(fixed_header, headers, parameters, n_jobs=options.jobs,
+                                           prefetch=options.prefetch, output_itemsizes=itemsizes,
+                                           resample_output=resample_output,
+                                           helper_processes=QC_WORKERS if options.qc and resample_output else 0)
+    plan.apply()
+    print(plan.summary(), flush=True)
+    for path, reason in refused.items():
+        print(f'Skipping {path}: {reason}', file=sys.stderr)
+    return plan, set(serial), refused
+
+
+def finish_batch(output_folder, options, n_images, failures, started, cache=None, task='registrations', flagged=None,
+                 plan=None, qc_failures=None, siblings=None):
+    """
+    Reports peak memory, saves the batch report (batch_report.json: shard, failed images, images flagged by the time
+    budget, images whose QC montage failed, siblings and their representatives, cache hits, wall time, peak memory and
+    resource plan) next to the outputs, then reports failures (see report_failures).
+    """
+    peak, workers_peak = report_peak_memory(options.jobs if plan is None else plan.n_workers)
+    flagged = flagged or {}
+    qc_failures = qc_failures or {}
+    report = dict(version=__version__, task=task, shard=None if options.shard == 'None' else options.shard,
+                  images=n_images, failed=sorted(failures), flagged=dict(sorted(flagged.items())),
+                  qc_failed=sorted(qc_failures), siblings=dict(sorted((siblings or {}).items())),
+                  cache_hits=0 if cache is None else cache.hits, wall_seconds=time.perf_counter() - started,
+                  peak_rss_mib=peak, workers_peak_rss_mib=workers_peak,
+                  resource_plan=None if plan is None else plan.to_dict())
+    with open(join(output_folder, BATCH_REPORT_FILE), 'w') as file:
+        json.dump(report, file, indent=2)
+    if flagged:
+        print(f'{len(flagged)} of {n_images} {task} ran out of time budget and kept the best transform seen '
+              f'(see {BATCH_REPORT_FILE}).', file=sys.stderr)
+    if qc_failures:
+        print(f'{len(qc_failures)} QC montages failed (see {BATCH_REPORT_FILE}).', file=sys.stderr)
+    report_failures(failures, n_images, task)
+
+
+def register_all_pairs(options, inputdir, outputdir, parameters, started):
+    """
+    Many-to-many mode (see pairs_tools): registers every moving image with every fixed image of fixed_images_folder,
+    or with every other moving image (all_pairs), and saves the transform store and the metric matrix of the pairs.
+    """
+    moving_folder = '' if options.moving_images_folder == 'None' else options.moving_images_folder
+    output_folder = join(outputdir, moving_folder)
+    os.makedirs(output_folder, exist_ok=True)
+    names = {join(inputdir, moving_folder, name): image_stem(name)
+             for name in list_images(join(inputdir, moving_folder), options.recursive)}
+    moving_paths = list(names)
+    fixed_paths = moving_paths
+    if not options.all_pairs:
+        fixed_folder = options.fixed_images_folder
+        fixed_names = {join(inputdir, fixed_folder, name): join(fixed_folder, image_stem(name))
+                       for name in list_images(join(inputdir, fixed_folder), options.recursive)}
+        names.update(fixed_names)
+        fixed_paths = list(fixed_names)
+
+    manifest = build_manifest(list(names))
+    save_manifest(manifest, join(output_folder, MANIFEST_FILE))
+    invalid = {path: f'invalid input: {header.error}' if not header.valid else 'invalid input: 4D image (3D expected)'
+               for path, header in manifest.items() if not header.valid or header.n_timepoints > 1}
+    for path, error in invalid.items():
+        print(f'Skipping {path}: {error}', file=sys.stderr)
+    fixed_paths = [path for path in fixed_paths if path not in invalid]
+    moving_paths = [path for path in moving_paths if path not in invalid]
+    if not fixed_paths or not moving_paths:
+        print(f'No valid {"fixed" if not fixed_paths else "moving"} images: nothing to register.')
+        return
+
+    image_bytes = max((prepared_bytes(manifest[path], parameters) for path in fixed_paths + moving_paths), default=0)
+    records, pair_failures, preparations = register_pairs(fixed_paths, moving_paths, parameters, n_jobs=options.jobs,
+                                                         cache_bytes=int(options.pair_cache_gb * 2 ** 30),
+                                                         image_bytes=image_bytes)
+    save_pair_results(records, pair_failures, join(output_folder, PAIR_TRANSFORMS_FILE),
+                      join(output_folder, PAIR_METRICS_FILE), names)
+    print(f'{len(records)} pairs registered with {preparations} image preparations.')
+    failures = {f'{fixed} -> {moving}': error for (fixed, moving), error in pair_failures.items()}
+    flagged = {f'{fixed} -> {moving}': list(record.flags)
+               for (fixed, moving), record in records.items() if record.flags}
+    # Invalid inputs are reported as failures, so they count towards the total like the attempted pairs:
+    finish_batch(output_folder, options, len(records) + len(pair_failures) + len(invalid), {**invalid, **failures},
+                 started, task='pair registrations', flagged=flagged)
+
+
+def serve_moving_images(options, inputdir, outputdir, parameters, output_format, started):
+    """
+    Watch mode: registers the moving images as they appear in the moving images folder or are queued on the socket,
+    until Ctrl-C, SIGTERM or options.watch_timeout seconds without new images, then finishes the registrations in
+    progress and saves the batch report (and the transform store). The fixed image context and the worker processes
+    are prepared once (see registration_tools.RegistrationService).
+
+    Every image is journaled as it completes; with --resume, the images a previous run completed are skipped. The
+    result cache, sibling groups, sharding and the resource plan do not apply to this mode. A 4D image is registered
+    timepoint by timepoint by one worker (see registration_tools.register_timeseries).
+    """
+    if options.moving_images_folder == 'None':
+        sys.exit('--watch needs --moving_images_folder: the folder to watch.')
+    fixed_image_path = join(inputdir, options.fixed_image)
+    fixed_mask_path = None if options.fixed_mask == 'None' else join(inputdir, options.fixed_mask)
+    read_fixed_header(fixed_image_path)
+    moving_folder_path = join(inputdir, options.moving_images_folder)
+    output_folder = join(outputdir, options.moving_images_folder)
+    os.makedirs(output_folder, exist_ok=True)
+    remove_partial_outputs(output_folder)
+    save_settings(output_folder, options.preset, parameters, output_format, fixed_mask_path)
+
+    fixed_digest = file_digest(fixed_image_path)
+    journal = CompletionJournal(join(output_folder, JOURNAL_FILE))
+    qc = QCRenderer(fixed_image_path) if options.qc else None
+    if qc is not None:
+        # The registration workers split the CPUs left by the QC renderers
+        reserve_cpus(QC_WORKERS)
+    jobs, names, records, flagged, refused = {}, {}, {}, {}, {}
+
+    def job_for(moving_image_path, header):
+        if os.path.relpath(moving_image_path, moving_folder_path).startswith(os.pardir):
+            name = image_stem(os.path.basename(moving_image_path))
+        else:
+            name = image_stem(os.path.relpath(moving_image_path, moving_folder_path))
+        os.makedirs(os.path.dirname(join(output_folder, name)), exist_ok=True)
+        transform_suffix = MOTION_SUFFIX if header.n_timepoints > 1 else '_transform.mat'
+        return (moving_image_path, join(output_folder, name + '_registered' + output_format.extension),
+                join(output_folder, name + transform_suffix)), name
+
+    def keys_of(job_list):
+        return registration_keys(fixed_image_path, job_list, parameters, output_format, fixed_mask_path,
+                                 fixed_digest=fixed_digest)
+
+    def prepare(moving_image_path):
+        header = read_header(moving_image_path)
+        if not header.valid:
+            refused[moving_image_path] = f'invalid input: {header.error}'
+            print(f'Skipping {moving_image_path}: {refused[moving_image_path]}', file=sys.stderr)
+            return None
+        jobs[moving_image_path], names[moving_image_path] = job_for(moving_image_path, header)
+        return jobs[moving_image_path]
+
+    def registration_completed(moving_image_path):
+        registered_image_path, transform_matrix_path = jobs[moving_image_path][1:]
+        journal.record(moving_image_path, keys_of([jobs[moving_image_path]])[moving_image_path],
+                       (registered_image_path, transform_matrix_path))
+        if qc is not None:
+            qc.submit(moving_image_path, registered_image_path)
+
+    def save_report():
+        report = dict(version=__version__, task='service', fixed_image=fixed_image_path, watched=moving_folder_path,
+                      uptime_seconds=time.perf_counter() - started, pending=service.n_pending,
+                      failed=sorted({**refused, **service.failures}), flagged=dict(sorted(flagged.items())),
+                      **loop.latencies.to_dict())
+        save_service_report(join(output_folder, SERVICE_REPORT_FILE), report)
+
+    watcher = ImageWatcher(moving_folder_path, lambda folder: list_images(folder, options.recursive))
+    if options.resume:
+        existing = dict(job_for(image_path, read_header(image_path))
+                        for image_path in [join(moving_folder_path, name)
+                                           for name in list_images(moving_folder_path, options.recursive)])
+        keys = keys_of(list(existing))
+        for job, name in existing.items():
+            if journal.is_complete(job[0], keys[job[0]], job[1:]):
+                watcher.seen.add(job[0])
+                jobs[job[0]], names[job[0]] = job, name
+        print(f'Resuming: {len(jobs)} moving images are already complete.')
+    sockets = None if options.watch_socket == 'None' else SocketQueue(options.watch_socket, moving_folder_path)
+    loop = WatchLoop(watcher, prepare, sockets, on_completed=registration_completed, on_update=save_report,
+                     timeout=options.watch_timeout)
+    service = RegistrationService(fixed_image_path, parameters, options.jobs,
+                                  hook_factory=profile_next_to_outputs if options.profile else None,
+                                  output_format=output_format, fixed_mask_path=fixed_mask_path,
+                                  on_success=loop.completed, on_flagged=flagged.__setitem__,
+                                  on_result=records.__setitem__ if options.transform_store else None)
+    print(f'Watching {moving_folder_path} with {service.n_workers} workers'
+          + ('' if sockets is None else f' and listening on {options.watch_socket}')
+          + f' (ready in {time.perf_counter() - started:.1f} s).', flush=True)
+    loop.run(service)
+    if options.transform_store:
+        write_transform_store(output_folder, list(jobs.values()), names, records, service.failures)
+    finish_batch(output_folder, options, len(jobs) + len(refused), {**refused, **service.failures}, started,
+                 flagged=flagged, qc_failures=None if qc is None else qc.close())
+
+
+def write_transform_store(output_folder, jobs, names, records, failures):
+    """
+    Saves the transforms of the completed 3D registrations of a batch into the transform store (see store_tools).
+    Images that this run did not register (resumed, restored from the cache, or siblings) are read from their
+    transform file; they keep the metric value, iterations and time of the store of a previous run if their
+    transform did not change.
+
+    Parameters
+        jobs : list of (moving_image_path, registered_image_path, transform_matrix_path) tuples.
+        names : dict mapping each moving image path to its name in the store.
+        records : dict mapping each moving image path registered by this run to its RegistrationRecord.
+        failures : dict of the moving image paths that failed (left out of the store).
+    """
+    store_path = join(output_folder, TRANSFORM_STORE_FILE)
+    previous = load_store_records(store_path) if os.path.isfile(store_path) else {}
+    store = {}
+    for moving_image_path, _, transform_matrix_path in jobs:
+        if moving_image_path in failures or transform_matrix_path.endswith(MOTION_SUFFIX):
+            continue
+        name = names[moving_image_path]
+        record = records.get(moving_image_path)
+        if record is None and os.path.isfile(transform_matrix_path):
+            record = read_transform_record(transform_matrix_path)
+            if name in previous and np.allclose(previous[name].parameters + previous[name].center,
+                                                record.parameters + record.center):
+                record = previous[name]
+        if record is not None:
+            store[name] = record
+    save_transform_store(store_path, store)
+    print(f'Saved {len(store)} transforms to {store_path}.')
+
+
+def merge_shards(inputdir, outputdir):
+    """
+    Merges the manifests, batch reports, timing profiles and transform stores of the shards found in inputdir into
+    outputdir.
+    """
+    manifest, report = merge_shard_outputs(inputdir)
+    os.makedirs(outputdir, exist_ok=True)
+    save_manifest(manifest, join(outputdir, MANIFEST_FILE))
+    records = merge_transform_stores(inputdir)
+    if records:
+        save_transform_store(join(outputdir, TRANSFORM_STORE_FILE), records)
+    with open(join(outputdir, BATCH_REPORT_FILE), 'w') as file:
+        json.dump(report, file, indent=2)
+    print(f"Merged {len(report['shard_reports'])} shard reports: {report['images']} images, "
+          f"{len(report['failed'])} failed, {len(report['flagged'])} flagged, {report['wall_seconds_max']:.0f} s for "
+          f"the slowest shard.")
+    if report['missing_shards']:
+        print(f"Missing shards: {', '.join(report['missing_shards'])}", file=sys.stderr)
+
+
+def report_failures(failures, n_jobs, task='registrations'):
+    """
+    Prints the traceback of every failed image and exits with an error if anything failed.
+    """
+    if failures:
+        for moving_image_path, error in failures.items():
+            print(f'\n{moving_image_path} failed:\n{error}', file=sys.stderr)
+        sys.exit(f'{len(failures)} of {n_jobs} {task} failed.')
 
 # ------------------------------------------- ChRIS PLUGIN WRAPPER ----------------------------------------------------
 
@@ -113,28 +772,180 @@ def main(options: Namespace, inputdir: Path, outputdir: Path):
     :param outputdir: directory where to write output files
     """
     print(DISPLAY_TITLE)
+    started = time.perf_counter()
+
+    if options.merge_shards:
+        merge_shards(inputdir, outputdir)
+        return
+
+    if options.all_pairs or options.fixed_images_folder != 'None':
+        register_all_pairs(options, inputdir, outputdir, registration_parameters(options), started)
+        return
+
+    if options.watch:
+        serve_moving_images(options, inputdir, outputdir, registration_parameters(options),
+                            OutputFormat(compression=options.output_compression,
+                                         compression_level=options.compression_level, dtype=options.output_dtype),
+                            started)
+        return
 
     fixed_image_path = join(inputdir, options.fixed_image)
+    fixed_mask_path = None if options.fixed_mask == 'None' else join(inputdir, options.fixed_mask)
+    if fixed_mask_path is not None and not os.path.isfile(fixed_mask_path):
+        sys.exit(f'Fixed image mask not found: {fixed_mask_path}')
+    parameters = registration_parameters(options)
+    output_format = OutputFormat(compression=options.output_compression, compression_level=options.compression_level,
+                                 dtype=options.output_dtype)
 
     if options.moving_images_folder == 'None':
-        moving_image_path = join(inputdir, options.moving_image)
-        registered_image_path = join(outputdir, options.moving_image.replace('.nii.gz', '_registered.nii.gz'))
-        transform_matrix_path = join(outputdir, options.moving_image.replace('.nii.gz', '_transform.mat'))
+        moving_folder, moving_images_list = '', [options.moving_image]
+    else:
+        moving_folder = options.moving_images_folder
+        moving_images_list = list_images(join(inputdir, moving_folder), options.recursive)
+    output_folder = join(outputdir, moving_folder)
+    os.makedirs(output_folder, exist_ok=True)
+    if remove_partial_outputs(output_folder):
+        print(f'Removed the partially written outputs of an interrupted run from {output_folder}.')
 
-        rigid_registration(fixed_image_path, moving_image_path, registered_image_path, transform_matrix_path)
+    moving_images_list, manifest, invalid, fixed_header = discover_inputs(fixed_image_path,
+                                                                          join(inputdir, moving_folder),
+                                                                          moving_images_list, output_folder,
+                                                                          parse_shard(options.shard))
 
-    else:
-        moving_images_list = sub_niftis(join(inputdir, options.moving_images_folder), complete_path=False)
-        for moving_image in moving_images_list:
-            moving_image_path = join(inputdir, options.moving_images_folder, moving_image)
-            registered_image_path = join(outputdir,
-                                         options.moving_images_folder,
-                                         options.moving_image.replace('.nii.gz', '_registered.nii.gz'))
-            transform_matrix_path = join(outputdir,
-                                         options.moving_images_folder,
-                                         options.moving_image.replace('.nii.gz', '_transform.mat'))
-
-            rigid_registration(fixed_image_path, moving_image_path, registered_image_path, transform_matrix_path)
+    jobs, names = [], {}
+    for moving_image in moving_images_list:
+        moving_image_path = join(inputdir, moving_folder, moving_image)
+        if moving_image_path in invalid:
+            continue
+        names[moving_image_path] = image_stem(moving_image)
+        registered_image_path = join(output_folder, image_stem(moving_image) + '_registered' + output_format.extension)
+        # The transforms of the timepoints of a 4D image are stacked into one motion parameter file
+        transform_suffix = MOTION_SUFFIX if manifest[moving_image_path].n_timepoints > 1 else '_transform.mat'
+        transform_matrix_path = join(output_folder, image_stem(moving_image) + transform_suffix)
+        os.makedirs(os.path.dirname(transform_matrix_path), exist_ok=True)
+        jobs.append((moving_image_path, registered_image_path, transform_matrix_path))
+    jobs = longest_first(jobs, manifest)
+
+    if options.apply_transforms:
+        transforms_folder = moving_folder if options.transforms_folder == 'None' else options.transforms_folder
+        resample_jobs = [(moving_image_path,
+                          join(inputdir, transforms_folder, os.path.relpath(transform_matrix_path, output_folder)),
+                          registered_image_path)
+                         for moving_image_path, registered_image_path, transform_matrix_path in jobs]
+        plan, serial, refused = plan_batch(fixed_header, resample_jobs, manifest, parameters, output_format, options)
+        resample_jobs = [job for job in resample_jobs if job[0] not in refused]
+        registered_paths = {moving_image_path: registered_image_path
+                            for moving_image_path, _, registered_image_path in resample_jobs}
+        qc = QCRenderer(fixed_image_path) if options.qc else None
+
+        def resampling_completed(moving_image_path):
+            if qc is not None:
+                qc.submit(moving_image_path, registered_paths[moving_image_path])
+
+        failures = resample_batch(fixed_image_path, [job for job in resample_jobs if job[0] not in serial],
+                                  parameters.final_interpolator, n_jobs=plan.n_workers, output_format=output_format,
+                                  slab_size=parameters.resample_slab_size, on_success=resampling_completed,
+                                  serial_jobs=[job for job in resample_jobs if job[0] in serial],
+                                  timeseries_reference=parameters.timeseries_reference)
+        finish_batch(output_folder, options, len(moving_images_list), {**invalid, **refused, **failures}, started,
+                     task='resamplings', plan=plan, qc_failures=None if qc is None else qc.close())
+        return
+
+    if options.transform_only:
+        jobs = [(moving_image_path, None, transform_matrix_path)
+                for moving_image_path, _, transform_matrix_path in jobs]
+        if options.qc:
+            print('--qc is ignored with --transform_only: no registered images are written.', file=sys.stderr)
+    plan, serial, refused = plan_batch(fixed_header, jobs, manifest, parameters, output_format, options,
+                                       resample_output=not options.transform_only)
+    jobs = [job for job in jobs if job[0] not in refused]
+    siblings = group_siblings(options, inputdir, moving_folder, manifest, jobs)
+    save_settings(output_folder, options.preset, parameters, output_format, fixed_mask_path)
+
+    # Every completed image is journaled with its key, so that a --resume run can skip it
+    keys = registration_keys(fixed_image_path, jobs, parameters, output_format, fixed_mask_path, siblings)
+    outputs = {moving_image_path: (registered_image_path, transform_matrix_path)
+               for moving_image_path, registered_image_path, transform_matrix_path in jobs}
+    journal = CompletionJournal(join(output_folder, JOURNAL_FILE))
+    qc = QCRenderer(fixed_image_path) if options.qc and not options.transform_only else None
+
+    def journal_completion(moving_image_path):
+        journal.record(moving_image_path, keys[moving_image_path], outputs[moving_image_path])
+        if qc is not None:
+            qc.submit(moving_image_path, outputs[moving_image_path][0])
+
+    pending = jobs
+    if options.resume:
+        pending = [job for job in jobs if not journal.is_complete(job[0], keys[job[0]], outputs[job[0]])]
+        print(f'Resuming: {len(jobs) - len(pending)} of {len(jobs)} moving images are already complete.')
+
+    cache = None
+    if options.cache_dir != 'None':
+        cache = ResultCache(options.cache_dir, max_bytes=int(options.cache_size_gb * 2 ** 30))
+        misses, to_resample = restore_from_cache(cache, pending, keys)
+        unfinished = {job[0] for job in misses + to_resample}
+        for moving_image_path, _, _ in pending:
+            if moving_image_path not in unfinished:
+                journal_completion(moving_image_path)
+        report_failures(resample_batch(fixed_image_path, to_resample, parameters.final_interpolator,
+                                       n_jobs=plan.n_workers, output_format=output_format,
+                                       slab_size=parameters.resample_slab_size, on_success=journal_completion,
+                                       timeseries_reference=parameters.timeseries_reference),
+                        len(to_resample), 'resamplings of cached transforms')
+        pending = misses
+
+    # Registrations cut short by the time budget depend on the machine load, so they are reported but not cached
+    flagged, records = {}, {}
+
+    def registration_flagged(moving_image_path, flags):
+        flagged[moving_image_path] = flags
+
+    def registration_completed(moving_image_path):
+        journal_completion(moving_image_path)
+        if cache is not None and moving_image_path not in flagged:
+            registered_image_path, transform_matrix_path = outputs[moving_image_path]
+            cache.store(keys[moving_image_path], transform_matrix_path,
+                        None if options.cache_transforms_only else registered_image_path)
+
+    sibling_jobs = [job for job in pending if job[0] in siblings]
+    pending = [job for job in pending if job[0] not in siblings]
+    failures = register_batch(fixed_image_path, [job for job in pending if job[0] not in serial],
+                              parameters=parameters, n_jobs=plan.n_workers,
+                              hook_factory=profile_next_to_outputs if options.profile else None,
+                              prefetch=0 if options.low_memory else plan.prefetch, output_format=output_format,
+                              on_success=registration_completed, fixed_mask_path=fixed_mask_path,
+                              on_flagged=registration_flagged,
+                              serial_jobs=[job for job in pending if job[0] in serial],
+                              on_result=records.__setitem__ if options.transform_store else None)
+
+    # Siblings take the transform of their representative (registered above, or by a previous run) and are resampled
+    to_resample = []
+    for moving_image_path, registered_image_path, transform_matrix_path in sibling_jobs:
+        representative = siblings[moving_image_path]
+        representative_transform_path = outputs[representative][1]
+        if representative in failures or not os.path.isfile(representative_transform_path):
+            failures[moving_image_path] = f'the registration of its representative {representative} failed'
+            continue
+        copy_transform(representative_transform_path, transform_matrix_path)
+        if representative in flagged:
+            flagged[moving_image_path] = flagged[representative]
+        if registered_image_path is None:
+            registration_completed(moving_image_path)
+        else:
+            to_resample.append((moving_image_path, transform_matrix_path, registered_image_path))
+    failures.update(resample_batch(fixed_image_path, [job for job in to_resample if job[0] not in serial],
+                                   parameters.final_interpolator, n_jobs=plan.n_workers, output_format=output_format,
+                                   slab_size=parameters.resample_slab_size, on_success=registration_completed,
+                                   serial_jobs=[job for job in to_resample if job[0] in serial],
+                                   timeseries_reference=parameters.timeseries_reference))
+
+    if cache is not None:
+        print(cache.summary())
+    if options.transform_store:
+        write_transform_store(output_folder, jobs, names, records, failures)
+
+    finish_batch(output_folder, options, len(moving_images_list), {**invalid, **refused, **failures}, started, cache,
+                 flagged=flagged, plan=plan, qc_failures=None if qc is None else qc.close(), siblings=siblings)
 
 # ------------------------------------------------ EXECUTE MAIN -------------------------------------------------------
 
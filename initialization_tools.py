@@ -0,0 +1,196 @@
+"""
+Developed by Arman Avesta, MD, PhD
+FNNDSC | Boston Children's Hospital | Harvard Medical School
+
+This module contains the coarse initialization search that can run before the optimizer.
+
+Both images are reduced to a coarse grid (about COARSE_SPACING_MM) and described by their gradient magnitude, which
+responds to edges rather than to intensities and therefore works across contrasts. A set of candidate rotations
+(the principal axes of the two head shapes, or a small grid of rotations) is tested; for each rotation, the best
+translation is found at once for all shifts by FFT cross-correlation, and candidates are processed in batches with
+NumPy. The best rotation and translation seed the Euler3D transform of the registration, so the pyramid levels start
+close to the solution instead of from aligned image centers.
+"""
+
+# ----------------------------------------------- ENVIRONMENT SETUP ---------------------------------------------------
+# Project imports:
+
+
+# System imports:
+import SimpleITK as sitk
+import numpy as np
+from itertools import product
+
+# Spacing (mm) of the coarse grid the search runs on:
+COARSE_SPACING_MM = 4.0
+
+# Number of rotation candidates correlated per batch of FFTs:
+FFT_BATCH_SIZE = 8
+
+# Principal axes candidates that rotate by more than this (degrees) are discarded: the axes of a near-ellipsoidal head
+# are only defined up to their sign, and flipped candidates can correlate well with a symmetric head:
+MAX_MOMENTS_ANGLE_DEG = 90.0
+
+# First step (degrees) of the rotation grids that refine the principal axes rotation:
+MOMENTS_REFINEMENT_DEG = 8.0
+
+# The rotation search stops refining its grid when the step between angles falls below this (degrees):
+MIN_ANGLE_STEP_DEG = 2.0
+
+# ---------------------------------------------- HELPER FUNCTIONS -----------------------------------------------------
+
+def coarse_image(image, spacing_mm=COARSE_SPACING_MM):
+    """
+    Block-averaged float32 copy of an image with a voxel size close to spacing_mm.
+    """
+    factors = [max(1, int(round(spacing_mm / spacing))) for spacing in image.GetSpacing()]
+    if image.GetPixelID() != sitk.sitkFloat32:
+        image = sitk.Cast(image, sitk.sitkFloat32)
+    return sitk.BinShrink(image, factors)
+
+
+def edge_features(image):
+    """
+    Gradient magnitude of a coarse image, at the scale of its voxels.
+    """
+    return sitk.GradientMagnitudeRecursiveGaussian(image, max(image.GetSpacing()))
+
+
+def _principal_axes(image):
+    """
+    Center and principal axes (columns, by decreasing extent) of the foreground of an image, i.e. its voxels
+    brighter than the mean, in physical coordinates.
+    """
+    array = sitk.GetArrayViewFromImage(image)
+    indices = np.argwhere(array > array.mean())[:, ::-1].astype(np.float64)
+    direction = np.asarray(image.GetDirection()).reshape(3, 3)
+    points = np.asarray(image.GetOrigin()) + (indices * image.GetSpacing()) @ direction.T
+    center = points.mean(axis=0)
+    eigenvalues, eigenvectors = np.linalg.eigh(np.cov((points - center).T))
+    return center, eigenvectors[:, ::-1]
+
+
+def principal_axes_candidates(fixed_coarse, moving_coarse):
+    """
+    Candidate (rotation matrix, fixed point, moving point) that map the principal axes of the fixed foreground onto
+    those of the moving foreground. The axes are defined up to their sign, so each of the four proper rotations
+    that turns by at most MAX_MOMENTS_ANGLE_DEG is returned.
+    """
+    fixed_center, fixed_axes = _principal_axes(fixed_coarse)
+    moving_center, moving_axes = _principal_axes(moving_coarse)
+    candidates = []
+    for signs in product((1, -1), repeat=3):
+        rotation = moving_axes @ np.diag(signs) @ fixed_axes.T
+        angle = np.degrees(np.arccos(np.clip((np.trace(rotation) - 1) / 2, -1.0, 1.0)))
+        if np.linalg.det(rotation) > 0 and angle <= MAX_MOMENTS_ANGLE_DEG:
+            candidates.append((rotation, fixed_center, moving_center))
+    return candidates
+
+
+def rotation_grid(max_angle_deg, steps=3):
+    """
+    Rotation matrices of a grid of Euler angles: `steps` angles from -max_angle_deg to max_angle_deg about each axis
+    (steps^3 rotations, including the identity when steps is odd).
+    """
+    angles = np.deg2rad(np.linspace(-max_angle_deg, max_angle_deg, steps))
+    rotations = []
+    for angle_x, angle_y, angle_z in product(angles, repeat=3):
+        transform = sitk.Euler3DTransform()
+        transform.SetRotation(float(angle_x), float(angle_y), float(angle_z))
+        rotations.append(np.asarray(transform.GetMatrix()).reshape(3, 3))
+    return rotations
+
+
+def _euler_transform(center, rotation, translation):
+    transform = sitk.Euler3DTransform()
+    transform.SetCenter(tuple(float(value) for value in center))
+    transform.SetMatrix(tuple(float(value) for value in rotation.flatten()))
+    transform.SetTranslation(tuple(float(value) for value in translation))
+    return transform
+
+
+def fft_translation_search(fixed_features, moving_features, transforms):
+    """
+    For each candidate transform, finds the translation of the fixed grid that best correlates the fixed features
+    with the moving features resampled through the transform, by FFT cross-correlation (zero-padded, so that shifts
+    up to half the field of view do not wrap around).
+
+    Returns:
+        list of (score, shift) per transform: score is the normalized correlation at the best shift; shift is the
+        physical displacement (mm) in the fixed image space.
+    """
+    fixed_array = sitk.GetArrayFromImage(fixed_features)
+    padded_shape = [n + n // 2 for n in fixed_array.shape]
+    axes = (1, 2, 3)
+    fixed_spectrum = np.fft.rfftn(fixed_array, s=padded_shape, axes=(0, 1, 2))
+    fixed_norm = float(np.linalg.norm(fixed_array))
+    direction = np.asarray(fixed_features.GetDirection()).reshape(3, 3)
+    spacing = np.asarray(fixed_features.GetSpacing())
+
+    results = []
+    for first in range(0, len(transforms), FFT_BATCH_SIZE):
+        batch = np.stack([sitk.GetArrayFromImage(sitk.Resample(moving_features, fixed_features, transform,
+                                                                sitk.sitkLinear, 0.0, sitk.sitkFloat32))
+                          for transform in transforms[first:first + FFT_BATCH_SIZE]])
+        spectra = np.fft.rfftn(batch, s=padded_shape, axes=axes)
+        correlations = np.fft.irfftn(fixed_spectrum[None] * np.conj(spectra), s=padded_shape, axes=axes)
+        norms = np.linalg.norm(batch.reshape(len(batch), -1), axis=1) * fixed_norm
+        for correlation, norm in zip(correlations, norms):
+            peak = np.unravel_index(int(np.argmax(correlation)), correlation.shape)
+            shift_zyx = [p - n if p > n // 2 else p for p, n in zip(peak, padded_shape)]
+            shift = direction @ (spacing * np.asarray(shift_zyx[::-1], dtype=np.float64))
+            results.append((float(correlation[peak]) / max(norm, 1e-12), shift))
+    return results
+
+
+# ----------------------------------------------- MAIN FUNCTIONS ------------------------------------------------------
+
+def coarse_initialization(fixed_coarse, moving_image, initial_transform, method, max_angle_deg=15.0):
+    """
+    Searches for a better starting transform than initial_transform.
+
+    Parameters
+        fixed_coarse : sitk.Image: Coarse fixed image (see coarse_image).
+        moving_image : sitk.Image: Moving image.
+        initial_transform : sitk.Euler3DTransform: Center-aligning transform; its center is kept.
+        method : str: 'moments' starts from the best of the principal axes rotations (or no rotation), and refines it
+            with grids of rotations of MOMENTS_REFINEMENT_DEG about each axis. 'search' starts with a 3 x 3 x 3 grid
+            of rotations of up to max_angle_deg about each axis (which includes no rotation). The grids are then
+            repeated around the best rotation with half the step, until the step is below MIN_ANGLE_STEP_DEG.
+        max_angle_deg : float: Largest rotation of the first 'search' grid.
+
+    Returns:
+        sitk.Euler3DTransform: the best candidate, with its FFT-refined translation.
+    """
+    moving_coarse = coarse_image(moving_image)
+    fixed_features, moving_features = edge_features(fixed_coarse), edge_features(moving_coarse)
+    center = np.asarray(initial_transform.GetCenter())
+    translation = np.asarray(initial_transform.GetTranslation())
+
+    def best_of(candidates):
+        # candidates: (rotation, translation mapping the rotation center onto its moving point)
+        transforms = [_euler_transform(center, rotation, candidate_translation)
+                      for rotation, candidate_translation in candidates]
+        results = fft_translation_search(fixed_features, moving_features, transforms)
+        best = int(np.argmax([score for score, _ in results]))
+        rotation, candidate_translation = candidates[best]
+        return results[best][0], rotation, candidate_translation - rotation @ results[best][1]
+
+    rotation = np.eye(3)
+    if method == 'moments':
+        candidates = [(rotation, translation)]
+        for axes_rotation, fixed_point, moving_point in principal_axes_candidates(fixed_coarse, moving_coarse):
+            candidates.append((axes_rotation, axes_rotation @ (center - fixed_point) + moving_point - center))
+        _, rotation, translation = best_of(candidates)
+        step = MOMENTS_REFINEMENT_DEG
+    elif method == 'search':
+        step = max_angle_deg
+    else:
+        raise ValueError(f'unknown initialization: {method}')
+
+    # Grids of rotations around the best one so far, with a step halved at each round. The translation found so far
+    # is kept for every rotation of a grid (they share the rotation center).
+    while step >= MIN_ANGLE_STEP_DEG:
+        _, rotation, translation = best_of([(rotation @ delta, translation) for delta in rotation_grid(step)])
+        step /= 2
+    return _euler_transform(center, rotation, translation)
@@ -0,0 +1,212 @@
+"""
+Developed by Arman Avesta, MD, PhD
+FNNDSC | Boston Children's Hospital | Harvard Medical School
+
+This module contains image reading and writing functions, including the encodings of the registered images:
+plain .nii, gzip at a chosen level, block-parallel gzip, and the original integer data type of the moving image.
+Input images are NIfTI files or folders holding a DICOM series (see dicom_tools).
+"""
+
+# ----------------------------------------------- ENVIRONMENT SETUP ---------------------------------------------------
+# Project imports:
+from os_tools import available_cpus, subfiles_recursive
+from dicom_tools import read_series_pixel_id, ras_affine
+
+# System imports:
+import SimpleITK as sitk
+import nibabel as nib
+import numpy as np
+import os
+import uuid
+import zlib
+from itertools import islice
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from dataclasses import dataclass, asdict
+from os.path import join, dirname, basename
+
+# Compression of the registered images:
+COMPRESSIONS = ('gzip', 'none', 'parallel_gzip')
+
+# Data types of the registered images: 'float32' (the registration's working type) or the moving image's own type.
+OUTPUT_DTYPES = ('float32', 'moving')
+
+# Size of the independently compressed blocks of parallel gzip:
+PARALLEL_GZIP_BLOCK_SIZE = 4 << 20
+
+# Name prefix of the temporary files that outputs are written to before they are renamed into place:
+PARTIAL_PREFIX = '.partial-'
+
+# ---------------------------------------------- HELPER FUNCTIONS -----------------------------------------------------
+
+@dataclass(frozen=True)
+class OutputFormat:
+    """
+    Encoding of the registered images.
+
+    Attributes
+        compression : str: 'gzip' (.nii.gz, single-threaded), 'none' (.nii) or 'parallel_gzip' (.nii.gz made of
+            independently compressed blocks, written by several threads; standard gzip readers, ITK and nibabel read
+            it like any other .nii.gz).
+        compression_level : int: gzip level 1 (fastest) to 9 (smallest); -1 uses the library default.
+        dtype : str: 'float32', or 'moving' to write the registered image in the moving image's original data type
+            (integer types are rounded and clipped to their range).
+        threads : int: Compression threads of parallel_gzip (0: one per available CPU).
+    """
+    compression: str = 'gzip'
+    compression_level: int = -1
+    dtype: str = 'float32'
+    threads: int = 0
+
+    def __post_init__(self):
+        assert self.compression in COMPRESSIONS, f'unknown compression: {self.compression}'
+        assert self.dtype in OUTPUT_DTYPES, f'unknown output dtype: {self.dtype}'
+        assert self.compression_level == -1 or 1 <= self.compression_level <= 9, 'gzip level must be 1-9 or -1.'
+
+    @property
+    def extension(self):
+        return '.nii' if self.compression == 'none' else '.nii.gz'
+
+    def pixel_id(self, moving_pixel_id):
+        """
+        Pixel type of the registered image of a moving image of type moving_pixel_id.
+        """
+        return moving_pixel_id if self.dtype == 'moving' and moving_pixel_id is not None else sitk.sitkFloat32
+
+    def to_dict(self):
+        return asdict(self)
+
+
+def read_pixel_id(image_path):
+    """
+    Pixel type of an image file (or DICOM series folder), read from its header only (the voxel data is not decoded).
+    """
+    if os.path.isdir(image_path):
+        return read_series_pixel_id(image_path)
+    reader = sitk.ImageFileReader()
+    reader.SetFileName(image_path)
+    reader.ReadImageInformation()
+    return reader.GetPixelID()
+
+
+def cast_to_pixel_id(image, pixel_id):
+    """
+    Casts a float image to pixel_id. Integer types are rounded to the nearest value and clipped to their range
+    instead of being truncated and wrapped around.
+    """
+    if image.GetPixelID() == pixel_id:
+        return image
+    target = sitk.Image(1, 1, pixel_id)
+    dtype = sitk.GetArrayViewFromImage(target).dtype
+    if not np.issubdtype(dtype, np.integer):
+        return sitk.Cast(image, pixel_id)
+    limits = np.iinfo(dtype)
+    array = np.clip(np.rint(sitk.GetArrayViewFromImage(image)), limits.min, limits.max).astype(dtype)
+    cast = sitk.GetImageFromArray(array)
+    cast.CopyInformation(image)
+    return cast
+
+
+@contextmanager
+def atomic_output(path):
+    """
+    Context manager that yields a temporary path next to path (same folder and extension) to write an output to.
+    When the block completes, the temporary file is renamed onto path in one atomic step; if the block fails or the
+    process is killed, path is left untouched and never holds a truncated file.
+    """
+    temporary_path = join(dirname(path), f'{PARTIAL_PREFIX}{uuid.uuid4().hex[:12]}-{basename(path)}')
+    try:
+        yield temporary_path
+        os.replace(temporary_path, path)
+    finally:
+        if os.path.exists(temporary_path):
+            os.remove(temporary_path)
+
+
+def remove_partial_outputs(folder):
+    """
+    Removes the temporary files that killed runs left in folder and its subfolders (see atomic_output).
+
+    Returns:
+        Number of files removed.
+    """
+    partial_paths = [path for path in subfiles_recursive(folder) if basename(path).startswith(PARTIAL_PREFIX)]
+    for path in partial_paths:
+        os.remove(path)
+    return len(partial_paths)
+
+
+def _nifti_header(image):
+    """
+    NIfTI-1 header of an image as SimpleITK writes it to a .nii file, followed by the 4 bytes that flag the absence of
+    header extensions (352 bytes in all, the offset of the voxel data): the qform and the sform both hold the RAS+
+    affine of the image (see dicom_tools.ras_affine), and the units are mm and seconds.
+    """
+    dimension = image.GetDimension()
+    direction = np.asarray(image.GetDirection()).reshape(dimension, dimension)[:3, :3]
+    affine = ras_affine(image.GetOrigin()[:3], image.GetSpacing()[:3], direction)
+    header = nib.Nifti1Header()
+    header.set_data_dtype(sitk.GetArrayViewFromImage(image).dtype)
+    header.set_data_shape(image.GetSize())
+    header.set_qform(affine, code=1)
+    header.set_sform(affine, code=1)
+    header.set_zooms(image.GetSpacing())
+    header.set_xyzt_units('mm', 'sec')
+    header['pixdim'][dimension + 1:] = 0
+    header['regular'] = b'r'
+    header['vox_offset'] = 352
+    return header.binaryblock + bytes(4)
+
+
+def _parallel_gzip(buffers, target_path, level, threads):
+    """
+    Compresses the concatenation of buffers (bytes-like objects) into target_path as a sequence of gzip members, one
+    per block of PARALLEL_GZIP_BLOCK_SIZE bytes, compressed concurrently (zlib releases the GIL). A multi-member file
+    is a valid gzip file and decompresses to the concatenated blocks. Blocks are memoryview slices of the buffers,
+    so nothing is copied before compression.
+    """
+    level = 6 if level == -1 else level
+    threads = threads or available_cpus()
+
+    def compress(block):
+        compressor = zlib.compressobj(level, zlib.DEFLATED, 31)
+        return compressor.compress(block) + compressor.flush()
+
+    views = [memoryview(buffer).cast('B') for buffer in buffers]
+    blocks = (view[first:first + PARALLEL_GZIP_BLOCK_SIZE]
+              for view in views for first in range(0, len(view), PARALLEL_GZIP_BLOCK_SIZE))
+    with open(target_path, 'wb') as target, ThreadPoolExecutor(max_workers=threads) as pool:
+        while True:
+            batch = list(islice(blocks, 2 * threads))
+            if not batch:
+                break
+            for member in pool.map(compress, batch):
+                target.write(member)
+
+
+# ----------------------------------------------- MAIN FUNCTIONS ------------------------------------------------------
+
+def write_image(image, image_path, output_format=None, pixel_id=None):
+    """
+    Saves an image with the given output format, atomically replacing an existing file (see atomic_output).
+
+    Parameters
+        image : sitk.Image: Image to save.
+        image_path : str: Destination; its extension should match output_format.extension.
+        output_format : OutputFormat: Encoding (default: float32 .nii.gz at the default gzip level).
+        pixel_id : int: Original pixel type, used when output_format.dtype is 'moving'.
+    """
+    output_format = output_format or OutputFormat()
+    if output_format.dtype == 'moving' and pixel_id is not None:
+        image = cast_to_pixel_id(image, pixel_id)
+
+    with atomic_output(image_path) as temporary_path:
+        if output_format.compression == 'parallel_gzip':
+            # The NIfTI file is serialized in memory (header, then the voxel buffer of the image, which is already in
+            # NIfTI order) and compressed as it is, without an uncompressed copy on disk
+            voxels = sitk.GetArrayViewFromImage(image)
+            _parallel_gzip([_nifti_header(image), voxels], temporary_path, output_format.compression_level,
+                           output_format.threads)
+        else:
+            sitk.WriteImage(image, temporary_path, useCompression=output_format.compression == 'gzip',
+                            compressionLevel=output_format.compression_level)
@@ -0,0 +1,79 @@
+"""
+Developed by Arman Avesta, MD, PhD
+FNNDSC | Boston Children's Hospital | Harvard Medical School
+
+This module contains the completion journal of a batch, which makes interrupted runs resumable.
+
+Every moving image whose outputs are completely written is appended to the journal together with its registration
+key (hash of the fixed image, the moving image and the settings, see cache_tools.registration_key). A run with
+--resume skips the images whose journal entry has the current key and whose outputs still exist, and redoes the
+others: those that were interrupted, and those whose inputs or settings changed.
+"""
+
+# ----------------------------------------------- ENVIRONMENT SETUP ---------------------------------------------------
+# Project imports:
+
+
+# System imports:
+import json
+import os
+import threading
+from datetime import datetime
+from os.path import exists
+
+# Name of the journal file in the output folder:
+JOURNAL_FILE = 'completed.jsonl'
+
+# ----------------------------------------------- MAIN FUNCTIONS ------------------------------------------------------
+
+class CompletionJournal:
+    """
+    Append-only journal of completed moving images, one JSON record per line.
+
+    Records are appended and flushed to disk (fsync) one at a time, so a journal cut short by a crash loses at most
+    its last, partial line, which is ignored and removed when the journal is opened. A later record of the same
+    moving image supersedes earlier ones.
+
+    Attributes
+        journal_path : str: Path to the journal file.
+        entries : dict mapping each moving image path to its latest record.
+    """
+    def __init__(self, journal_path):
+        self.journal_path = journal_path
+        self.entries = {}
+        self._lock = threading.Lock()
+        if exists(journal_path):
+            with open(journal_path, 'rb+') as file:
+                content = file.read()
+                for line in content.splitlines():
+                    try:
+                        entry = json.loads(line)
+                    except json.JSONDecodeError:
+                        continue
+                    self.entries[entry['moving_image']] = entry
+                # Drop the partial last line of a crashed run, so that the next record starts on a line of its own
+                complete = content.rfind(b'\n') + 1
+                if complete < len(content):
+                    file.truncate(complete)
+
+    def is_complete(self, moving_image_path, key, output_paths):
+        """
+        Whether moving_image_path was completed with the same registration key and all its outputs still exist.
+        """
+        entry = self.entries.get(moving_image_path)
+        return entry is not None and entry['key'] == key and \
+            all(path is None or exists(path) for path in output_paths)
+
+    def record(self, moving_image_path, key, output_paths):
+        """
+        Appends the completion of moving_image_path (key: its registration key; output_paths: the files written).
+        """
+        entry = dict(moving_image=moving_image_path, key=key,
+                     outputs=[path for path in output_paths if path is not None],
+                     completed=datetime.now().isoformat(timespec='seconds'))
+        with self._lock:
+            with open(self.journal_path, 'a') as file:
+                file.write(json.dumps(entry) + '\n')
+                file.flush()
+                os.fsync(file.fileno())
+            self.entries[moving_image_path] = entry
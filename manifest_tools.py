@@ -0,0 +1,257 @@
+"""
+Developed by Arman Avesta, MD, PhD
+FNNDSC | Boston Children's Hospital | Harvard Medical School
+
+This module contains the input manifest of a batch: every input image is described from its NIfTI header (or the
+headers of the slices of its DICOM series) alone (dimensions, voxel size, data type and decoded size) before any
+voxel data is decompressed, so that unreadable or unsupported inputs are reported up front and the largest
+registrations can be scheduled first.
+
+It also splits a batch into shards of balanced voxel count for several plugin instances, and merges the manifests
+and batch reports of the shards.
+"""
+
+# ----------------------------------------------- ENVIRONMENT SETUP ---------------------------------------------------
+# Project imports:
+from os_tools import subfiles_recursive
+from dicom_tools import series_geometry, ras_affine
+
+# System imports:
+import json
+import nibabel as nib
+import numpy as np
+import os
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass, asdict
+from os.path import relpath
+
+# Number of threads reading headers concurrently (header reads are dominated by file system latency):
+HEADER_READ_THREADS = 16
+
+# Decimals the affines of the manifest are rounded to (mm), so that images of one scanner frame compare equal:
+AFFINE_DECIMALS = 3
+
+# Files of each batch, written to its output folder:
+MANIFEST_FILE = 'input_manifest.json'
+BATCH_REPORT_FILE = 'batch_report.json'
+
+# ---------------------------------------------- HELPER FUNCTIONS -----------------------------------------------------
+
+@dataclass(frozen=True)
+class ImageHeader:
+    """
+    Description of one input image, read from its header.
+
+    Attributes
+        path : str: Path to the image.
+        shape : tuple of int: Dimensions (voxels).
+        voxel_size : tuple of float: Voxel size along each dimension (mm).
+        dtype : str: Data type of the voxels on disk.
+        voxel_bytes : int: Size of the decoded voxel data.
+        file_bytes : int: Size of the file.
+        affine : tuple of float: NIfTI (RAS+) affine, flattened row by row (rounded to AFFINE_DECIMALS).
+        frame_of_reference : str: DICOM frame of reference UID of a DICOM series (empty if unknown).
+        error : str: Why the image cannot be registered; None if it is valid.
+    """
+    path: str
+    shape: tuple = ()
+    voxel_size: tuple = ()
+    dtype: str = None
+    voxel_bytes: int = 0
+    file_bytes: int = 0
+    affine: tuple = ()
+    frame_of_reference: str = ''
+    error: str = None
+
+    @property
+    def valid(self):
+        return self.error is None
+
+    @property
+    def n_timepoints(self):
+        return self.shape[3] if len(self.shape) > 3 else 1
+
+    @property
+    def n_voxels(self):
+        return int(np.prod(self.shape, dtype=np.int64)) if self.shape else 0
+
+    def to_dict(self):
+        return asdict(self)
+
+
+def _rounded_affine(affine):
+    return tuple(round(float(value), AFFINE_DECIMALS) for value in np.asarray(affine).ravel())
+
+
+def _header_error(header, shape, voxel_size, dtype, file_bytes, compressed):
+    """
+    Reason why an image with this header cannot be registered, or None.
+    """
+    if len(shape) < 3 or int(np.prod(shape[4:], dtype=np.int64)) > 1:
+        return f'{len(shape)}D image of shape {shape} (3D or 4D expected)'
+    if min(shape) == 0:
+        return f'empty image of shape {shape}'
+    if dtype.names is not None or not np.issubdtype(dtype, np.number) or np.issubdtype(dtype, np.complexfloating):
+        return f'unsupported data type {dtype} (scalar integer or float voxels expected)'
+    if min(voxel_size[:3]) <= 0:
+        return f'invalid voxel size {voxel_size}'
+    if not compressed and 'vox_offset' in header and file_bytes < int(header['vox_offset']) + \
+            int(np.prod(shape, dtype=np.int64)) * dtype.itemsize:
+        return f'truncated file ({file_bytes} bytes)'
+    return None
+
+
+# ----------------------------------------------- MAIN FUNCTIONS ------------------------------------------------------
+
+def read_series_header(folder):
+    """
+    Describes and validates a DICOM series folder from the headers of its slices (see dicom_tools.series_geometry).
+    """
+    try:
+        geometry = series_geometry(folder)
+    except Exception as error:
+        return ImageHeader(folder, error=f'unreadable DICOM series: {error}')
+    if geometry.error is not None:
+        return ImageHeader(folder, error=f'invalid DICOM series: {geometry.error}')
+    shape, dtype = tuple(int(n) for n in geometry.size), geometry.dtype
+    return ImageHeader(folder, shape=shape, voxel_size=tuple(float(size) for size in geometry.spacing),
+                       dtype=str(dtype), voxel_bytes=int(np.prod(shape, dtype=np.int64)) * dtype.itemsize,
+                       file_bytes=geometry.file_bytes,
+                       affine=_rounded_affine(ras_affine(geometry.origin, geometry.spacing, geometry.direction)),
+                       frame_of_reference=geometry.frame_of_reference)
+
+
+def read_header(image_path):
+    """
+    Describes and validates an image from its NIfTI header, or a DICOM series folder from the headers of its
+    slices; the voxel data is not decoded.
+
+    Returns:
+        ImageHeader (with error set if the image is unreadable or cannot be registered).
+    """
+    if os.path.isdir(image_path):
+        return read_series_header(image_path)
+    try:
+        file_bytes = os.path.getsize(image_path)
+        image = nib.load(image_path)
+        header = image.header
+        shape = tuple(int(n) for n in header.get_data_shape())
+        voxel_size = tuple(float(size) for size in header.get_zooms())
+        dtype = header.get_data_dtype()
+        affine = _rounded_affine(image.affine)
+    except Exception as error:
+        return ImageHeader(image_path, error=f'unreadable header: {error}')
+
+    error = _header_error(header, shape, voxel_size, dtype, file_bytes, compressed=image_path.endswith('.gz'))
+    return ImageHeader(image_path, shape=shape, voxel_size=voxel_size, dtype=str(dtype),
+                       voxel_bytes=int(np.prod(shape, dtype=np.int64)) * dtype.itemsize, file_bytes=file_bytes,
+                       affine=affine, error=error)
+
+
+def build_manifest(image_paths):
+    """
+    Reads the headers of many images concurrently.
+
+    Returns:
+        dict mapping each image path to its ImageHeader, in the order of image_paths.
+    """
+    with ThreadPoolExecutor(max_workers=HEADER_READ_THREADS) as pool:
+        return dict(zip(image_paths, pool.map(read_header, image_paths)))
+
+
+def save_manifest(manifest, manifest_path, shard=None):
+    """
+    Saves a manifest (see build_manifest) as JSON, with a summary of the batch and the shard ('i/N') it covers.
+    """
+    headers = list(manifest.values())
+    summary = dict(images=len(headers), invalid=sum(not header.valid for header in headers),
+                   voxel_bytes=sum(header.voxel_bytes for header in headers),
+                   file_bytes=sum(header.file_bytes for header in headers), shard=shard)
+    with open(manifest_path, 'w') as file:
+        json.dump(dict(summary=summary, images=[header.to_dict() for header in headers]), file, indent=2)
+
+
+def load_manifest(manifest_path):
+    """
+    Reads a manifest saved by save_manifest.
+
+    Returns:
+        (manifest, summary)
+    """
+    with open(manifest_path) as file:
+        saved = json.load(file)
+    headers = [ImageHeader(**dict(image, shape=tuple(image['shape']), voxel_size=tuple(image['voxel_size']),
+                                  affine=tuple(image.get('affine', ()))))
+               for image in saved['images']]
+    return {header.path: header for header in headers}, saved['summary']
+
+
+def longest_first(jobs, manifest):
+    """
+    Orders jobs (tuples whose first element is the moving image path) by decreasing number of voxels of the moving
+    image, so that in a pool of workers the largest registrations start first instead of straggling at the end.
+    Jobs of equal size keep their order.
+    """
+    return sorted(jobs, key=lambda job: manifest[job[0]].n_voxels, reverse=True)
+
+
+def split_shards(sizes, n_shards):
+    """
+    Deterministic split of a batch into n_shards disjoint shards of balanced total size: images are taken from the
+    largest to the smallest (ties by name) and each one goes to the shard with the smallest total so far (ties by
+    number of images, then shard number). The split only depends on the names and sizes, so every plugin instance
+    computes the same one.
+
+    Parameters
+        sizes : dict mapping each image name (e.g. its path relative to the input folder) to its number of voxels.
+        n_shards : int: Number of shards.
+
+    Returns:
+        list of n_shards lists of image names.
+    """
+    shards = [[] for _ in range(n_shards)]
+    totals = [0] * n_shards
+    for name in sorted(sizes, key=lambda name: (-sizes[name], name)):
+        target = min(range(n_shards), key=lambda shard: (totals[shard], len(shards[shard]), shard))
+        shards[target].append(name)
+        totals[target] += sizes[name]
+    return shards
+
+
+def merge_shard_outputs(root):
+    """
+    Merges the manifests and batch reports of the shards of a batch, found anywhere below root (e.g. the output
+    folders of the shards copied next to each other), together with the per-image timing profiles.
+
+    Returns:
+        (manifest, report): the merged manifest (to be saved with save_manifest) and the merged batch report.
+    """
+    manifest, reports = {}, []
+    for manifest_path in subfiles_recursive(root, suffix=MANIFEST_FILE):
+        shard_manifest, summary = load_manifest(manifest_path)
+        manifest.update(shard_manifest)
+    for report_path in subfiles_recursive(root, suffix=BATCH_REPORT_FILE):
+        with open(report_path) as file:
+            reports.append(dict(json.load(file), report=relpath(report_path, root)))
+    profiles = {}
+    for profile_path in subfiles_recursive(root, suffix='_profile.json'):
+        with open(profile_path) as file:
+            profiles[relpath(profile_path, root)] = json.load(file).get('total')
+
+    n_shards = {report['shard'].split('/')[1] for report in reports if report.get('shard')}
+    shards = sorted(report['shard'] for report in reports if report.get('shard'))
+    missing = []
+    if len(n_shards) == 1:
+        n = int(n_shards.pop())
+        missing = [f'{i}/{n}' for i in range(1, n + 1) if f'{i}/{n}' not in shards]
+    wall_seconds = [report['wall_seconds'] for report in reports]
+    report = dict(shards=shards, missing_shards=missing,
+                  images=sum(report['images'] for report in reports),
+                  failed=sorted(path for report in reports for path in report['failed']),
+                  flagged=dict(sorted((path, flags) for report in reports
+                                      for path, flags in report.get('flagged', {}).items())),
+                  cache_hits=sum(report.get('cache_hits', 0) for report in reports),
+                  wall_seconds_total=sum(wall_seconds), wall_seconds_max=max(wall_seconds, default=0.0),
+                  peak_rss_mib=max((report['peak_rss_mib'] for report in reports), default=0.0),
+                  shard_reports=reports, profiles=profiles)
+    return dict(sorted(manifest.items())), report
@@ -0,0 +1,125 @@
+"""
+Developed by Arman Avesta, MD, PhD
+FNNDSC | Boston Children's Hospital | Harvard Medical School
+
+This module contains the foreground (head) masks of the registration.
+
+Most voxels of a head CT or MRI are air. The foreground mask of the fixed image restricts the metric samples to the
+head (through SetMetricFixedMask), and both images are cropped to the bounding box of their mask before the
+pyramid is built, so that smoothing, shrinking and metric evaluation only process the head. Masks are computed on a
+block-averaged copy of the image (about MASK_SPACING_MM), by Otsu thresholds followed by morphology, or read from a
+file supplied by the user. ITK tests mask membership in physical space, so the masks do not need to share the grid of
+their image.
+"""
+
+# ----------------------------------------------- ENVIRONMENT SETUP ---------------------------------------------------
+# Project imports:
+from initialization_tools import coarse_image
+
+# System imports:
+import SimpleITK as sitk
+import numpy as np
+
+# Foreground masks of the registration: 'none' uses every voxel; 'otsu' computes the mask of each image:
+FOREGROUND_MASKS = ('none', 'otsu')
+
+# Spacing (mm) of the block-averaged copy the masks are computed on:
+MASK_SPACING_MM = 2.0
+
+# Radius (voxels of the mask grid) of the opening that removes noise and thin structures (e.g. head holders) from the
+# thresholded image:
+MASK_OPENING_RADIUS = 1
+
+# Margin (mm) kept around the bounding box of a mask when cropping, so that the smoothing of the pyramid levels is not
+# affected by the crop and the moving image can still move within the metric domain:
+MASK_MARGIN_MM = 10.0
+
+# ---------------------------------------------- HELPER FUNCTIONS -----------------------------------------------------
+
+def _largest_component(mask):
+    """
+    Largest connected component of a binary mask (the mask itself if it is empty).
+    """
+    components = sitk.RelabelComponent(sitk.ConnectedComponent(mask), sortByObjectSize=True)
+    largest = components == 1
+    return largest if sitk.GetArrayViewFromImage(largest).any() else mask
+
+
+def _is_empty(mask):
+    return not sitk.GetArrayViewFromImage(mask).any()
+
+
+def bounding_box(mask, image, margin_mm=MASK_MARGIN_MM):
+    """
+    Index region of image that contains the foreground of mask, padded by margin_mm.
+
+    Returns:
+        (lower, upper) voxel indices of image (upper excluded), or None if the mask is empty.
+    """
+    statistics = sitk.LabelShapeStatisticsImageFilter()
+    statistics.Execute(mask)
+    if not statistics.HasLabel(1):
+        return None
+    box = statistics.GetBoundingBox(1)
+    start, size = np.asarray(box[:3]), np.asarray(box[3:])
+    corners = [image.TransformPhysicalPointToContinuousIndex(mask.TransformContinuousIndexToPhysicalPoint(
+                   tuple(float(value) for value in start - 0.5 + size * np.asarray(corner))))
+               for corner in np.ndindex(2, 2, 2)]
+    margin = margin_mm / np.asarray(image.GetSpacing())
+    lower = np.maximum(np.floor(np.min(corners, axis=0) - margin).astype(int), 0)
+    upper = np.minimum(np.ceil(np.max(corners, axis=0) + margin).astype(int) + 1, image.GetSize())
+    if np.any(upper <= lower):
+        return None
+    return lower, upper
+
+
+# ----------------------------------------------- MAIN FUNCTIONS ------------------------------------------------------
+
+def foreground_mask(image):
+    """
+    Foreground mask of an image, computed on a copy block-averaged to about MASK_SPACING_MM. The copy is split into
+    three intensity classes by Otsu thresholds, and everything above the darkest class (air) is foreground: a single
+    Otsu threshold often separates bone or white matter from the rest of the head instead. The mask is then opened to
+    remove noise, reduced to its largest connected component, closed, and its holes are filled. If nothing is left,
+    the whole image is foreground.
+
+    Returns:
+        sitk.Image: uint8 mask (1: foreground) on the grid of the block-averaged copy.
+    """
+    coarse = coarse_image(image, MASK_SPACING_MM)
+    mask = sitk.Cast(sitk.OtsuMultipleThresholds(coarse, numberOfThresholds=2) > 0, sitk.sitkUInt8)
+    radius = [MASK_OPENING_RADIUS] * mask.GetDimension()
+    opened = sitk.BinaryMorphologicalOpening(mask, radius)
+    if not _is_empty(opened):
+        mask = opened
+    mask = sitk.BinaryMorphologicalClosing(_largest_component(mask), radius)
+    mask = sitk.BinaryFillhole(mask)
+    if _is_empty(mask):
+        mask = sitk.Image(coarse.GetSize(), sitk.sitkUInt8) + 1
+        mask.CopyInformation(coarse)
+    return sitk.Cast(mask, sitk.sitkUInt8)
+
+
+def read_mask(mask_path):
+    """
+    Reads a mask supplied by the user: every non-zero voxel is foreground.
+
+    Returns:
+        sitk.Image: uint8 mask (1: foreground).
+    """
+    mask = sitk.ReadImage(mask_path)
+    return sitk.Cast(sitk.NotEqual(mask, 0), sitk.sitkUInt8)
+
+
+def crop_to_mask(image, mask, margin_mm=MASK_MARGIN_MM):
+    """
+    Crops an image to the bounding box of its mask, padded by margin_mm. The physical position of the voxels is kept.
+    The image is returned unchanged if the mask is empty.
+    """
+    region = bounding_box(mask, image, margin_mm)
+    if region is None:
+        return image
+    (x0, y0, z0), (x1, y1, z1) = region
+    if (x0, y0, z0) == (0, 0, 0) and (x1, y1, z1) == tuple(image.GetSize()):
+        return image
+    return image[int(x0):int(x1), int(y0):int(y1), int(z0):int(z1)]
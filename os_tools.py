@@ -10,9 +10,21 @@ functionalities.
 # Project imports:
 
 # System imports:
+import math
 import os
-from os.path import join, dirname
-from typing import List
+import resource
+import sys
+from os.path import join, dirname, isdir
+from typing import List, Tuple, Optional
+
+# Mount point of the cgroup file systems (v2 unified hierarchy, or one folder per v1 controller):
+CGROUP_ROOT = '/sys/fs/cgroup'
+
+# cgroup v1 reports an unlimited memory limit as a huge number (close to 2^63) rather than as 'max':
+CGROUP_UNLIMITED_BYTES = 2 ** 60
+
+# CPUs left to background processes outside the registration workers (e.g. QC renderers), see reserve_cpus:
+_reserved_cpus = 0
 
 # ---------------------------------------------- HELPER FUNCTIONS -----------------------------------------------------
 
@@ -22,9 +34,10 @@ def subdirs(root: str, complete_path: bool = False, prefix: str = None, suffix:
         func = os.path.join
     else:
         func = lambda x, y: y
-    res = [func(root, subdir) for subdir in os.listdir(root) if os.path.isdir(join(root, subdir))
-           and (prefix is None or subdir.startswith(prefix))
-           and (suffix is None or subdir.endswith(suffix))]
+    with os.scandir(root) as entries:
+        res = [func(root, entry.name) for entry in entries if entry.is_dir()
+               and (prefix is None or entry.name.startswith(prefix))
+               and (suffix is None or entry.name.endswith(suffix))]
     if sort:
         res.sort()
     return res
@@ -36,18 +49,50 @@ def subfiles(root: str, complete_path: bool = True, prefix: str = None, suffix:
         func = os.path.join
     else:
         func = lambda x, y: y
-    res = [func(root, subdir) for subdir in os.listdir(root) if os.path.isfile(join(root, subdir))
-           and (prefix is None or subdir.startswith(prefix))
-           and (suffix is None or subdir.endswith(suffix))]
+    with os.scandir(root) as entries:
+        res = [func(root, entry.name) for entry in entries if entry.is_file()
+               and (prefix is None or entry.name.startswith(prefix))
+               and (suffix is None or entry.name.endswith(suffix))]
+    if sort:
+        res.sort()
+    return res
+
+
+def subfiles_recursive(root: str, complete_path: bool = True, suffix: str = None, sort: bool = True) -> List[str]:
+    """
+    Files below root at any depth. Without complete_path, the paths are relative to root. Hidden folders are skipped.
+    os.scandir reports the entry types from the directory listing, so no file is stat'ed.
+    """
+    res = []
+    folders = ['']
+    while folders:
+        folder = folders.pop()
+        with os.scandir(join(root, folder)) as entries:
+            for entry in entries:
+                relative_path = join(folder, entry.name)
+                if entry.is_dir():
+                    if not entry.name.startswith('.'):
+                        folders.append(relative_path)
+                elif entry.is_file() and (suffix is None or entry.name.endswith(suffix)):
+                    res.append(join(root, relative_path) if complete_path else relative_path)
     if sort:
         res.sort()
     return res
 
 
-def sub_niftis(root: str, complete_path: bool = True, sort: bool = True) -> List[str]:
+def sub_niftis(root: str, complete_path: bool = True, sort: bool = True, recursive: bool = False) -> List[str]:
+    if recursive:
+        return subfiles_recursive(root, complete_path=complete_path, sort=sort, suffix='.nii.gz')
     return subfiles(root, complete_path=complete_path, sort=sort, suffix='.nii.gz')
 
 
+def image_stem(name: str) -> str:
+    """
+    Name of an input image without its .nii.gz extension (DICOM series folders have none).
+    """
+    name = name.rstrip(os.sep)
+    return name[:-len('.nii.gz')] if name.endswith('.nii.gz') else name
+
 
 def split_path(path: str) -> List[str]:
     """
@@ -56,6 +101,146 @@ def split_path(path: str) -> List[str]:
     return path.split(os.sep)
 
 
+def _read_cgroup_file(path: str) -> Optional[str]:
+    try:
+        with open(path) as file:
+            return file.read().strip()
+    except OSError:
+        return None
+
+
+def _cgroup_folders(controller: str = None) -> List[str]:
+    """
+    Folders of the cgroup of this process and of all its ancestors, for a cgroup v1 controller (e.g. 'cpu'), or for
+    the v2 unified hierarchy if controller is None. The limits of every ancestor apply to the process too. Inside a
+    container the cgroup of the process is usually mounted at the root, which is always included.
+    """
+    lines = (_read_cgroup_file('/proc/self/cgroup') or '').splitlines()
+    if controller is None:
+        roots = [CGROUP_ROOT, join(CGROUP_ROOT, 'unified')]
+        paths = [line.split(':', 2)[2] for line in lines if line.startswith('0::')]
+    else:
+        roots = [join(CGROUP_ROOT, controller)]
+        paths = [line.split(':', 2)[2] for line in lines
+                 if line.count(':') >= 2 and controller in line.split(':', 2)[1].split(',')]
+    folders = []
+    for root in roots:
+        for path in paths or ['/']:
+            parts = [part for part in path.split('/') if part]
+            for depth in range(len(parts), -1, -1):
+                folder = join(root, *parts[:depth])
+                if isdir(folder) and folder not in folders:
+                    folders.append(folder)
+    return folders
+
+
+def cgroup_cpu_limit() -> Optional[float]:
+    """
+    CPU quota of the cgroup of this process (cgroup v2 cpu.max or v1 cpu.cfs_quota_us / cpu.cfs_period_us), in
+    CPUs, e.g. 1.0 for a Kubernetes limit of 1000m. None if there is no quota.
+    """
+    limits = []
+    for folder in _cgroup_folders():
+        fields = (_read_cgroup_file(join(folder, 'cpu.max')) or 'max').split()
+        if fields[0] != 'max' and len(fields) == 2 and int(fields[1]) > 0:
+            limits.append(int(fields[0]) / int(fields[1]))
+    for folder in _cgroup_folders('cpu'):
+        quota = _read_cgroup_file(join(folder, 'cpu.cfs_quota_us'))
+        period = _read_cgroup_file(join(folder, 'cpu.cfs_period_us'))
+        if quota is not None and period is not None and int(quota) > 0 and int(period) > 0:
+            limits.append(int(quota) / int(period))
+    return min(limits) if limits else None
+
+
+def cgroup_memory_limit() -> Optional[int]:
+    """
+    Memory limit (bytes) of the cgroup of this process (cgroup v2 memory.max or v1 memory.limit_in_bytes), or None
+    if there is no limit.
+    """
+    limits = []
+    for folder in _cgroup_folders():
+        value = _read_cgroup_file(join(folder, 'memory.max'))
+        if value is not None and value != 'max':
+            limits.append(int(value))
+    for folder in _cgroup_folders('memory'):
+        value = _read_cgroup_file(join(folder, 'memory.limit_in_bytes'))
+        if value is not None and int(value) < CGROUP_UNLIMITED_BYTES:
+            limits.append(int(value))
+    return min(limits) if limits else None
+
+
+def physical_memory() -> Optional[int]:
+    """
+    Physical memory (bytes) of the machine, or None if the platform does not report it.
+    """
+    try:
+        return os.sysconf('SC_PAGE_SIZE') * os.sysconf('SC_PHYS_PAGES')
+    except (ValueError, OSError, AttributeError):
+        return None
+
+
+def available_memory() -> Optional[int]:
+    """
+    Memory (bytes) this process may use: the cgroup memory limit, or the physical memory if it is lower.
+    """
+    limits = [limit for limit in (cgroup_memory_limit(), physical_memory()) if limit is not None]
+    return min(limits) if limits else None
+
+
+def available_cpus() -> int:
+    """
+    Number of CPUs this process is allowed to run on: respects taskset / cpuset affinity when the platform exposes
+    it, and the cgroup CPU quota of a container (rounded down, so that a full quota is never exceeded and throttled).
+    """
+    try:
+        n_cpus = len(os.sched_getaffinity(0))
+    except AttributeError:
+        n_cpus = os.cpu_count() or 1
+    quota = cgroup_cpu_limit()
+    if quota is not None:
+        n_cpus = min(n_cpus, max(1, math.floor(quota)))
+    return n_cpus
+
+
+def reserve_cpus(n_cpus: int) -> None:
+    """
+    Leaves n_cpus of the available CPUs to background processes of this process (e.g. QC renderers): the default
+    budget of split_cpu_budget no longer counts them (it keeps at least one CPU).
+    """
+    global _reserved_cpus
+    _reserved_cpus = max(0, n_cpus)
+
+
+def split_cpu_budget(n_jobs: int, n_cpus: int = None) -> Tuple[int, int]:
+    """
+    Splits a CPU budget between worker processes and the threads each worker may use internally, so that
+    workers x threads never exceeds the budget.
+
+    Parameters
+        n_jobs : int: requested number of worker processes; 0 or negative means one worker per CPU.
+        n_cpus : int: CPU budget; defaults to available_cpus() minus the reserved CPUs (see reserve_cpus).
+
+    Returns:
+        (n_workers, threads_per_worker)
+    """
+    if n_cpus is None:
+        n_cpus = available_cpus() - _reserved_cpus
+    n_cpus = max(1, n_cpus)
+    n_workers = n_cpus if n_jobs <= 0 else min(n_jobs, n_cpus)
+    threads_per_worker = max(1, n_cpus // n_workers)
+    return n_workers, threads_per_worker
+
+
+def peak_rss_mib(children: bool = False) -> float:
+    """
+    Peak resident set size (MiB) of this process, or of its largest terminated child process (e.g. a pool worker)
+    if children is True.
+    """
+    peak = resource.getrusage(resource.RUSAGE_CHILDREN if children else resource.RUSAGE_SELF).ru_maxrss
+    # ru_maxrss is in bytes on macOS and in kilobytes elsewhere
+    return peak / 2 ** 20 if sys.platform == 'darwin' else peak / 2 ** 10
+
+
 # -------------------------------------------------- CODE TESTING -----------------------------------------------------
 
 if __name__ == '__main__':
@@ -0,0 +1,306 @@
+"""
+Developed by Arman Avesta, MD, PhD
+FNNDSC | Boston Children's Hospital | Harvard Medical School
+
+This module contains the many-to-many registration mode: every image of a set of fixed images (e.g. templates) is
+registered with every image of a set of moving images, or every image of one set with every other (e.g. all the
+timepoints of a longitudinal study). Only the transforms and the final metric values are kept, in one transform
+store (pairwise_transforms.npz, see store_tools) and one metric matrix (pairwise_metrics.csv); no registered image is
+written.
+
+Registering pair by pair would decode, mask and build the pyramid of every image once per pair. Here the prepared
+images (the fixed image context of a fixed image, the smoothed pyramid of a moving image) are kept in a bounded
+in-memory cache in each worker (PreparedImageCache), and the matrix of pairs is split into tiles of fixed x moving
+images whose moving images fit in the cache together (pair_tiles). A worker registers a tile fixed image by fixed
+image, so that every prepared moving image of the tile is reused by every fixed image of the tile: each image is
+prepared once per tile instead of once per pair.
+"""
+
+# ----------------------------------------------- ENVIRONMENT SETUP ---------------------------------------------------
+# Project imports:
+from registration_tools import FixedImageContext, ConvergenceWatchdog, RegistrationParameters, RegistrationRecord, \
+    read_image, moving_working_image, moving_pyramid, initialize_transform, optimize_transform
+from profiling_tools import ConvergenceRecorder
+from store_tools import save_transform_store
+from os_tools import split_cpu_budget
+from io_tools import atomic_output
+
+# System imports:
+import SimpleITK as sitk
+import csv
+import math
+import time
+import traceback
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+# Outputs of the many-to-many mode, written to the output folder: the transform store of the pairs (see store_tools)
+# and the metric matrix:
+PAIR_TRANSFORMS_FILE = 'pairwise_transforms.npz'
+PAIR_METRICS_FILE = 'pairwise_metrics.csv'
+
+# Default memory of the prepared image cache of each worker:
+PAIR_CACHE_BYTES = 2 * 2 ** 30
+
+# Prepared image cache of the current worker process (set by _init_pairs_worker):
+_worker_cache = None
+
+# ---------------------------------------------- HELPER FUNCTIONS -----------------------------------------------------
+
+def _image_bytes(images):
+    unique = {id(image): image for image in images if image is not None}
+    return sum(image.GetNumberOfPixels() * image.GetSizeOfPixelComponent() * image.GetNumberOfComponentsPerPixel()
+               for image in unique.values())
+
+
+class PreparedImage:
+    """
+    An image prepared for the roles it plays in a tile: its fixed image context (decoded, masked and pyramid built)
+    and / or its moving working image and smoothed pyramid levels. The image is decoded once for all its roles.
+
+    Parameters
+        image_path : str: Path to the image (NIfTI file or DICOM series folder).
+        parameters : RegistrationParameters: Registration settings.
+        as_fixed : bool: Build the fixed image context.
+        as_moving : bool: Build the moving working image and pyramid.
+    """
+    def __init__(self, image_path, parameters, as_fixed=False, as_moving=False):
+        image = read_image(image_path, parameters)
+        self.fixed_context = FixedImageContext(image, parameters) if as_fixed else None
+        self.moving_image = moving_working_image(image, parameters) if as_moving else None
+        self.moving_levels = moving_pyramid(self.moving_image, parameters) if as_moving else None
+        del image
+
+    def has_roles(self, as_fixed, as_moving):
+        return (self.fixed_context is not None or not as_fixed) and (self.moving_image is not None or not as_moving)
+
+    @property
+    def nbytes(self):
+        images = [self.moving_image] + list(self.moving_levels or [])
+        if self.fixed_context is not None:
+            images += [self.fixed_context.image, self.fixed_context.mask] + list(self.fixed_context.levels)
+        return _image_bytes(images)
+
+
+class PreparedImageCache:
+    """
+    Least recently used cache of prepared images, bounded by the memory of the images it holds. The image just
+    requested is never evicted, even if it alone exceeds the bound.
+
+    Parameters
+        parameters : RegistrationParameters: Registration settings the images are prepared with.
+        max_bytes : int: Memory bound of the cache.
+    """
+    def __init__(self, parameters, max_bytes=PAIR_CACHE_BYTES):
+        self.parameters = parameters
+        self.max_bytes = max_bytes
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.preparations = 0
+
+    def get(self, image_path, as_fixed=False, as_moving=False):
+        """
+        The prepared image of image_path with (at least) the given roles, prepared now if it is not cached.
+        """
+        entry = self.entries.get(image_path)
+        if entry is not None and entry.has_roles(as_fixed, as_moving):
+            self.entries.move_to_end(image_path)
+            self.hits += 1
+            return entry
+        if entry is not None:
+            # Prepare the missing role together with the roles the entry already has
+            as_fixed = as_fixed or entry.fixed_context is not None
+            as_moving = as_moving or entry.moving_image is not None
+            del self.entries[image_path]
+        entry = PreparedImage(image_path, self.parameters, as_fixed, as_moving)
+        self.preparations += 1
+        self.entries[image_path] = entry
+        total = sum(cached.nbytes for cached in self.entries.values())
+        while total > self.max_bytes and len(self.entries) > 1:
+            _, evicted = self.entries.popitem(last=False)
+            total -= evicted.nbytes
+        return entry
+
+
+def register_pair(fixed, moving, parameters):
+    """
+    Registers a prepared moving image (see PreparedImage) onto a prepared fixed image: initialization and
+    optimization, without resampling.
+
+    Returns:
+        registration_tools.RegistrationRecord of the fixed to moving transform.
+    """
+    started = time.perf_counter()
+    recorder = ConvergenceRecorder()
+    watchdog = ConvergenceWatchdog(parameters)
+    fixed_context = fixed.fixed_context
+    transform = initialize_transform(fixed_context.image, moving.moving_image, parameters.initialization,
+                                     fixed_context.coarse_image)
+    optimize_transform(fixed_context, moving.moving_image, transform, hook=recorder, watchdog=watchdog,
+                       moving_levels=moving.moving_levels)
+    return RegistrationRecord.from_transform(transform, metric=recorder.metric, iterations=recorder.iterations,
+                                             seconds=time.perf_counter() - started, flags=tuple(watchdog.flags))
+
+
+def _init_pairs_worker(n_threads, parameters, cache_bytes):
+    global _worker_cache
+    sitk.ProcessObject.SetGlobalDefaultNumberOfThreads(n_threads)
+    _worker_cache = PreparedImageCache(parameters, cache_bytes)
+
+
+def _register_tile(tile, cache=None):
+    """
+    Registers the pairs of a tile, fixed image by fixed image, with the prepared images of the cache of the worker.
+    Images that are both fixed and moving images of the tile are prepared for both roles at once.
+
+    Returns:
+        (records, failures, preparations): dicts mapping each (fixed image path, moving image path) pair to its
+        RegistrationRecord, or to the formatted traceback of its failure, and the number of images prepared for the
+        tile.
+    """
+    cache = cache or _worker_cache
+    fixed_paths, moving_paths = tile
+    both = set(fixed_paths) & set(moving_paths)
+    records, failures, preparations = {}, {}, cache.preparations
+    for fixed_path in fixed_paths:
+        try:
+            fixed = cache.get(fixed_path, as_fixed=True, as_moving=fixed_path in both)
+        except Exception:
+            error = traceback.format_exc()
+            failures.update({(fixed_path, moving_path): error
+                             for moving_path in moving_paths if moving_path != fixed_path})
+            continue
+        for moving_path in moving_paths:
+            if moving_path == fixed_path:
+                continue
+            try:
+                moving = cache.get(moving_path, as_fixed=moving_path in both, as_moving=True)
+                records[fixed_path, moving_path] = register_pair(fixed, moving, cache.parameters)
+            except Exception:
+                failures[fixed_path, moving_path] = traceback.format_exc()
+    return records, failures, cache.preparations - preparations
+
+
+def _blocks(paths, n_blocks):
+    size = math.ceil(len(paths) / max(1, n_blocks))
+    return [paths[first:first + size] for first in range(0, len(paths), size)]
+
+
+# ----------------------------------------------- MAIN FUNCTIONS ------------------------------------------------------
+
+def pair_tiles(fixed_paths, moving_paths, n_workers=1, cache_images=None):
+    """
+    Splits the matrix of pairs into tiles (fixed images x moving images) for the workers. The moving images of a
+    tile, plus one fixed image, fit in the cache of a worker, so a tile prepares each of its images once. Tiles are
+    as few as the cache and the number of workers allow: every tile prepares its images again.
+
+    Parameters
+        cache_images : int: Number of prepared images the cache of a worker holds (None: unbounded).
+
+    Returns:
+        list of (fixed_paths, moving_paths) tiles (empty if there are no fixed or no moving images).
+    """
+    if not fixed_paths or not moving_paths:
+        return []
+    columns = len(moving_paths) if cache_images is None else max(1, min(len(moving_paths), cache_images - 1))
+    moving_blocks = _blocks(list(moving_paths), math.ceil(len(moving_paths) / columns))
+    n_rows = max(1, min(len(fixed_paths), math.ceil(n_workers / max(1, len(moving_blocks)))))
+    fixed_blocks = _blocks(list(fixed_paths), n_rows)
+    return [(fixed_block, moving_block) for fixed_block in fixed_blocks for moving_block in moving_blocks]
+
+
+def prepared_bytes(header, parameters):
+    """
+    Estimated memory of an image prepared both as fixed and as moving image, from its manifest_tools.ImageHeader:
+    the float32 working image and its smoothed levels, and the fixed image pyramid.
+    """
+    voxels = header.n_voxels / parameters.working_shrink ** 3
+    fixed_levels = sum(1 / max(1, shrink_factor) ** 3 for shrink_factor in parameters.shrink_factors)
+    return int(voxels * 4 * (2 + len(parameters.shrink_factors) + fixed_levels))
+
+
+def register_pairs(fixed_paths, moving_paths, parameters=None, n_jobs=1, cache_bytes=PAIR_CACHE_BYTES,
+                   image_bytes=None, on_result=None):
+    """
+    Registers every moving image with every fixed image (pairs of an image with itself are skipped), tile by tile
+    (see pair_tiles), in-process or in a pool of worker processes that each keep a cache of prepared images.
+
+    Parameters
+        fixed_paths : list of str: Paths to the fixed images.
+        moving_paths : list of str: Paths to the moving images (the same list for all pairs of one set of images).
+        parameters : RegistrationParameters: Registration settings (default: the 'balanced' preset).
+        n_jobs : int: Number of worker processes (as in registration_tools.register_batch).
+        cache_bytes : int: Memory bound of the prepared image cache of each worker.
+        image_bytes : int: Estimated memory of the largest prepared image (see prepared_bytes), which sizes the
+            tiles; None makes one tile column.
+        on_result : callable: Called in the calling process as on_result(pair, record) for every registered pair,
+            where pair is (fixed image path, moving image path).
+
+    Returns:
+        (records, failures, preparations): dicts mapping each (fixed image path, moving image path) pair to its
+        registration_tools.RegistrationRecord, or to the formatted traceback of its failure, and the number of image
+        preparations of the batch.
+    """
+    parameters = parameters or RegistrationParameters()
+    n_pairs = sum(fixed_path != moving_path for fixed_path in fixed_paths for moving_path in moving_paths)
+    n_workers, n_threads = split_cpu_budget(n_jobs)
+    cache_images = None if not image_bytes else max(2, cache_bytes // image_bytes)
+    tiles = pair_tiles(fixed_paths, moving_paths, n_workers, cache_images)
+    n_workers = min(n_workers, len(tiles))
+    print(f'Registering {n_pairs} pairs of {len(set(fixed_paths) | set(moving_paths))} images in {len(tiles)} tiles '
+          f'with {n_workers} workers x {n_threads} threads.', flush=True)
+
+    records, failures, preparations = {}, {}, 0
+
+    def report(tile_records, tile_failures, tile_preparations, done):
+        nonlocal preparations
+        preparations += tile_preparations
+        print(f'[tile {done}/{len(tiles)}] {len(tile_records)} pairs done'
+              + (f', {len(tile_failures)} FAILED' if tile_failures else '')
+              + f' ({tile_preparations} images prepared)', flush=True)
+        failures.update(tile_failures)
+        for pair, record in tile_records.items():
+            records[pair] = record
+            if on_result is not None:
+                on_result(pair, record)
+
+    if n_workers <= 1:
+        cache = PreparedImageCache(parameters, cache_bytes)
+        for done, tile in enumerate(tiles, start=1):
+            report(*_register_tile(tile, cache), done)
+        return records, failures, preparations
+
+    with ProcessPoolExecutor(max_workers=n_workers, initializer=_init_pairs_worker,
+                             initargs=(n_threads, parameters, cache_bytes)) as pool:
+        futures = [pool.submit(_register_tile, tile) for tile in tiles]
+        for done, future in enumerate(as_completed(futures), start=1):
+            report(*future.result(), done)
+    return records, failures, preparations
+
+
+def save_pair_results(records, failures, store_path, metrics_path, names):
+    """
+    Saves the transform store of the registered pairs (see store_tools, indexed by fixed and moving image name) and
+    the metric matrix (one row per fixed image and one column per moving image; empty for failed and skipped pairs),
+    atomically.
+
+    Parameters
+        records : dict mapping each registered (fixed image path, moving image path) pair to its RegistrationRecord.
+        failures : dict of the pairs that failed.
+        names : dict mapping each image path to the name it is saved under.
+    """
+    save_transform_store(store_path, {(names[fixed], names[moving]): record
+                                      for (fixed, moving), record in records.items()})
+
+    pairs = list(records) + list(failures)
+    fixed_names = sorted({names[fixed] for fixed, _ in pairs})
+    moving_names = sorted({names[moving] for _, moving in pairs})
+    metrics = {(names[fixed], names[moving]): record.metric for (fixed, moving), record in records.items()}
+    with atomic_output(metrics_path) as temporary_path:
+        with open(temporary_path, 'w', newline='') as file:
+            writer = csv.writer(file)
+            writer.writerow(['fixed \\ moving'] + moving_names)
+            for fixed_name in fixed_names:
+                writer.writerow([fixed_name] + [repr(metrics[fixed_name, moving_name])
+                                                if (fixed_name, moving_name) in metrics else ''
+                                                for moving_name in moving_names])
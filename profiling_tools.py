@@ -0,0 +1,165 @@
+"""
+Developed by Arman Avesta, MD, PhD
+FNNDSC | Boston Children's Hospital | Harvard Medical School
+
+This module contains the instrumentation hooks of the registration pipeline.
+
+rigid_registration reports its stages (read, mask, init, optimize, resample, write), the start and end of each
+pyramid level, and every optimizer iteration to a hook. RegistrationHook does nothing and is the default;
+TimingProfiler records wall and CPU time per stage and the metric trace per level, and saves them as JSON;
+ConvergenceRecorder keeps the final metric value and iteration count of a registration. Callers can supply their
+own hook by subclassing RegistrationHook.
+"""
+
+# ----------------------------------------------- ENVIRONMENT SETUP ---------------------------------------------------
+# Project imports:
+from os_tools import peak_rss_mib
+
+# System imports:
+import json
+import time
+from contextlib import contextmanager
+
+# ---------------------------------------------- HELPER FUNCTIONS -----------------------------------------------------
+
+def profile_path_for(transform_matrix_path):
+    """
+    Path of the timing profile saved next to the outputs of one registration:
+    <moving image name>_transform.mat --> <moving image name>_profile.json
+    """
+    suffix = '_transform.mat'
+    if transform_matrix_path.endswith(suffix):
+        return transform_matrix_path[:-len(suffix)] + '_profile.json'
+    return transform_matrix_path + '.profile.json'
+
+
+# ----------------------------------------------- MAIN FUNCTIONS ------------------------------------------------------
+
+class RegistrationHook:
+    """
+    Receives instrumentation events from the registration pipeline. All methods are no-ops; override the ones
+    you need.
+    """
+    @contextmanager
+    def stage(self, name):
+        """
+        Context manager wrapped around each stage of the pipeline.
+        """
+        yield
+
+    def level_started(self, level, shrink_factor, smoothing_sigma):
+        """
+        Called (from SimpleITK's multi-resolution event) when the optimizer starts a pyramid level.
+        """
+
+    def iteration(self, level, iteration, metric_value):
+        """
+        Called (from SimpleITK's iteration event) after every optimizer iteration.
+        """
+
+    def level_finished(self, level, iterations, metric_value, stop_condition):
+        """
+        Called when the optimizer finishes a pyramid level.
+        """
+
+    def finish(self):
+        """
+        Called once the registration and all its outputs are written.
+        """
+
+
+class TimingProfiler(RegistrationHook):
+    """
+    Records wall and CPU time of each stage and, for each pyramid level, the metric value of every iteration,
+    the number of iterations and the elapsed time. The profile also reports the peak resident memory of the process
+    at the time it is saved.
+
+    CPU time is process-wide, so it includes the work of all SimpleITK threads; CPU / wall therefore shows how well
+    a stage is parallelized.
+
+    Parameters
+        output_path : str: If given, finish() saves the profile to this JSON file.
+        record_iterations : bool: Keep the per-iteration metric trace (not only per-level summaries).
+    """
+    def __init__(self, output_path=None, record_iterations=True):
+        self.output_path = output_path
+        self.record_iterations = record_iterations
+        self.stages = {}
+        self.levels = []
+        self._level_start = None
+
+    @contextmanager
+    def stage(self, name):
+        wall, cpu = time.perf_counter(), time.process_time()
+        try:
+            yield
+        finally:
+            entry = self.stages.setdefault(name, dict(wall_seconds=0.0, cpu_seconds=0.0))
+            entry['wall_seconds'] += time.perf_counter() - wall
+            entry['cpu_seconds'] += time.process_time() - cpu
+
+    def level_started(self, level, shrink_factor, smoothing_sigma):
+        self._level_start = time.perf_counter()
+        self.levels.append(dict(level=level, shrink_factor=shrink_factor, smoothing_sigma=smoothing_sigma,
+                                iterations=0, metric_value=None, elapsed_seconds=None, metric_trace=[]))
+
+    def iteration(self, level, iteration, metric_value):
+        if self.record_iterations and self.levels:
+            self.levels[-1]['metric_trace'].append(
+                dict(iteration=iteration, metric_value=metric_value,
+                     elapsed_seconds=time.perf_counter() - self._level_start))
+
+    def level_finished(self, level, iterations, metric_value, stop_condition):
+        if not self.levels:
+            self.level_started(level, None, None)
+        self.levels[-1].update(iterations=iterations, metric_value=metric_value, stop_condition=stop_condition,
+                               elapsed_seconds=time.perf_counter() - self._level_start)
+
+    def to_dict(self):
+        total = dict(wall_seconds=sum(s['wall_seconds'] for s in self.stages.values()),
+                     cpu_seconds=sum(s['cpu_seconds'] for s in self.stages.values()))
+        return dict(stages=self.stages, total=total, levels=self.levels, peak_rss_mib=peak_rss_mib())
+
+    def finish(self):
+        if self.output_path is not None:
+            with open(self.output_path, 'w') as file:
+                json.dump(self.to_dict(), file, indent=2)
+
+
+class ConvergenceRecorder(RegistrationHook):
+    """
+    Keeps the metric value of the last pyramid level and counts the optimizer iterations over all levels, and passes
+    every event on to another hook (e.g. a TimingProfiler).
+
+    Attributes
+        metric : float: Metric value of the last pyramid level (nan until a level finished).
+        iterations : int: Optimizer iterations of the finished levels.
+    """
+    def __init__(self, hook=None):
+        self.hook = hook or RegistrationHook()
+        self.metric = float('nan')
+        self.iterations = 0
+
+    def stage(self, name):
+        return self.hook.stage(name)
+
+    def level_started(self, level, shrink_factor, smoothing_sigma):
+        self.hook.level_started(level, shrink_factor, smoothing_sigma)
+
+    def iteration(self, level, iteration, metric_value):
+        self.hook.iteration(level, iteration, metric_value)
+
+    def level_finished(self, level, iterations, metric_value, stop_condition):
+        self.metric = float(metric_value)
+        self.iterations += int(iterations)
+        self.hook.level_finished(level, iterations, metric_value, stop_condition)
+
+    def finish(self):
+        self.hook.finish()
+
+
+def profile_next_to_outputs(moving_image_path, transform_matrix_path):
+    """
+    Hook factory for register_batch: profiles every registration and saves the profile next to its transform.
+    """
+    return TimingProfiler(output_path=profile_path_for(transform_matrix_path))
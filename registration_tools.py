@@ -7,101 +7,1424 @@ This module contains image registration functions.
 
 # ----------------------------------------------- ENVIRONMENT SETUP ---------------------------------------------------
 # Project imports:
-from visualization_tools import imgshow
+from os_tools import split_cpu_budget
+from profiling_tools import RegistrationHook, ConvergenceRecorder
+from initialization_tools import coarse_initialization, coarse_image
+from mask_tools import foreground_mask, read_mask, crop_to_mask, FOREGROUND_MASKS
+from io_tools import OutputFormat, write_image, read_pixel_id, cast_to_pixel_id, atomic_output
+from dicom_tools import read_dicom_series
+from timeseries_tools import MOTION_SUFFIX, timepoint_count, is_timeseries, timepoint_runs, read_timepoint, \
+    timepoint_grid, timepoint_spacing, timeseries_image, create_shared_array, attach_shared_array, euler_transform, \
+    save_motion, read_motion
 
 # System imports:
 import SimpleITK as sitk
-import nibabel as nib
+import numpy as np
 import os
-from datetime import datetime
+import queue
+import signal
+import threading
+import time
+import traceback
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, FIRST_COMPLETED, as_completed, wait
+from dataclasses import dataclass, asdict, replace
+from multiprocessing import shared_memory
+
+# Seed of the random metric sampler. Fixing it means every registration against the same fixed image context
+# samples the same points of the fixed image pyramid.
+DEFAULT_SAMPLING_SEED = 2024
+
+# Interpolators that can be used to resample the registered image:
+INTERPOLATORS = {
+    'nearest': sitk.sitkNearestNeighbor,
+    'linear': sitk.sitkLinear,
+    'bspline': sitk.sitkBSpline,
+}
+
+# Initializations of the transform: 'geometry' aligns the image centers; 'moments' and 'search' then run the coarse
+# principal axes or rotation grid search of initialization_tools:
+INITIALIZATIONS = ('geometry', 'moments', 'search')
+
+# Optimizers of the registration (see _set_optimizer): gradient descent with a learning rate estimated once from the
+# optimizer scales (the historical optimizer), regular step gradient descent, the quasi-Newton L-BFGS, and the
+# derivative-free Powell and Amoeba (Nelder-Mead simplex). ITK's bounded LBFGS-B ignores the optimizer scales, and
+# mixing radians with millimetres makes it diverge, so 'lbfgs' uses the unbounded L-BFGS, which honours them:
+OPTIMIZERS = ('gradient_descent', 'regular_step', 'lbfgs', 'powell', 'amoeba')
+
+# Rotation (degrees) of the additional starting transforms of multi_start, about each axis in turn, and the largest
+# number of starts (the initial transform and one rotation each way about each axis):
+MULTI_START_ANGLE_DEG = 10.0
+MAX_MULTI_START = 7
+
+# Regular step gradient descent: the step is multiplied by the relaxation factor whenever the gradient changes
+# direction, and the level stops once it is below this fraction of the learning rate:
+REGULAR_STEP_RELAXATION = 0.5
+REGULAR_STEP_MIN_STEP = 1e-3
+
+# L-BFGS stops once the gradient is below this fraction of the larger of 1 and the norm of the parameters:
+LBFGS_SOLUTION_ACCURACY = 1e-5
+
+# Powell: metric evaluations of each line search, and the step (fraction of the learning rate) it stops at:
+POWELL_LINE_ITERATIONS = 20
+POWELL_STEP_TOLERANCE = 1e-3
+
+# Targets the timepoints of a 4D moving image are registered to: the fixed image, or the first or middle timepoint of
+# the series itself (motion correction, in which case the registered series keeps the grid of the moving image):
+TIMESERIES_REFERENCES = ('fixed', 'first', 'middle')
+
+# Fixed image context of the current worker process (set by _init_worker when a pool shares one):
+_worker_fixed_context = None
 
 # ---------------------------------------------- HELPER FUNCTIONS -----------------------------------------------------
 
+@dataclass(frozen=True)
+class RegistrationParameters:
+    """
+    Every setting of the rigid registration. The parameters are part of the result cache key and are recorded next
+    to the outputs, so any change here invalidates previously cached registrations.
+
+    Attributes
+        shrink_factors : tuple of int: Shrink factor of each pyramid level (coarse to fine).
+        smoothing_sigmas : tuple of float: Gaussian smoothing sigma (mm) of each pyramid level.
+        histogram_bins : int: Number of histogram bins of the Mattes mutual information metric.
+        sampling_percentage : float: Fraction of the fixed image voxels randomly sampled by the metric.
+        sampling_seed : int: Seed of the random metric sampler.
+        learning_rate : float: Learning rate of gradient descent; initial step length of regular step gradient
+            descent and Powell, and initial simplex size of Amoeba (in units of the optimizer scales).
+        iterations : int: Maximum number of optimizer iterations per pyramid level.
+        convergence_minimum_value : float: Convergence threshold of the metric.
+        convergence_window_size : int: Number of iterations the convergence threshold is checked over.
+        final_interpolator : str: Interpolator of the registered image ('nearest', 'linear' or 'bspline').
+        working_shrink : int: The registration runs on copies of both images block-averaged by this factor, which
+            are decoded in their own data type and only converted to float32 once reduced (1: full resolution).
+            shrink_factors stay relative to the full resolution image.
+        resample_slab_size : int: Number of fixed image slices resampled at a time into the registered image, each
+            from the cropped region of the moving image it maps to (0: whole volume at once).
+        initialization : str: Initialization of the transform (one of INITIALIZATIONS).
+        foreground_mask : str: Foreground masks (one of mask_tools.FOREGROUND_MASKS): both images are cropped to the
+            bounding box of their mask before the pyramid is built, and the metric only samples the fixed mask.
+        time_budget_seconds : float: Wall time allowed to register one image, from the start of its registration
+            to the end of the optimization (0: no limit). When it runs out, the optimizer stops, keeps the best
+            transform of the current pyramid level and skips the remaining levels; the image is flagged. The budget
+            is checked at every iteration, so it can be overrun by the set-up of one level and one iteration.
+        early_stop_iterations : int: Stops a pyramid level once the metric has not improved by more than
+            early_stop_tolerance for this many iterations, keeping the best transform of the level (0: disabled).
+        early_stop_tolerance : float: Relative metric improvement that counts for early_stop_iterations.
+        optimizer : str: Optimizer of every pyramid level (one of OPTIMIZERS).
+        multi_start : int: Number of starting transforms (1 to MAX_MULTI_START): the coarsest pyramid level is
+            optimized from the initial transform and from rotations of it by MULTI_START_ANGLE_DEG, concurrently in
+            threads, and the finer levels continue from the start with the best metric value.
+        timeseries_reference : str: Target of the timepoints of 4D moving images (one of TIMESERIES_REFERENCES).
+    """
+    shrink_factors: tuple = (4, 2, 1)
+    smoothing_sigmas: tuple = (2, 1, 0)
+    histogram_bins: int = 50
+    sampling_percentage: float = 0.01
+    sampling_seed: int = DEFAULT_SAMPLING_SEED
+    learning_rate: float = 1.0
+    iterations: int = 100
+    convergence_minimum_value: float = 1e-6
+    convergence_window_size: int = 10
+    final_interpolator: str = 'bspline'
+    working_shrink: int = 1
+    resample_slab_size: int = 0
+    initialization: str = 'geometry'
+    foreground_mask: str = 'none'
+    time_budget_seconds: float = 0.0
+    early_stop_iterations: int = 0
+    early_stop_tolerance: float = 1e-4
+    optimizer: str = 'gradient_descent'
+    multi_start: int = 1
+    timeseries_reference: str = 'fixed'
+
+    def __post_init__(self):
+        # Normalize the types so that equal settings always produce the same cache key.
+        object.__setattr__(self, 'shrink_factors', tuple(int(factor) for factor in self.shrink_factors))
+        object.__setattr__(self, 'smoothing_sigmas', tuple(float(sigma) for sigma in self.smoothing_sigmas))
+        assert len(self.shrink_factors) == len(self.smoothing_sigmas), \
+            'one smoothing sigma is needed per shrink factor.'
+        assert self.final_interpolator in INTERPOLATORS, f'unknown interpolator: {self.final_interpolator}'
+        assert self.working_shrink >= 1, 'working_shrink must be at least 1.'
+        assert self.resample_slab_size >= 0, 'resample_slab_size must be 0 (whole volume) or positive.'
+        assert self.initialization in INITIALIZATIONS, f'unknown initialization: {self.initialization}'
+        assert self.foreground_mask in FOREGROUND_MASKS, f'unknown foreground mask: {self.foreground_mask}'
+        assert self.time_budget_seconds >= 0, 'time_budget_seconds must be 0 (no limit) or positive.'
+        assert self.early_stop_iterations >= 0, 'early_stop_iterations must be 0 (disabled) or positive.'
+        assert self.optimizer in OPTIMIZERS, f'unknown optimizer: {self.optimizer}'
+        assert 1 <= self.multi_start <= MAX_MULTI_START, f'multi_start must be between 1 and {MAX_MULTI_START}.'
+        assert self.timeseries_reference in TIMESERIES_REFERENCES, \
+            f'unknown timeseries reference: {self.timeseries_reference}'
+
+    @property
+    def low_memory(self):
+        """
+        Whether the images are decoded in their own data type rather than as float32 (see working_shrink and
+        resample_slab_size).
+        """
+        return self.working_shrink > 1 or self.resample_slab_size > 0
+
+    def with_overrides(self, **overrides):
+        """
+        Copy of the parameters where every override that is not None replaces the corresponding setting.
+        """
+        return replace(self, **{name: value for name, value in overrides.items() if value is not None})
+
+    def to_dict(self):
+        return asdict(self)
 
-# ----------------------------------------------- MAIN FUNCTIONS ------------------------------------------------------
 
-def rigid_registration(fixed_image_path, moving_image_path, registered_image_path, transform_matrix_path):
+# Speed / accuracy presets. 'balanced' is the historical behavior of the plugin. Note that gradient descent estimates
+# its step size from the optimizer scales, so the learning rate has little influence on the result.
+PRESETS = {
+    'fast': RegistrationParameters(shrink_factors=(4, 2), smoothing_sigmas=(2, 1), histogram_bins=32,
+                                   sampling_percentage=0.005, iterations=50, final_interpolator='linear'),
+    'balanced': RegistrationParameters(),
+    'accurate': RegistrationParameters(sampling_percentage=0.05, iterations=300, convergence_minimum_value=1e-7,
+                                       convergence_window_size=15),
+}
+
+# Memory-lean settings applied on top of the preset by --low_memory:
+LOW_MEMORY_OVERRIDES = dict(working_shrink=2, resample_slab_size=32)
+
+# Margin (voxels) kept around the moving image region a slab maps to, so that the B-spline coefficients computed on
+# the cropped region match those of the whole image:
+SLAB_MARGIN = 8
+
+
+def read_image(image_path, parameters):
     """
-    Function to perform rigid registration between two images.
+    Decodes an input image (NIfTI file or DICOM series folder): as float32, or in its own data type when
+    parameters.low_memory is set (the float32 copy is then made by working_image, at reduced resolution).
+    """
+    if os.path.isdir(image_path):
+        return read_dicom_series(image_path, None if parameters.low_memory else sitk.sitkFloat32)
+    if parameters.low_memory:
+        return sitk.ReadImage(image_path)
+    return sitk.ReadImage(image_path, sitk.sitkFloat32)
+
+
+def read_image_timepoint(image_path, timepoint, parameters):
+    """
+    Decodes one timepoint of a 4D moving image, in the data type read_image would use.
+    """
+    return read_timepoint(image_path, timepoint, None if parameters.low_memory else sitk.sitkFloat32)
+
+
+def working_image(image, working_shrink):
+    """
+    Float32 copy of an image that the registration runs on: block-averaged by working_shrink before the conversion,
+    so that no full resolution float32 copy is made.
+    """
+    if working_shrink > 1:
+        image = sitk.BinShrink(image, [working_shrink] * image.GetDimension())
+    if image.GetPixelID() != sitk.sitkFloat32:
+        image = sitk.Cast(image, sitk.sitkFloat32)
+    return image
+
+
+def moving_working_image(moving_image, parameters):
+    """
+    Working copy of a moving image (see working_image), cropped to the bounding box of its foreground mask when
+    parameters.foreground_mask is 'otsu'.
+
+    The mask only crops the moving image; it is not given to the metric (SetMetricMovingMask). Samples of the fixed
+    mask that map outside a moving mask are dropped, so a moving mask starves the metric of samples while the images
+    are still misaligned, and fails the registration when nothing is left.
+    """
+    image = working_image(moving_image, parameters.working_shrink)
+    if parameters.foreground_mask == 'none':
+        return image
+    return crop_to_mask(image, foreground_mask(image))
+
+
+def image_grid(image):
+    """
+    Sampling grid of an image (size, origin, spacing, direction) as a picklable dict.
+    """
+    return dict(size=image.GetSize(), origin=image.GetOrigin(), spacing=image.GetSpacing(),
+                direction=image.GetDirection())
+
+
+def _slab_source(moving_image, grid, transform, first_slice, n_slices):
+    """
+    Region of the moving image that the fixed grid slices [first_slice, first_slice + n_slices) map to under
+    transform, padded by SLAB_MARGIN voxels. Returns None if the slab maps entirely outside the moving image.
+    """
+    reference = sitk.Image([1, 1, 1], sitk.sitkUInt8)
+    reference.SetOrigin(grid['origin'])
+    reference.SetSpacing(grid['spacing'])
+    reference.SetDirection(grid['direction'])
+    size_x, size_y = grid['size'][0], grid['size'][1]
+    corners = [moving_image.TransformPhysicalPointToContinuousIndex(
+                   transform.TransformPoint(reference.TransformContinuousIndexToPhysicalPoint((x, y, z))))
+               for x in (-0.5, size_x - 0.5) for y in (-0.5, size_y - 0.5)
+               for z in (first_slice - 0.5, first_slice + n_slices - 0.5)]
+    lower = np.floor(np.min(corners, axis=0)).astype(int) - SLAB_MARGIN
+    upper = np.ceil(np.max(corners, axis=0)).astype(int) + SLAB_MARGIN
+    lower = np.maximum(lower, 0)
+    upper = np.minimum(upper, moving_image.GetSize())
+    if np.any(upper <= lower):
+        return None
+    return moving_image[int(lower[0]):int(upper[0]), int(lower[1]):int(upper[1]), int(lower[2]):int(upper[2])]
+
+
+class ConvergenceWatchdog:
+    """
+    Enforces the time budget and the early stop of one registration (see RegistrationParameters) from the iteration
+    events of the optimizer, and keeps the best transform seen on each pyramid level.
+
+    The metric value reported at an iteration event is that of the position before the step the optimizer just took,
+    so each value is paired with the position of the previous event.
+
+    Attributes
+        deadline : float: time.perf_counter() at which the time budget runs out (None: no limit).
+        flags : list of str: Why the result may be worse than a complete registration, for the batch report.
+        stop_reason : str: Why the watchdog stopped the current level (None if it did not).
+    """
+    def __init__(self, parameters):
+        self.parameters = parameters
+        budget = parameters.time_budget_seconds
+        self.deadline = time.perf_counter() + budget if budget > 0 else None
+        self.flags = []
+        self.stop_reason = None
+        self._best_value = None
+        self._best_position = None
+        self._position = None
+        self._stale_iterations = 0
+
+    @property
+    def expired(self):
+        return self.deadline is not None and time.perf_counter() >= self.deadline
+
+    def fork(self):
+        """
+        Watchdog of a concurrent start of the same registration (see multi_start): same deadline, own state and flags.
+        """
+        watchdog = ConvergenceWatchdog(self.parameters)
+        watchdog.deadline = self.deadline
+        return watchdog
+
+    def start_level(self, transform):
+        self.stop_reason = None
+        self._best_value, self._best_position = None, None
+        self._position = transform.GetParameters()
+        self._stale_iterations = 0
+
+    def iteration(self, registration_method):
+        """
+        Iteration event observer: records the best position and stops the optimizer when the time budget runs out or
+        the metric reaches a plateau.
+        """
+        value = registration_method.GetMetricValue()
+        best = self._best_value
+        if best is None or value < best - self.parameters.early_stop_tolerance * abs(best):
+            self._stale_iterations = 0
+        else:
+            self._stale_iterations += 1
+        if best is None or value < best:
+            self._best_value, self._best_position = value, self._position
+        self._position = registration_method.GetOptimizerPosition()
+
+        early_stop_iterations = self.parameters.early_stop_iterations
+        if self.expired:
+            self.stop_reason = f'time budget of {self.parameters.time_budget_seconds:g} s exhausted'
+            registration_method.StopRegistration()
+        elif early_stop_iterations and self._stale_iterations >= early_stop_iterations:
+            self.stop_reason = f'metric plateau: no improvement in {early_stop_iterations} iterations'
+            registration_method.StopRegistration()
+
+    def finish_level(self, level, transform):
+        """
+        Restores the best transform of the level if the watchdog stopped it, and flags an exhausted time budget.
+
+        Returns:
+            The stop reason, or None if the optimizer stopped by itself.
+        """
+        if self.stop_reason is None:
+            return None
+        if self._best_position is not None:
+            transform.SetParameters(self._best_position)
+        if self.expired:
+            self.flags.append(f'{self.stop_reason} at pyramid level {level + 1} of '
+                              f'{len(self.parameters.shrink_factors)}; kept the best transform of that level')
+        return self.stop_reason
+
+
+@dataclass(frozen=True)
+class RegistrationRecord:
+    """
+    Outcome of the registration of one moving image: the transform and how it was reached, for the batch report and
+    the transform store (see store_tools).
+
+    Attributes
+        parameters : tuple of float: Euler angles (radians) and translation (mm) of the fixed to moving transform.
+        center : tuple of float: Center of rotation of the transform (mm).
+        metric : float: Metric value of the last pyramid level (Mattes mutual information: lower is better).
+        iterations : int: Optimizer iterations over all pyramid levels.
+        seconds : float: Wall time of the registration and of the resampling, if any (reading and writing excluded).
+        flags : tuple of str: Why the result may be incomplete (see ConvergenceWatchdog); empty for a full
+            registration.
+    """
+    parameters: tuple
+    center: tuple
+    metric: float = float('nan')
+    iterations: int = 0
+    seconds: float = float('nan')
+    flags: tuple = ()
+
+    @classmethod
+    def from_transform(cls, transform, **fields):
+        return cls(tuple(transform.GetParameters()), tuple(transform.GetCenter()), **fields)
+
+    def transform(self):
+        return euler_transform(self.parameters + self.center)
+
+    def to_dict(self):
+        return asdict(self)
+
+
+def _pyramid_level(image, shrink_factor, smoothing_sigma):
+    """
+    Builds one level of the multi-resolution pyramid the way ITK's ImageRegistrationMethod does: Gaussian smoothing
+    with a sigma in physical units, followed by shrinking of the sampling grid.
+    """
+    if smoothing_sigma > 0:
+        image = sitk.SmoothingRecursiveGaussian(image, smoothing_sigma)
+    if shrink_factor > 1:
+        image = sitk.Shrink(image, [shrink_factor] * image.GetDimension())
+    return image
+
+
+def _image_to_shared_memory(image):
+    """
+    Copies the voxels of a SimpleITK image into a new shared memory block.
+
+    Returns:
+        (descriptor, block): descriptor is a picklable dict describing the block and the image geometry.
+    """
+    array = sitk.GetArrayViewFromImage(image)
+    block = shared_memory.SharedMemory(create=True, size=max(1, array.nbytes))
+    np.ndarray(array.shape, dtype=array.dtype, buffer=block.buf)[...] = array
+    descriptor = dict(name=block.name, shape=array.shape, dtype=array.dtype.str, spacing=image.GetSpacing(),
+                      origin=image.GetOrigin(), direction=image.GetDirection())
+    return descriptor, block
+
+
+def _image_from_shared_memory(descriptor):
+    """
+    Rebuilds a SimpleITK image from a shared memory block created by _image_to_shared_memory.
+    """
+    block = shared_memory.SharedMemory(name=descriptor['name'])
+    array = np.ndarray(descriptor['shape'], dtype=np.dtype(descriptor['dtype']), buffer=block.buf)
+    image = sitk.GetImageFromArray(array)
+    del array
+    block.close()
+    image.SetSpacing(descriptor['spacing'])
+    image.SetOrigin(descriptor['origin'])
+    image.SetDirection(descriptor['direction'])
+    return image
+
+
+def _init_worker(n_threads, shared_fixed_context=None):
+    """
+    Process-pool initializer: caps the number of threads SimpleITK / ITK may use inside each worker so that
+    workers x threads stays within the CPU budget, and attaches the fixed image context shared by the parent.
+    """
+    global _worker_fixed_context
+    sitk.ProcessObject.SetGlobalDefaultNumberOfThreads(n_threads)
+    if shared_fixed_context is not None:
+        _worker_fixed_context = FixedImageContext.from_shared_memory(shared_fixed_context)
+
+
+def _init_service_worker(n_threads, shared_fixed_context):
+    """
+    Pool initializer of RegistrationService: as _init_worker, and leaves Ctrl-C to the service, which lets the
+    registrations in progress finish before it stops.
+    """
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    _init_worker(n_threads, shared_fixed_context)
+
+
+def _safe_call(task_function, fixed_context, task):
+    """
+    Runs task_function(fixed_context, *task) and returns (task[0], error, result) where error is None on success or
+    the formatted traceback on failure, and result is what task_function returned: a RegistrationRecord (see
+    rigid_registration), or a list of flags. Exceptions are never raised, so that one bad image does not abort the
+    whole batch. Inside a pool worker (fixed_context is None) the context shared by the parent is used.
+    """
+    try:
+        result = task_function(fixed_context or _worker_fixed_context, *task)
+        return task[0], None, result
+    except Exception:
+        return task[0], traceback.format_exc(), None
+
+
+def _report_task(failures, name, error, result, progress, on_success=None, on_flagged=None, on_result=None):
+    """
+    Prints the progress of a finished task ('[done/total]'), records its failure, or calls on_flagged, on_result (if
+    the task returned a RegistrationRecord) and on_success.
+    """
+    flags = result.flags if isinstance(result, RegistrationRecord) else result
+    status = 'done' if error is None else 'FAILED'
+    if flags:
+        status += f" ({'; '.join(flags)})"
+    print(f'[{progress}] {status}: {name}', flush=True)
+    if error is not None:
+        failures[name] = error
+        return
+    if flags and on_flagged is not None:
+        on_flagged(name, flags)
+    if isinstance(result, RegistrationRecord) and on_result is not None:
+        on_result(name, result)
+    if on_success is not None:
+        on_success(name)
+
+
+def _run_batch(task_function, fixed_context, tasks, n_jobs, on_success=None, on_flagged=None, on_result=None):
+    """
+    Runs task_function(fixed_context, *task) for every task, in-process or in a pool of worker processes that
+    receive fixed_context through shared memory. Progress is printed as tasks finish.
 
     Parameters
-        fixed_image_path : str: Path to the fixed image.
-        moving_image_path : str: Path to the moving image.
-        registered_image_path : str: Path to the registered image.
-        transform_matrix_path : str: Path to the transform matrix.
+        task_function : module-level function (picklable), called as task_function(fixed_context, *task).
+        fixed_context : FixedImageContext: Prepared fixed image shared by all tasks.
+        tasks : list of tuples; the first element of each task (the moving image path) identifies it.
+        n_jobs : int: Number of worker processes. 1 runs in-process; 0 or negative uses one worker per CPU.
+        on_success : callable: Called in the calling process as on_success(task[0]) after each successful task.
+        on_flagged : callable: Called in the calling process as on_flagged(task[0], flags) before on_success, for
+            each successful task that returned flags.
+        on_result : callable: Called in the calling process as on_result(task[0], record) before on_success, for
+            each successful task that returned a RegistrationRecord.
 
     Returns:
-        None.
+        failures : dict mapping task[0] to the formatted traceback of every task that failed.
+    """
+    n_workers, n_threads = split_cpu_budget(n_jobs)
+    n_workers = min(n_workers, len(tasks))
+    failures = {}
 
-    Side Effects:
-        Saves registered image and transform matrix to disk (to registered_image_path and transform_matrix_path).
+    def report(name, error, result, done):
+        _report_task(failures, name, error, result, f'{done}/{len(tasks)}', on_success, on_flagged, on_result)
+
+    if n_workers <= 1:
+        for done, task in enumerate(tasks, start=1):
+            report(*_safe_call(task_function, fixed_context, task), done)
+        return failures
+
+    print(f'Processing {len(tasks)} images with {n_workers} workers x {n_threads} threads.', flush=True)
+    shared_fixed_context, blocks = fixed_context.to_shared_memory()
+    try:
+        with ProcessPoolExecutor(max_workers=n_workers, initializer=_init_worker,
+                                 initargs=(n_threads, shared_fixed_context)) as pool:
+            futures = [pool.submit(_safe_call, task_function, None, task) for task in tasks]
+            for done, future in enumerate(as_completed(futures), start=1):
+                report(*future.result(), done)
+    finally:
+        for block in blocks:
+            block.close()
+            block.unlink()
+    return failures
+
+
+def _registration_task(fixed_context, moving_image_path, registered_image_path, transform_matrix_path,
+                       hook_factory, output_format):
+    hook = hook_factory(moving_image_path, transform_matrix_path) if hook_factory is not None else None
+    return rigid_registration(None, moving_image_path, registered_image_path, transform_matrix_path,
+                              fixed_context=fixed_context, hook=hook, output_format=output_format)
+
+
+def _resample_task(fixed_context, moving_image_path, transform_matrix_path, registered_image_path, output_format):
+    output_format = output_format or OutputFormat()
+    if transform_matrix_path.endswith(MOTION_SUFFIX):
+        return resample_timeseries(fixed_context, moving_image_path, transform_matrix_path, registered_image_path,
+                                   output_format)
+    parameters = fixed_context.parameters
+    moving_image = read_image(moving_image_path, parameters)
+    pixel_id = read_pixel_id(moving_image_path)
+    transform = sitk.ReadTransform(transform_matrix_path)
+    registered_image = resample(moving_image, fixed_context.grid, transform, parameters.final_interpolator,
+                                parameters.resample_slab_size, output_format.pixel_id(pixel_id))
+    del moving_image
+    write_image(registered_image, registered_image_path, output_format, pixel_id)
+
+
+def _pipelined_registration_batch(fixed_context, jobs, hook_factory, prefetch, output_format, on_success=None,
+                                  on_flagged=None, on_result=None):
     """
-    # Read the images
-    fixed_image = sitk.ReadImage(fixed_image_path, sitk.sitkFloat32)
-    moving_image = sitk.ReadImage(moving_image_path, sitk.sitkFloat32)
+    In-process registration of a batch as a three-stage pipeline: a reader thread decodes the next moving images into
+    a bounded queue, the calling thread registers, and a writer thread compresses and saves the outputs. Decoding
+    and encoding of neighbouring images thus overlap with the optimizer, and the bounded queues cap the number of
+    volumes held in memory at 2 x prefetch + 1.
+
+    Returns:
+        failures : dict mapping moving_image_path to the formatted traceback of every image that failed.
+    """
+    output_format = output_format or OutputFormat()
+    read_queue = queue.Queue(maxsize=prefetch)
+    write_queue = queue.Queue(maxsize=prefetch)
+    failures = {}
+    lock = threading.Lock()
+    done = [0]
+
+    def report(moving_image_path, error, record=None):
+        with lock:
+            done[0] += 1
+            _report_task(failures, moving_image_path, error, record, f'{done[0]}/{len(jobs)}', on_success, on_flagged,
+                         on_result)
+
+    def reader():
+        for job in jobs:
+            moving_image_path, registered_image_path, transform_matrix_path = job
+            hook = hook_factory(moving_image_path, transform_matrix_path) if hook_factory is not None \
+                else RegistrationHook()
+            try:
+                with hook.stage('read'):
+                    moving_image = read_image(moving_image_path, fixed_context.parameters)
+                    pixel_id = read_pixel_id(moving_image_path)
+                read_queue.put((job, hook, moving_image, pixel_id, None))
+            except Exception:
+                read_queue.put((job, hook, None, None, traceback.format_exc()))
+        read_queue.put(None)
+
+    def writer():
+        while True:
+            item = write_queue.get()
+            if item is None:
+                return
+            (moving_image_path, registered_image_path, transform_matrix_path), hook, final_transform, \
+                resampled_moving_image, pixel_id, record = item
+            try:
+                with hook.stage('write'):
+                    save_outputs(final_transform, transform_matrix_path, resampled_moving_image,
+                                 registered_image_path, output_format, pixel_id)
+                hook.finish()
+                report(moving_image_path, None, record)
+            except Exception:
+                report(moving_image_path, traceback.format_exc())
+
+    threads = [threading.Thread(target=reader, daemon=True), threading.Thread(target=writer, daemon=True)]
+    for thread in threads:
+        thread.start()
+    try:
+        while True:
+            item = read_queue.get()
+            if item is None:
+                break
+            job, hook, moving_image, pixel_id, error = item
+            if error is not None:
+                report(job[0], error)
+                continue
+            try:
+                final_transform, resampled_moving_image, record = register_image(
+                    fixed_context, moving_image, resample_output=job[1] is not None, hook=hook,
+                    pixel_id=output_format.pixel_id(pixel_id))
+            except Exception:
+                report(job[0], traceback.format_exc())
+                continue
+            del moving_image
+            write_queue.put((job, hook, final_transform, resampled_moving_image, pixel_id, record))
+    finally:
+        write_queue.put(None)
+        for thread in threads:
+            thread.join()
+    return failures
+
+
+# ----------------------------------------------- MAIN FUNCTIONS ------------------------------------------------------
+
+class FixedImageContext:
+    """
+    The decoded fixed image together with its precomputed multi-resolution pyramid.
+
+    Building the context once and passing it to every rigid_registration call of a batch avoids decompressing the
+    fixed image and rebuilding its shrink / smooth pyramid for each moving image. The metric sampler is seeded
+    with parameters.sampling_seed, so every registration against the context samples the same fixed image points.
+
+    With parameters.working_shrink > 1 only the reduced working copy of the fixed image is kept; the registered
+    images are resampled onto the full resolution grid, which needs its geometry but not its voxels.
+
+    The foreground mask of the fixed image (computed with parameters.foreground_mask 'otsu', or supplied) is also
+    computed once, and the working copy is cropped to its bounding box before the pyramid is built.
+
+    Attributes
+        image : sitk.Image: The fixed image the registration runs on (float32, reduced by parameters.working_shrink).
+        parameters : RegistrationParameters: Parameters the pyramid was built with (and the registrations use).
+        levels : list of sitk.Image: Smoothed and shrunk fixed image of each pyramid level.
+        grid : dict: Full resolution sampling grid of the fixed image (see image_grid).
+        mask : sitk.Image: uint8 foreground mask of the metric (see mask_tools), or None.
+    """
+    def __init__(self, image, parameters=None, levels=None, grid=None, mask=None):
+        self.parameters = parameters or RegistrationParameters()
+        self.grid = grid or image_grid(image)
+        if levels is None:
+            working_shrink = self.parameters.working_shrink
+            image = working_image(image, working_shrink)
+            if mask is None and self.parameters.foreground_mask != 'none':
+                mask = foreground_mask(image)
+            if mask is not None:
+                image = crop_to_mask(image, mask)
+            levels = [_pyramid_level(image, max(1, round(shrink_factor / working_shrink)), smoothing_sigma)
+                      for shrink_factor, smoothing_sigma
+                      in zip(self.parameters.shrink_factors, self.parameters.smoothing_sigmas)]
+        self.image = image
+        self.levels = levels
+        self.mask = mask
+        self._coarse_image = None
+
+    @property
+    def coarse_image(self):
+        """
+        Coarse copy of the fixed image used by the initialization search (built on first use).
+        """
+        if self._coarse_image is None:
+            self._coarse_image = coarse_image(self.image)
+        return self._coarse_image
+
+    @classmethod
+    def from_path(cls, fixed_image_path, parameters=None, mask_path=None):
+        """
+        Reads the fixed image from disk and builds its context. mask_path is an optional foreground mask of the fixed
+        image supplied by the user (non-zero voxels are foreground), used instead of parameters.foreground_mask.
+        """
+        parameters = parameters or RegistrationParameters()
+        mask = read_mask(mask_path) if mask_path is not None else None
+        return cls(read_image(fixed_image_path, parameters), parameters, mask=mask)
+
+    def to_shared_memory(self):
+        """
+        Copies the fixed image, its pyramid levels and its mask into shared memory blocks, so that worker processes can
+        attach them without decoding the image or rebuilding the pyramid.
+
+        Returns:
+            (descriptor, blocks): descriptor is picklable and is passed to from_shared_memory in the workers;
+            blocks are the SharedMemory objects, which the caller must close() and unlink() when the workers are done.
+        """
+        descriptors, blocks = [], []
+        for image in [self.image] + list(self.levels) + ([self.mask] if self.mask is not None else []):
+            descriptor, block = _image_to_shared_memory(image)
+            descriptors.append(descriptor)
+            blocks.append(block)
+        return dict(images=descriptors, parameters=self.parameters, grid=self.grid,
+                    has_mask=self.mask is not None), blocks
+
+    @classmethod
+    def from_shared_memory(cls, descriptor):
+        """
+        Rebuilds a context from the descriptor returned by to_shared_memory.
+        """
+        images = [_image_from_shared_memory(image_descriptor) for image_descriptor in descriptor['images']]
+        mask = images.pop() if descriptor['has_mask'] else None
+        return cls(images[0], descriptor['parameters'], levels=images[1:], grid=descriptor['grid'], mask=mask)
+
+
+def initialize_transform(fixed_image, moving_image, initialization='geometry', fixed_coarse_image=None):
+    """
+    Initial rigid transform of the registration: aligns the geometric centers of the two images and, unless
+    initialization is 'geometry', refines the rotation and translation with the coarse search of
+    initialization_tools ('moments' or 'search').
 
-    # Initialize the transform
+    Parameters
+        fixed_coarse_image : sitk.Image: Coarse fixed image of the search (see FixedImageContext.coarse_image);
+            built from fixed_image if not given.
+
+    Returns:
+        sitk.Euler3DTransform
+    """
     initial_transform = sitk.CenteredTransformInitializer(fixed_image,
                                                           moving_image,
                                                           sitk.Euler3DTransform(),
                                                           sitk.CenteredTransformInitializerFilter.GEOMETRY)
+    initial_transform = sitk.Euler3DTransform(initial_transform)
+    if initialization == 'geometry':
+        return initial_transform
+    if fixed_coarse_image is None:
+        fixed_coarse_image = coarse_image(fixed_image)
+    return coarse_initialization(fixed_coarse_image, moving_image, initial_transform, initialization)
 
-    # Set up the multi-resolution framework
-    registration_method = sitk.ImageRegistrationMethod()
-    registration_method.SetShrinkFactorsPerLevel(shrinkFactors=[4, 2, 1])
-    registration_method.SetSmoothingSigmasPerLevel(smoothingSigmas=[2, 1, 0])
-    registration_method.SmoothingSigmasAreSpecifiedInPhysicalUnitsOn()
+
+def _shift_scales(image, transform):
+    """
+    Largest shift (mm) of the corners of image per unit change of each parameter of transform. SimpleITK's scale
+    estimators return the squares of such shifts, which balance gradients; the simplex of Amoeba is divided by the
+    scales themselves, so it needs these to take steps of about the same length in mm along every parameter.
+    """
+    size = image.GetSize()
+    corners = [image.TransformContinuousIndexToPhysicalPoint(tuple(float(c * (n - 1)) for c, n in zip(corner, size)))
+               for corner in np.ndindex(2, 2, 2)]
+    moved = [np.asarray(transform.TransformPoint(corner)) for corner in corners]
+    step = 1e-3
+    scales = []
+    for index, value in enumerate(transform.GetParameters()):
+        shifted = sitk.Euler3DTransform(transform)
+        shifted_parameters = list(shifted.GetParameters())
+        shifted_parameters[index] = value + step
+        shifted.SetParameters(shifted_parameters)
+        scales.append(max(np.linalg.norm(np.asarray(shifted.TransformPoint(corner)) - point)
+                          for corner, point in zip(corners, moved)) / step)
+    return scales
+
+
+def _set_optimizer(registration_method, parameters, fixed_image, transform):
+    """
+    Sets the optimizer of one pyramid level (see OPTIMIZERS) and its scales, so that a step moves the image by about
+    the same distance along every parameter: estimated from the Jacobian of the transform, or with _shift_scales for
+    Amoeba.
+    """
+    optimizer = parameters.optimizer
+    if optimizer == 'gradient_descent':
+        registration_method.SetOptimizerAsGradientDescent(
+            learningRate=parameters.learning_rate,
+            numberOfIterations=parameters.iterations,
+            convergenceMinimumValue=parameters.convergence_minimum_value,
+            convergenceWindowSize=parameters.convergence_window_size)
+    elif optimizer == 'regular_step':
+        registration_method.SetOptimizerAsRegularStepGradientDescent(
+            learningRate=parameters.learning_rate,
+            minStep=REGULAR_STEP_MIN_STEP * parameters.learning_rate,
+            numberOfIterations=parameters.iterations,
+            relaxationFactor=REGULAR_STEP_RELAXATION)
+    elif optimizer == 'lbfgs':
+        registration_method.SetOptimizerAsLBFGS2(
+            solutionAccuracy=LBFGS_SOLUTION_ACCURACY,
+            numberOfIterations=parameters.iterations)
+    elif optimizer == 'powell':
+        registration_method.SetOptimizerAsPowell(
+            numberOfIterations=parameters.iterations,
+            maximumLineIterations=POWELL_LINE_ITERATIONS,
+            stepLength=parameters.learning_rate,
+            stepTolerance=POWELL_STEP_TOLERANCE * parameters.learning_rate,
+            valueTolerance=parameters.convergence_minimum_value)
+    else:
+        registration_method.SetOptimizerAsAmoeba(
+            simplexDelta=parameters.learning_rate,
+            numberOfIterations=parameters.iterations,
+            functionConvergenceTolerance=parameters.convergence_minimum_value)
+        registration_method.SetOptimizerScales(_shift_scales(fixed_image, transform))
+        return
+    registration_method.SetOptimizerScalesFromJacobian()
+
+
+def _optimize_level(fixed_context, fixed_level, moving_level, transform, level, hook, watchdog, n_threads=None):
+    """
+    Optimizes one pyramid level from transform, which is refined in place.
+
+    Parameters
+        n_threads : int: SimpleITK threads of the registration (default: the global default).
+
+    Returns:
+        (registration_method, stop_reason): stop_reason is that of the watchdog (None if the optimizer stopped by
+        itself).
+    """
+    parameters = fixed_context.parameters
 
     # Set up the registration components
-    registration_method.SetMetricAsMattesMutualInformation(numberOfHistogramBins=50)
+    registration_method = sitk.ImageRegistrationMethod()
+    registration_method.SetMetricAsMattesMutualInformation(numberOfHistogramBins=parameters.histogram_bins)
     registration_method.SetMetricSamplingStrategy(registration_method.RANDOM)
-    registration_method.SetMetricSamplingPercentage(0.01)
+    registration_method.SetMetricSamplingPercentage(parameters.sampling_percentage, parameters.sampling_seed)
+    if fixed_context.mask is not None:
+        registration_method.SetMetricFixedMask(fixed_context.mask)
     registration_method.SetInterpolator(sitk.sitkLinear)
+    _set_optimizer(registration_method, parameters, fixed_level, transform)
+    registration_method.SetInitialTransform(transform, inPlace=True)
+    if n_threads is not None:
+        registration_method.SetNumberOfThreads(n_threads)
+    watchdog.start_level(transform)
 
-    registration_method.SetOptimizerAsGradientDescent(learningRate=1.0, numberOfIterations=100,
-                                                      convergenceMinimumValue=1e-6, convergenceWindowSize=10)
-    registration_method.SetOptimizerScalesFromPhysicalShift()
-
-    registration_method.SetInitialTransform(initial_transform, inPlace=False)
-    registration_method.SetOptimizerScalesFromJacobian()
+    # Report optimizer progress to the hook
+    registration_method.AddCommand(sitk.sitkIterationEvent,
+                                   lambda: hook.iteration(level, registration_method.GetOptimizerIteration(),
+                                                          registration_method.GetMetricValue()))
+    registration_method.AddCommand(sitk.sitkIterationEvent, lambda: watchdog.iteration(registration_method))
 
     # Execute the registration
-    final_transform = registration_method.Execute(fixed_image, moving_image)
+    registration_method.Execute(fixed_level, moving_level)
+    return registration_method, watchdog.finish_level(level, transform)
 
-    # print(f"Final metric value: {registration_method.GetMetricValue()}")
-    # print(f"Optimizer's stopping condition: {registration_method.GetOptimizerStopConditionDescription()}")
 
-    # Apply the transform to the moving image
-    resampled_moving_image = sitk.Resample(moving_image, fixed_image, final_transform, sitk.sitkBSpline, 0.0,
-                                           moving_image.GetPixelID())
+def _multi_start_transforms(transform, n_starts):
+    """
+    Starting transforms of multi_start: transform, then transform rotated by MULTI_START_ANGLE_DEG one way and the
+    other about the x, y and z axes in turn.
+    """
+    starts = [sitk.Euler3DTransform(transform)]
+    angle = np.deg2rad(MULTI_START_ANGLE_DEG)
+    for axis in range(3):
+        for sign in (1, -1):
+            start = sitk.Euler3DTransform(transform)
+            start_parameters = list(start.GetParameters())
+            start_parameters[axis] += sign * angle
+            start.SetParameters(start_parameters)
+            starts.append(start)
+    return starts[:n_starts]
+
+
+def _multi_start_level(fixed_context, fixed_level, moving_level, transform, level, watchdog):
+    """
+    Optimizes one pyramid level from each multi_start starting transform concurrently (SimpleITK releases the GIL
+    while it registers, and the threads of the process are split between the starts), and sets transform to the
+    result with the best metric value. The results are compared on the metric over every voxel of the level
+    (MetricEvaluate ignores the sampling), which is cheap on the coarsest level and less noisy than the sampled
+    metric the optimizers see.
+
+    Returns:
+        (registration_method, stop_reason) of the best start (see _optimize_level).
+    """
+    starts = _multi_start_transforms(transform, fixed_context.parameters.multi_start)
+    watchdogs = [watchdog.fork() for _ in starts]
+    n_threads = max(1, sitk.ProcessObject.GetGlobalDefaultNumberOfThreads() // len(starts))
+
+    def optimize_start(start, start_watchdog):
+        registration_method, stop_reason = _optimize_level(fixed_context, fixed_level, moving_level, start, level,
+                                                           RegistrationHook(), start_watchdog, n_threads)
+        return registration_method, stop_reason, registration_method.MetricEvaluate(fixed_level, moving_level)
+
+    with ThreadPoolExecutor(max_workers=len(starts)) as executor:
+        results = list(executor.map(optimize_start, starts, watchdogs))
+    best = int(np.argmin([metric_value for _, _, metric_value in results]))
+    transform.SetParameters(starts[best].GetParameters())
+    watchdog.flags.extend(watchdogs[best].flags)
+    registration_method, stop_reason, _ = results[best]
+    description = stop_reason or registration_method.GetOptimizerStopConditionDescription()
+    return registration_method, f'start {best + 1} of {len(starts)}: {description}'
 
+
+def moving_pyramid(moving_image, parameters):
+    """
+    Smoothed moving image of each pyramid level (see optimize_transform), for a moving image registered with many
+    fixed images.
+    """
+    return [_pyramid_level(moving_image, 1, smoothing_sigma) for smoothing_sigma in parameters.smoothing_sigmas]
+
+
+def optimize_transform(fixed_context, moving_image, transform, hook=None, watchdog=None, moving_levels=None):
+    """
+    Runs the multi-resolution optimization and refines transform in place.
+
+    The fixed pyramid is precomputed in fixed_context; the moving image is only smoothed at each level (as ITK
+    does), and every level continues from the transform the previous level reached. The metric only samples the
+    foreground mask of the fixed image, if it has one. With multi_start, the coarsest level is optimized from several
+    starting transforms and the finer levels continue from the best one.
+
+    Parameters
+        fixed_context : FixedImageContext: Prepared fixed image.
+        moving_image : sitk.Image: Moving image (float32).
+        transform : sitk.Euler3DTransform: Initial transform; updated in place.
+        hook : RegistrationHook: Receives the level and iteration events of the optimizer.
+        watchdog : ConvergenceWatchdog: Enforces the time budget and early stop (created here if not given, in which
+            case the time budget starts now); its flags tell whether the time budget ran out.
+        moving_levels : list of sitk.Image: Smoothed moving image of each level (see moving_pyramid), if they were
+            already computed.
+
+    Returns:
+        transform
+    """
+    hook = hook or RegistrationHook()
+    parameters = fixed_context.parameters
+    watchdog = watchdog or ConvergenceWatchdog(parameters)
+    levels = zip(fixed_context.levels, parameters.shrink_factors, parameters.smoothing_sigmas)
+    for level, (fixed_level, shrink_factor, smoothing_sigma) in enumerate(levels):
+        if watchdog.expired:
+            watchdog.flags.append(f'time budget of {parameters.time_budget_seconds:g} s exhausted before pyramid '
+                                  f'level {level + 1} of {len(parameters.shrink_factors)}')
+            break
+        moving_level = moving_levels[level] if moving_levels is not None else \
+            _pyramid_level(moving_image, 1, smoothing_sigma)
+
+        hook.level_started(level, shrink_factor, smoothing_sigma)
+        if level == 0 and parameters.multi_start > 1:
+            registration_method, stop_reason = _multi_start_level(fixed_context, fixed_level, moving_level,
+                                                                  transform, level, watchdog)
+        else:
+            registration_method, stop_reason = _optimize_level(fixed_context, fixed_level, moving_level, transform,
+                                                               level, hook, watchdog)
+        hook.level_finished(level, registration_method.GetOptimizerIteration(), registration_method.GetMetricValue(),
+                            stop_reason or registration_method.GetOptimizerStopConditionDescription())
+        if watchdog.expired:
+            break
+
+    return transform
+
+
+def resample(moving_image, fixed_image, transform, interpolator='bspline', slab_size=0, pixel_id=sitk.sitkFloat32):
+    """
+    Resamples the moving image onto the fixed image grid.
+
+    Parameters
+        moving_image : sitk.Image: Moving image (any pixel type).
+        fixed_image : sitk.Image or dict: Fixed image, or its grid (see image_grid).
+        transform : sitk.Transform: Fixed to moving transform.
+        interpolator : str: One of INTERPOLATORS.
+        slab_size : int: Number of fixed image slices resampled at a time, each from the cropped moving image region
+            it maps to, so that neither a float32 copy nor B-spline coefficients of the whole moving image are made.
+            0 resamples the whole volume at once.
+        pixel_id : int: Pixel type of the resampled image (integer types are rounded and clipped).
+
+    Returns:
+        sitk.Image
+    """
+    grid = fixed_image if isinstance(fixed_image, dict) else image_grid(fixed_image)
+    n_slices = grid['size'][2]
+    if slab_size <= 0 or slab_size >= n_slices:
+        resampled = sitk.Resample(moving_image, grid['size'], transform, INTERPOLATORS[interpolator], grid['origin'],
+                                  grid['spacing'], grid['direction'], 0.0, sitk.sitkFloat32)
+        return cast_to_pixel_id(resampled, pixel_id)
+
+    resampled = sitk.Image(grid['size'], pixel_id)
+    resampled.SetOrigin(grid['origin'])
+    resampled.SetSpacing(grid['spacing'])
+    resampled.SetDirection(grid['direction'])
+    for first_slice in range(0, n_slices, slab_size):
+        slab_slices = min(slab_size, n_slices - first_slice)
+        source = _slab_source(moving_image, grid, transform, first_slice, slab_slices)
+        if source is None:
+            continue
+        slab = sitk.Resample(source, [grid['size'][0], grid['size'][1], slab_slices], transform,
+                             INTERPOLATORS[interpolator], resampled.TransformIndexToPhysicalPoint((0, 0, first_slice)),
+                             grid['spacing'], grid['direction'], 0.0, sitk.sitkFloat32)
+        resampled[:, :, first_slice:first_slice + slab_slices] = cast_to_pixel_id(slab, pixel_id)
+        del source, slab
+    return resampled
+
+
+def save_outputs(final_transform, transform_matrix_path, resampled_moving_image=None, registered_image_path=None,
+                 output_format=None, pixel_id=None):
+    """
+    Saves the transform matrix and, if given, the registered image (atomically replacing existing files). The
+    registered image is encoded with output_format (see io_tools.OutputFormat); pixel_id is the moving image's original
+    pixel type.
+    """
     # Save the registered image
-    if os.path.exists(registered_image_path):
-        os.remove(registered_image_path)
-    sitk.WriteImage(resampled_moving_image, registered_image_path)
+    if registered_image_path is not None:
+        write_image(resampled_moving_image, registered_image_path, output_format, pixel_id)
 
     # Save the transform matrix
-    if os.path.exists(transform_matrix_path):
-        os.remove(transform_matrix_path)
-    sitk.WriteTransform(final_transform, transform_matrix_path)
+    with atomic_output(transform_matrix_path) as temporary_path:
+        sitk.WriteTransform(final_transform, temporary_path)
+
+
+def register_image(fixed_context, moving_image, resample_output=True, hook=None, pixel_id=sitk.sitkFloat32,
+                   initial_transform=None):
+    """
+    Registers a decoded moving image onto a prepared fixed image: initialization, optimization and (optionally)
+    resampling, without any file I/O.
+
+    The moving image is float32, or in its own data type when fixed_context.parameters.low_memory is set (see
+    read_image); pixel_id is the pixel type of the resampled image. The time budget of the parameters starts here.
+    A given initial_transform (e.g. the result of the previous timepoint of a series) replaces the initialization.
+
+    Returns:
+        (final_transform, resampled_moving_image, record): resampled_moving_image is None if resample_output is False;
+        record is the RegistrationRecord of the registration (its flags list why the result may be incomplete, see
+        ConvergenceWatchdog).
+    """
+    started = time.perf_counter()
+    hook = ConvergenceRecorder(hook)
+    parameters = fixed_context.parameters
+    watchdog = ConvergenceWatchdog(parameters)
+    with hook.stage('mask'):
+        moving_working = moving_working_image(moving_image, parameters)
+
+    # Initialize and optimize the transform
+    with hook.stage('init'):
+        if initial_transform is not None:
+            final_transform = sitk.Euler3DTransform(initial_transform)
+        else:
+            final_transform = initialize_transform(fixed_context.image, moving_working, parameters.initialization,
+                                                   fixed_context.coarse_image)
+    with hook.stage('optimize'):
+        optimize_transform(fixed_context, moving_working, final_transform, hook=hook, watchdog=watchdog)
+    del moving_working
 
+    # Apply the transform to the moving image
+    resampled_moving_image = None
+    if resample_output:
+        with hook.stage('resample'):
+            resampled_moving_image = resample(moving_image, fixed_context.grid, final_transform,
+                                              parameters.final_interpolator, parameters.resample_slab_size, pixel_id)
+    record = RegistrationRecord.from_transform(final_transform, metric=hook.metric, iterations=hook.iterations,
+                                               seconds=time.perf_counter() - started, flags=tuple(watchdog.flags))
+    return final_transform, resampled_moving_image, record
+
+
+def rigid_registration(fixed_image_path, moving_image_path, registered_image_path, transform_matrix_path,
+                       parameters=None, fixed_context=None, hook=None, output_format=None):
+    """
+    Function to perform rigid registration between two images.
+
+    Parameters
+        fixed_image_path : str: Path to the fixed image.
+        moving_image_path : str: Path to the moving image.
+        registered_image_path : str: Path to the registered image. If None, the moving image is not resampled and
+            only the transform is saved.
+        transform_matrix_path : str: Path to the transform matrix.
+        parameters : RegistrationParameters: Registration settings (default: the 'balanced' preset). Ignored when
+            fixed_context is given, because the context's pyramid was built with its own parameters.
+        fixed_context : FixedImageContext: Prepared fixed image. If given, fixed_image_path is not read again.
+        hook : RegistrationHook: Instrumentation hook (see profiling_tools); receives every stage, pyramid level and
+            optimizer iteration.
+        output_format : io_tools.OutputFormat: Encoding of the registered image (default: float32 .nii.gz).
+
+    Returns:
+        record : RegistrationRecord: The transform, final metric value, iteration count and time of the registration;
+            its flags tell why the result may be incomplete, e.g. the time budget of the parameters ran out (see
+            ConvergenceWatchdog), and are empty for a full registration.
+
+    Side Effects:
+        Saves registered image and transform matrix to disk (to registered_image_path and transform_matrix_path).
+    """
+    hook = hook or RegistrationHook()
+    output_format = output_format or OutputFormat()
+
+    # Read the images
+    if fixed_context is None:
+        with hook.stage('read_fixed'):
+            fixed_context = FixedImageContext.from_path(fixed_image_path, parameters)
+    with hook.stage('read'):
+        moving_image = read_image(moving_image_path, fixed_context.parameters)
+        pixel_id = read_pixel_id(moving_image_path)
+
+    final_transform, resampled_moving_image, record = register_image(fixed_context, moving_image,
+                                                                     resample_output=registered_image_path is not None,
+                                                                     hook=hook,
+                                                                     pixel_id=output_format.pixel_id(pixel_id))
+    del moving_image
+
+    with hook.stage('write'):
+        save_outputs(final_transform, transform_matrix_path, resampled_moving_image, registered_image_path,
+                     output_format, pixel_id)
+
+    hook.finish()
+    return record
+
+
+def _timeseries_task(fixed_context, name, moving_image_path, first, stop, output, motion, pixel_id, reference=None):
+    """
+    Registers the timepoints first to stop - 1 of a 4D moving image one after the other, each starting from the
+    transform of the previous one, and writes their transforms (and registered timepoints) into the shared arrays of
+    register_timeseries. The reference timepoint of the series, if it is one of them, takes the identity transform.
+    """
+    parameters = fixed_context.parameters
+    motion_array, motion_block = attach_shared_array(motion)
+    output_array, output_block = attach_shared_array(output) if output is not None else (None, None)
+    flags, transform = [], None
+    try:
+        for timepoint in range(first, stop):
+            moving_image = read_image_timepoint(moving_image_path, timepoint, parameters)
+            if timepoint == reference:
+                transform, timepoint_flags = sitk.Euler3DTransform(), []
+                transform.SetCenter(initialize_transform(fixed_context.image, fixed_context.image).GetCenter())
+                registered_image = resample(moving_image, fixed_context.grid, transform, parameters.final_interpolator,
+                                            parameters.resample_slab_size, pixel_id) if output is not None else None
+            else:
+                transform, registered_image, record = register_image(fixed_context, moving_image,
+                                                                     resample_output=output is not None,
+                                                                     pixel_id=pixel_id, initial_transform=transform)
+                timepoint_flags = record.flags
+            motion_array[timepoint] = transform.GetParameters() + transform.GetCenter()
+            if output_array is not None:
+                output_array[timepoint] = sitk.GetArrayViewFromImage(registered_image)
+            flags += [f'timepoint {timepoint}: {flag}' for flag in timepoint_flags]
+            del moving_image, registered_image
+    finally:
+        del motion_array, output_array
+        motion_block.close()
+        if output_block is not None:
+            output_block.close()
+    return flags
+
+
+def register_timeseries(fixed_context, moving_image_path, registered_image_path, motion_path, n_jobs=1,
+                        output_format=None):
+    """
+    Registers every timepoint of a 4D moving image, read one at a time, onto the fixed image or onto a timepoint of
+    the series (see RegistrationParameters.timeseries_reference).
+
+    The timepoints are split into one run of consecutive timepoints per worker (see timepoint_runs). Within a run,
+    each timepoint starts from the transform of the previous one, which is close to its own, so only the first
+    timepoint of a run is initialized and the optimizer converges in fewer iterations. The workers write the
+    registered timepoints into one shared 4D array, which is saved as the registered 4D image, and the transforms
+    are stacked into one motion parameter file (see timeseries_tools.save_motion).
+
+    Parameters
+        fixed_context : FixedImageContext: Prepared fixed image (not used when the series is its own reference).
+        registered_image_path : str: Path to the registered 4D image (None: only the motion file is saved).
+        motion_path : str: Path to the motion parameter file.
+        n_jobs : int: Number of worker processes (see _run_batch).
+        output_format : io_tools.OutputFormat: Encoding of the registered image (default: float32 .nii.gz).
+
+    Returns:
+        flags : list of str: Why the transforms of some timepoints may be incomplete (see ConvergenceWatchdog).
+    """
+    output_format = output_format or OutputFormat()
+    parameters = fixed_context.parameters
+    n_timepoints = timepoint_count(moving_image_path)
+    reference = None
+    if parameters.timeseries_reference != 'fixed':
+        reference = 0 if parameters.timeseries_reference == 'first' else n_timepoints // 2
+        fixed_context = FixedImageContext(read_image_timepoint(moving_image_path, reference, parameters), parameters)
+
+    source_pixel_id = read_pixel_id(moving_image_path)
+    pixel_id = output_format.pixel_id(source_pixel_id)
+    runs = timepoint_runs(n_timepoints, split_cpu_budget(n_jobs)[0])
+    motion, motion_block = create_shared_array((n_timepoints, 9), np.float64)
+    output, output_block = None, None
+    if registered_image_path is not None:
+        grid_size = fixed_context.grid['size']
+        output, output_block = create_shared_array((n_timepoints,) + tuple(reversed(grid_size)),
+                                                   sitk.GetArrayViewFromImage(sitk.Image(1, 1, pixel_id)).dtype)
+    flags = []
+    try:
+        tasks = [(f'{moving_image_path} [timepoints {first}-{stop - 1} of {n_timepoints}]', moving_image_path, first,
+                  stop, output, motion, pixel_id, reference) for first, stop in runs]
+        failures = _run_batch(_timeseries_task, fixed_context, tasks, n_jobs,
+                              on_flagged=lambda name, run_flags: flags.extend(run_flags))
+        if failures:
+            raise RuntimeError('\n'.join(f'{name} failed:\n{error}' for name, error in failures.items()))
+
+        motion_array, attached = attach_shared_array(motion)
+        transforms = [euler_transform(row) for row in motion_array]
+        del motion_array
+        attached.close()
+        if registered_image_path is not None:
+            output_array, attached = attach_shared_array(output)
+            registered_image = timeseries_image(output_array, fixed_context.grid, timepoint_spacing(moving_image_path))
+            del output_array
+            attached.close()
+            write_image(registered_image, registered_image_path, output_format, source_pixel_id)
+            del registered_image
+        save_motion(motion_path, transforms)
+    finally:
+        for block in (motion_block, output_block):
+            if block is not None:
+                block.close()
+                block.unlink()
+    return flags
+
+
+def resample_timeseries(fixed_context, moving_image_path, motion_path, registered_image_path, output_format=None):
+    """
+    Resamples every timepoint of a 4D moving image with its transform from a motion parameter file (see
+    register_timeseries), one timepoint at a time, and saves the registered 4D image.
+    """
+    output_format = output_format or OutputFormat()
+    parameters = fixed_context.parameters
+    transforms = read_motion(motion_path)
+    n_timepoints = timepoint_count(moving_image_path)
+    if len(transforms) != n_timepoints:
+        raise ValueError(f'{motion_path} holds {len(transforms)} transforms for {n_timepoints} timepoints')
+    grid = fixed_context.grid
+    if parameters.timeseries_reference != 'fixed':
+        grid = timepoint_grid(moving_image_path)
+    source_pixel_id = read_pixel_id(moving_image_path)
+    pixel_id = output_format.pixel_id(source_pixel_id)
+    output = None
+    for timepoint, transform in enumerate(transforms):
+        registered = resample(read_image_timepoint(moving_image_path, timepoint, parameters), grid, transform,
+                              parameters.final_interpolator, parameters.resample_slab_size, pixel_id)
+        if output is None:
+            output = np.empty((n_timepoints,) + tuple(reversed(grid['size'])),
+                              dtype=sitk.GetArrayViewFromImage(registered).dtype)
+        output[timepoint] = sitk.GetArrayViewFromImage(registered)
+        del registered
+    write_image(timeseries_image(output, grid, timepoint_spacing(moving_image_path)), registered_image_path,
+                output_format, source_pixel_id)
+
+
+def _run_timeseries_batch(fixed_context, jobs, n_jobs, output_format, on_success=None, on_flagged=None):
+    """
+    Registers the 4D moving images of a batch one after the other, each with its timepoints spread over the workers
+    (see register_timeseries).
+    """
+    failures = {}
+    for done, (moving_image_path, registered_image_path, motion_path) in enumerate(jobs, start=1):
+        result = _safe_call(register_timeseries, fixed_context,
+                            (moving_image_path, registered_image_path, motion_path, n_jobs, output_format))
+        _report_task(failures, *result, f'4D image {done}/{len(jobs)}', on_success, on_flagged)
+    return failures
+
+
+def register_batch(fixed_image_path, jobs, parameters=None, n_jobs=1, hook_factory=None, prefetch=2,
+                   output_format=None, on_success=None, fixed_mask_path=None, on_flagged=None, serial_jobs=(),
+                   on_result=None):
+    """
+    Registers many moving images onto the same fixed image, optionally in a pool of worker processes.
+
+    Parameters
+        fixed_image_path : str: Path to the fixed image.
+        jobs : list of (moving_image_path, registered_image_path, transform_matrix_path) tuples. Output paths are
+            taken verbatim from the jobs, so they do not depend on scheduling order. A registered_image_path of
+            None saves only the transform.
+        parameters : RegistrationParameters: Registration settings (default: the 'balanced' preset).
+        n_jobs : int: Number of worker processes. 1 runs in-process; 0 or negative uses one worker per CPU.
+            The CPU budget is split between workers and SimpleITK's internal threads. A worker registers an image
+            exactly as the calling process does with the same number of threads; the metric sums depend on the
+            number of threads, so transforms computed with different numbers differ in their last digits.
+        hook_factory : callable(moving_image_path, transform_matrix_path) -> RegistrationHook, called once per image
+            (inside the worker). Must be picklable, e.g. a module-level function, when n_jobs != 1.
+        prefetch : int: When the batch runs in-process, number of moving images decoded ahead (and of outputs
+            queued for writing) by the I/O threads of the pipeline. 0 runs read, registration and write one after
+            the other.
+        output_format : io_tools.OutputFormat: Encoding of the registered images (default: float32 .nii.gz).
+        on_success : callable: Called in the calling process as on_success(moving_image_path) as soon as the outputs
+            of an image are written (e.g. to journal completed images).
+        fixed_mask_path : str: Path to a foreground mask of the fixed image supplied by the user (see
+            FixedImageContext.from_path).
+        on_flagged : callable: Called in the calling process as on_flagged(moving_image_path, flags), before
+            on_success, for every image whose registration was cut short by the time budget.
+        serial_jobs : list of jobs (as in jobs) registered in-process one at a time, after the others, e.g. because
+            they are too large to register in parallel within the memory limit (see resource_tools).
+        on_result : callable: Called in the calling process as on_result(moving_image_path, record), before
+            on_success, with the RegistrationRecord of every registered 3D image (e.g. for the transform store).
+
+    The fixed image is decoded and its mask and pyramid are built once (FixedImageContext); worker processes receive
+    them through shared memory. 4D moving images are registered after the others, one at a time, with their
+    timepoints spread over the workers (see register_timeseries); the transform_matrix_path of their jobs is the
+    path of their motion parameter file.
+
+    Returns:
+        failures : dict mapping moving_image_path to the formatted traceback of every registration that failed.
+    """
+    if not jobs and not serial_jobs:
+        return {}
+    fixed_context = FixedImageContext.from_path(fixed_image_path, parameters, fixed_mask_path)
+    timeseries_jobs = [job for job in list(jobs) + list(serial_jobs) if is_timeseries(job[0])]
+    jobs = [job for job in jobs if job not in timeseries_jobs]
+    serial_jobs = [job for job in serial_jobs if job not in timeseries_jobs]
+    failures = {}
+    if prefetch > 0 and min(split_cpu_budget(n_jobs)[0], len(jobs)) == 1:
+        failures.update(_pipelined_registration_batch(fixed_context, jobs, hook_factory, prefetch, output_format,
+                                                      on_success, on_flagged, on_result))
+    elif jobs:
+        tasks = [(*job, hook_factory, output_format) for job in jobs]
+        failures.update(_run_batch(_registration_task, fixed_context, tasks, n_jobs, on_success, on_flagged,
+                                   on_result))
+    if serial_jobs:
+        tasks = [(*job, hook_factory, output_format) for job in serial_jobs]
+        failures.update(_run_batch(_registration_task, fixed_context, tasks, 1, on_success, on_flagged, on_result))
+    if timeseries_jobs:
+        failures.update(_run_timeseries_batch(fixed_context, timeseries_jobs, n_jobs, output_format, on_success,
+                                              on_flagged))
+    return failures
+
+
+def resample_batch(reference_image_path, jobs, interpolator='bspline', n_jobs=1, output_format=None, slab_size=0,
+                   on_success=None, serial_jobs=(), timeseries_reference='fixed'):
+    """
+    Applies saved transforms to many moving images and resamples them onto the grid of a reference image, optionally
+    in a pool of worker processes. This is the resampling half of rigid_registration, so that it can be deferred,
+    run at another interpolation order, or run on other nodes.
+
+    Parameters
+        reference_image_path : str: Path to the image that defines the output grid (usually the fixed image).
+        jobs : list of (moving_image_path, transform_matrix_path, registered_image_path) tuples.
+        interpolator : str: One of INTERPOLATORS.
+        n_jobs : int: Number of worker processes (as in register_batch).
+        output_format : io_tools.OutputFormat: Encoding of the registered images (default: float32 .nii.gz).
+        slab_size : int: Number of slices resampled at a time (see resample); 0 resamples whole volumes.
+        on_success : callable: Called in the calling process as on_success(moving_image_path) after each image.
+        serial_jobs : list of jobs (as in jobs) resampled in-process one at a time, after the others.
+        timeseries_reference : str: Target the 4D moving images were registered to (see RegistrationParameters);
+            the transform_matrix_path of their jobs is the path of their motion parameter file.
+
+    Returns:
+        failures : dict mapping moving_image_path to the formatted traceback of every image that failed.
+    """
+    if not jobs and not serial_jobs:
+        return {}
+    parameters = RegistrationParameters(shrink_factors=(), smoothing_sigmas=(), final_interpolator=interpolator,
+                                        resample_slab_size=slab_size, timeseries_reference=timeseries_reference)
+    reference_context = FixedImageContext.from_path(reference_image_path, parameters)
+    failures = {}
+    if jobs:
+        failures.update(_run_batch(_resample_task, reference_context, [(*job, output_format) for job in jobs],
+                                   n_jobs, on_success))
+    if serial_jobs:
+        failures.update(_run_batch(_resample_task, reference_context, [(*job, output_format) for job in serial_jobs],
+                                   1, on_success))
+    return failures
+
+
+class RegistrationService:
+    """
+    Registers moving images onto one fixed image as they are submitted, e.g. by a service that watches a folder (see
+    service_tools). The fixed image context is built once, and the worker processes (or, with a single worker, one
+    registration thread) are started once and kept warm: each image only pays for its own reading, registration and
+    writing, not for the interpreter, the imports or the decoding of the fixed image.
+
+    Parameters
+        fixed_image_path, parameters, n_jobs, hook_factory, output_format, fixed_mask_path : as in register_batch.
+        on_success, on_flagged, on_result : callables as in register_batch, called from collect().
+
+    Attributes
+        failures : dict mapping moving_image_path to the formatted traceback of every registration that failed.
+        done : int: Number of finished registrations.
+    """
+    def __init__(self, fixed_image_path, parameters=None, n_jobs=1, hook_factory=None, output_format=None,
+                 fixed_mask_path=None, on_success=None, on_flagged=None, on_result=None):
+        self.fixed_context = FixedImageContext.from_path(fixed_image_path, parameters, fixed_mask_path)
+        self.hook_factory = hook_factory
+        self.output_format = output_format
+        self.callbacks = (on_success, on_flagged, on_result)
+        self.failures = {}
+        self.done = 0
+        self._futures = set()
+        self._blocks = []
+        self.n_workers, n_threads = split_cpu_budget(n_jobs)
+        if self.n_workers <= 1:
+            self._context = self.fixed_context
+            self._pool = ThreadPoolExecutor(max_workers=1)
+            return
+        shared_fixed_context, self._blocks = self.fixed_context.to_shared_memory()
+        self._context = None
+        self._pool = ProcessPoolExecutor(max_workers=self.n_workers, initializer=_init_service_worker,
+                                         initargs=(n_threads, shared_fixed_context))
+        # Start the workers now rather than when the first images arrive
+        wait([self._pool.submit(os.getpid) for _ in range(self.n_workers)])
 
-# -------------------------------------------------- CODE TESTING -----------------------------------------------------
+    @property
+    def n_pending(self):
+        return len(self._futures)
 
-if __name__ == '__main__':
-    fixed_image_path = '/Users/arman/projects/pl-images-register/data/nifti/fixed.nii.gz'
-    moving_image_path = '/Users/arman/projects/pl-images-register/data/nifti/moving.nii.gz'
-    registered_image_path = '/Users/arman/projects/pl-images-register/data/nifti/moving_registered.nii.gz'
-    transform_matrix_path = '/Users/arman/projects/pl-images-register/data/nifti/transform.mat'
+    def submit(self, job):
+        """
+        Queues the registration of job: a (moving_image_path, registered_image_path, transform_matrix_path) tuple.
+        A 4D moving image is registered timepoint by timepoint by one worker (see register_timeseries); the
+        transform_matrix_path of its job is the path of its motion parameter file.
+        """
+        if job[2].endswith(MOTION_SUFFIX):
+            task_function, task = register_timeseries, (*job, 1, self.output_format)
+        else:
+            task_function, task = _registration_task, (*job, self.hook_factory, self.output_format)
+        self._futures.add(self._pool.submit(_safe_call, task_function, self._context, task))
 
-    t1 = datetime.now()
-    rigid_registration(fixed_image_path, moving_image_path, registered_image_path, transform_matrix_path)
-    print(f'Registration computation time: {datetime.now() - t1}')
+    def collect(self, timeout=None):
+        """
+        Waits up to timeout seconds (None: until one finishes) for registrations to finish, and reports them.
 
-    fixed_image = nib.load(fixed_image_path)
-    moving_image = nib.load(moving_image_path)
-    registered_image = nib.load(registered_image_path)
-    imgshow(fixed_image)
-    imgshow(moving_image)
-    imgshow(registered_image)
+        Returns:
+            list of the moving image paths whose registration finished (succeeded or failed).
+        """
+        if not self._futures:
+            return []
+        finished, self._futures = wait(self._futures, timeout=timeout, return_when=FIRST_COMPLETED)
+        names = []
+        for future in finished:
+            name, error, result = future.result()
+            self.done += 1
+            _report_task(self.failures, name, error, result, f'{self.done}/{self.done + len(self._futures)}',
+                         *self.callbacks)
+            names.append(name)
+        return names
 
+    def close(self):
+        """
+        Waits for the registrations in progress, then stops the workers and releases the shared fixed image context.
+        """
+        while self._futures:
+            self.collect()
+        self._pool.shutdown()
+        for block in self._blocks:
+            block.close()
+            block.unlink()
+        self._blocks = []
@@ -0,0 +1,227 @@
+"""
+Developed by Arman Avesta, MD, PhD
+FNNDSC | Boston Children's Hospital | Harvard Medical School
+
+This module contains the resource planner of a batch: it fits the number of worker processes, the threads of each
+worker and the read-ahead of the pipeline to the CPUs and memory the plugin may actually use.
+
+Inside a container, SimpleITK still sees every core of the host and the whole physical memory. The planner reads the
+CPU quota and memory limit of the cgroup instead (see os_tools), estimates the memory of each registration from the
+NIfTI headers of the manifest (see manifest_tools), and:
+- runs as many workers as the CPU quota allows and the memory limit can hold, with the CPU quota split between them,
+  after one CPU and one process worth of memory for each helper process of the batch (e.g. the QC renderers);
+- registers alone (in-process, after the others) the images too large to register in parallel;
+- refuses the images that would not fit in the memory limit even alone.
+
+The memory estimates were measured on the peak resident memory of registrations of 128^3 to 256^3 volumes.
+"""
+
+# ----------------------------------------------- ENVIRONMENT SETUP ---------------------------------------------------
+# Project imports:
+from os_tools import available_cpus, available_memory, cgroup_cpu_limit, split_cpu_budget, reserve_cpus
+
+# System imports:
+import SimpleITK as sitk
+import numpy as np
+from dataclasses import dataclass, asdict
+
+# Memory of a Python process with the plugin imported, before any image is read:
+PROCESS_BYTES = 200 * 2 ** 20
+
+# Memory of the fixed image context (fixed image and pyramid), per fixed image voxel:
+CONTEXT_BYTES_PER_VOXEL = 10
+LOW_MEMORY_CONTEXT_BYTES_PER_VOXEL = 5
+
+# Memory of one registration per moving image voxel: float32 image, smoothed pyramid level, metric and B-spline
+# coefficients (float64) of the final resampling:
+MOVING_BYTES_PER_VOXEL = 36
+
+# In low memory mode: float32 working copies per voxel of the reduced image (working copy, smoothed level, metric),
+# on top of the moving image decoded in its own data type:
+LOW_MEMORY_WORKING_BYTES_PER_VOXEL = 16
+
+# Fraction of the memory limit the plan may use; the rest is left for the allocator and the page cache of the file
+# system:
+MEMORY_HEADROOM = 0.85
+
+# ---------------------------------------------- HELPER FUNCTIONS -----------------------------------------------------
+
+def _itemsize(header):
+    return header.voxel_bytes // max(1, header.n_voxels)
+
+
+def _gib(n_bytes):
+    return f'{n_bytes / 2 ** 30:.1f} GiB'
+
+
+def context_bytes(fixed_header, parameters):
+    """
+    Estimated memory of the fixed image context, from the header of the fixed image.
+    """
+    per_voxel = LOW_MEMORY_CONTEXT_BYTES_PER_VOXEL if parameters.low_memory else CONTEXT_BYTES_PER_VOXEL
+    return fixed_header.n_voxels * per_voxel
+
+
+def job_bytes(moving_header, fixed_header, parameters, output_itemsize=4, resample_output=True):
+    """
+    Estimated peak memory of one registration (on top of the process and the fixed image context), from the headers
+    of the moving and fixed images. The timepoints of a 4D moving image are registered one at a time, into a
+    registered 4D image held in memory (see registration_tools.register_timeseries).
+
+    Parameters
+        output_itemsize : int: Bytes per voxel of the registered image.
+        resample_output : bool: Whether the registered image is resampled and written.
+    """
+    n_timepoints = moving_header.n_timepoints
+    moving_voxels = moving_header.n_voxels // n_timepoints
+    if parameters.low_memory:
+        moving = moving_header.voxel_bytes // n_timepoints + \
+            moving_voxels * LOW_MEMORY_WORKING_BYTES_PER_VOXEL // parameters.working_shrink ** 3
+        output = 2 * output_itemsize
+    else:
+        moving = moving_voxels * MOVING_BYTES_PER_VOXEL
+        # float32 resampled image, cast to the output type
+        output = 4 + output_itemsize
+    if n_timepoints > 1:
+        output += n_timepoints * output_itemsize
+    return moving + (fixed_header.n_voxels * output if resample_output else 0)
+
+
+def queued_bytes(moving_header, fixed_header, parameters, output_itemsize=4):
+    """
+    Memory of one decoded moving image and one registered image waiting in the queues of the pipeline.
+    """
+    decoded = moving_header.voxel_bytes if parameters.low_memory else moving_header.n_voxels * 4
+    return decoded + fixed_header.n_voxels * output_itemsize
+
+
+@dataclass(frozen=True)
+class ResourcePlan:
+    """
+    Workers, threads and read-ahead of a batch.
+
+    Attributes
+        n_cpus : int: CPUs the plugin may use (affinity and cgroup quota).
+        cpu_quota : float: cgroup CPU quota (None: no quota).
+        memory_bytes : int: Memory the plugin may use (cgroup limit or physical memory; None if unknown).
+        n_workers : int: Worker processes of the batch (1: in-process).
+        threads_per_worker : int: SimpleITK threads of each worker.
+        prefetch : int: Read-ahead of the in-process pipeline.
+        context_bytes : int: Estimated memory of the fixed image context.
+        largest_job_bytes : int: Estimated memory of the largest registration.
+        serial : int: Number of images registered alone after the others.
+        refused : int: Number of images that do not fit in memory.
+        helper_processes : int: Background processes of the batch outside the registration (e.g. QC renderers),
+            each left one of the CPUs.
+    """
+    n_cpus: int
+    cpu_quota: float
+    memory_bytes: int
+    n_workers: int
+    threads_per_worker: int
+    prefetch: int
+    context_bytes: int
+    largest_job_bytes: int
+    serial: int = 0
+    refused: int = 0
+    helper_processes: int = 0
+
+    @property
+    def registration_cpus(self):
+        return max(1, self.n_cpus - self.helper_processes)
+
+    def apply(self):
+        """
+        Sets the SimpleITK threads of the calling process to the CPUs of the plan left to the registrations (worker
+        processes set their own, see registration_tools._init_worker), and reserves the CPUs of the helper processes
+        (see os_tools.reserve_cpus), so that the workers of the batch split the other CPUs.
+        """
+        reserve_cpus(self.helper_processes)
+        sitk.ProcessObject.SetGlobalDefaultNumberOfThreads(self.registration_cpus)
+
+    def summary(self):
+        cpus = f'{self.n_cpus} CPUs' + (f' (cgroup quota {self.cpu_quota:g})' if self.cpu_quota is not None else '')
+        memory = 'unknown memory' if self.memory_bytes is None else f'{_gib(self.memory_bytes)} memory'
+        helpers = f', {self.helper_processes} helper processes' if self.helper_processes else ''
+        text = (f'Resource plan: {cpus}, {memory}; {self.n_workers} workers x {self.threads_per_worker} threads, '
+                f'prefetch {self.prefetch}{helpers}; estimated {_gib(self.context_bytes)} for the fixed image and up '
+                f'to {_gib(self.largest_job_bytes)} per image.')
+        if self.serial:
+            text += f' Too large to register in parallel (registered alone after the others): {self.serial} images.'
+        if self.refused:
+            text += f' Too large for the memory limit (skipped): {self.refused} images.'
+        return text
+
+    def to_dict(self):
+        return asdict(self)
+
+
+# ----------------------------------------------- MAIN FUNCTIONS ------------------------------------------------------
+
+def plan_resources(fixed_header, moving_headers, parameters, n_jobs=1, prefetch=2, output_itemsizes=None,
+                   resample_output=True, helper_processes=0):
+    """
+    Plans the workers, threads and read-ahead of a batch within the CPU quota and memory limit of the plugin.
+
+    Each worker holds a process, a copy of the fixed image context and one registration; the parent process holds
+    the context too. The number of workers is the largest that the CPUs allow and at which the median image still
+    fits in memory. Images that would not fit at that number of workers (assuming the others are as large, since the
+    largest images are scheduled first) are registered alone; images that do not fit even alone are refused.
+
+    Parameters
+        fixed_header : manifest_tools.ImageHeader: Header of the fixed image.
+        moving_headers : dict mapping each moving image path to its ImageHeader.
+        parameters : RegistrationParameters: Registration settings (low memory mode changes the estimates).
+        n_jobs : int: Requested number of workers (0 or negative: one per CPU).
+        prefetch : int: Requested read-ahead of the in-process pipeline.
+        output_itemsizes : dict mapping each moving image path to the bytes per voxel of its registered image
+            (default: 4, float32).
+        resample_output : bool: Whether the registered images are resampled and written.
+        helper_processes : int: Background processes of the batch outside the registration (e.g.
+            visualization_tools.QC_WORKERS QC renderers); each takes one CPU and PROCESS_BYTES of memory.
+
+    Returns:
+        (plan, serial, refused): plan is a ResourcePlan; serial lists the moving image paths to register alone;
+        refused maps the paths of the images that do not fit in memory to the reason.
+    """
+    n_cpus, memory = available_cpus(), available_memory()
+    budget = None if memory is None else int(memory * MEMORY_HEADROOM) - helper_processes * PROCESS_BYTES
+    registration_cpus = max(1, n_cpus - helper_processes)
+    output_itemsizes = output_itemsizes or {}
+    context = context_bytes(fixed_header, parameters)
+    worker = PROCESS_BYTES + context
+    estimates = {path: job_bytes(header, fixed_header, parameters, output_itemsizes.get(path, 4), resample_output)
+                 for path, header in moving_headers.items()}
+
+    def fits(n_workers, estimate):
+        # Parent process, plus n_workers workers running registrations of this size (in-process: the parent alone)
+        total = worker + estimate if n_workers <= 1 else worker + n_workers * (worker + estimate)
+        return budget is None or total <= budget
+
+    hint = 'a larger --working_shrink' if parameters.low_memory else '--low_memory'
+    refused = {path: f'estimated memory {_gib(worker + estimate)} exceeds the memory budget {_gib(budget)} of the '
+                     f'plugin; try {hint}'
+               for path, estimate in estimates.items() if not fits(1, estimate)}
+    accepted = [estimate for path, estimate in estimates.items() if path not in refused]
+
+    n_workers = max(1, min(split_cpu_budget(n_jobs, registration_cpus)[0], len(accepted)))
+    if accepted:
+        median = float(np.median(accepted))
+        while n_workers > 1 and not fits(n_workers, median):
+            n_workers -= 1
+    serial = [path for path, estimate in estimates.items()
+              if n_workers > 1 and path not in refused and not fits(n_workers, estimate)]
+
+    # Read-ahead of the in-process pipeline: each queued image adds a decoded moving image and a registered image
+    if n_workers == 1 and budget is not None and accepted:
+        largest = max(accepted)
+        queued = max(queued_bytes(header, fixed_header, parameters, output_itemsizes.get(path, 4))
+                      for path, header in moving_headers.items() if path not in refused)
+        while prefetch > 0 and worker + largest + prefetch * queued > budget:
+            prefetch -= 1
+
+    plan = ResourcePlan(n_cpus=n_cpus, cpu_quota=cgroup_cpu_limit(), memory_bytes=memory, n_workers=n_workers,
+                        threads_per_worker=max(1, registration_cpus // n_workers), prefetch=prefetch,
+                        context_bytes=context, largest_job_bytes=max(accepted, default=0), serial=len(serial),
+                        refused=len(refused), helper_processes=helper_processes)
+    return plan, serial, refused
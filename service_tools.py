@@ -0,0 +1,325 @@
+"""
+Developed by Arman Avesta, MD, PhD
+FNNDSC | Boston Children's Hospital | Harvard Medical School
+
+This module contains the building blocks of the watch mode (images_register --watch), a long-running service that
+registers moving images as they arrive, e.g. from a scanner feed: the folder watcher, the local socket queue other
+processes can submit images on, and the per-image latency statistics.
+
+The registrations themselves run in a registration_tools.RegistrationService, which keeps the fixed image context
+and the worker processes warm between images.
+"""
+
+# ----------------------------------------------- ENVIRONMENT SETUP ---------------------------------------------------
+# Project imports:
+from io_tools import atomic_output
+
+# System imports:
+import json
+import numpy as np
+import os
+import queue
+import signal
+import socketserver
+import threading
+import time
+from os.path import join, isabs, isdir, exists
+
+# Interval between two scans of the watched folder (seconds):
+WATCH_POLL_SECONDS = 0.5
+
+# Time an image must stay unchanged before it is read, so that images still being copied are not (seconds):
+WATCH_SETTLE_SECONDS = 1.0
+
+# Latency percentiles reported by the service:
+LATENCY_PERCENTILES = (50, 90, 99)
+
+# Report of the service, rewritten next to the outputs after every image:
+SERVICE_REPORT_FILE = 'service_report.json'
+
+# ---------------------------------------------- HELPER FUNCTIONS -----------------------------------------------------
+
+def _signature(image_path):
+    """
+    What changes while an image is written: the size and modification time of a file, or the number, total size and
+    latest modification time of the files of a DICOM series folder.
+
+    Returns:
+        (signature, modification_time), or (None, None) if the image disappeared.
+    """
+    try:
+        if not isdir(image_path):
+            stat = os.stat(image_path)
+            return (stat.st_size, stat.st_mtime_ns), stat.st_mtime
+        with os.scandir(image_path) as entries:
+            stats = [entry.stat() for entry in entries if entry.is_file()]
+        modification_time = max([stat.st_mtime_ns for stat in stats], default=0)
+        return (len(stats), sum(stat.st_size for stat in stats), modification_time), modification_time / 1e9
+    except FileNotFoundError:
+        return None, None
+
+
+def latency_percentiles(seconds):
+    """
+    Percentiles (LATENCY_PERCENTILES), mean and maximum of a list of latencies (empty dict if there are none).
+    """
+    if not seconds:
+        return {}
+    values = np.asarray(seconds)
+    percentiles = np.percentile(values, LATENCY_PERCENTILES)
+    summary = {f'p{q}': float(value) for q, value in zip(LATENCY_PERCENTILES, percentiles)}
+    return dict(summary, mean=float(values.mean()), max=float(values.max()))
+
+
+def stop_on_sigterm():
+    """
+    Makes SIGTERM (e.g. a container being stopped) stop the service like Ctrl-C, so that it finishes the
+    registrations in progress and saves its reports.
+    """
+    def stop(signal_number, frame):
+        raise KeyboardInterrupt
+
+    signal.signal(signal.SIGTERM, stop)
+
+
+# ----------------------------------------------- MAIN FUNCTIONS ------------------------------------------------------
+
+class ImageWatcher:
+    """
+    Finds the moving images that appear in a folder. An image is ready once it is unchanged between two polls and
+    for at least settle_seconds (see _signature), so that an image is not read while it is being copied. Every image
+    is reported once; an image that is replaced later is not registered again.
+
+    Parameters
+        folder_path : str: The watched folder.
+        list_images : callable(folder_path) -> names of the images below folder_path (e.g. images_register.list_images).
+        settle_seconds : float: Time an image must stay unchanged before it is ready.
+
+    Attributes
+        seen : set of str: Paths of the images already reported (add to it to skip images).
+    """
+    def __init__(self, folder_path, list_images, settle_seconds=WATCH_SETTLE_SECONDS):
+        self.folder_path = folder_path
+        self.list_images = list_images
+        self.settle_seconds = settle_seconds
+        self.seen = set()
+        self._changing = {}
+
+    def poll(self):
+        """
+        Scans the folder once.
+
+        Returns:
+            list of (image_path, detected) of the images that became ready, where detected is the time.time() at
+            which the watcher first saw the image.
+        """
+        now = time.time()
+        ready, listed = [], set()
+        for name in self.list_images(self.folder_path):
+            image_path = join(self.folder_path, name)
+            listed.add(image_path)
+            if image_path in self.seen:
+                continue
+            signature, modification_time = _signature(image_path)
+            previous, detected = self._changing.get(image_path, (None, now))
+            if signature is not None and signature == previous and now - modification_time >= self.settle_seconds:
+                self.seen.add(image_path)
+                self._changing.pop(image_path)
+                ready.append((image_path, detected))
+            else:
+                self._changing[image_path] = (signature, detected)
+        self._changing = {path: entry for path, entry in self._changing.items() if path in listed}
+        return ready
+
+    @property
+    def n_settling(self):
+        """
+        Number of images seen by the last poll that are not ready yet (e.g. still being copied).
+        """
+        return len(self._changing)
+
+
+class SocketQueue:
+    """
+    Local (Unix domain) socket on which other processes queue moving images, one path per line: absolute, or relative
+    to the watched folder. The service answers each line with 'queued <path>' or 'error: <reason>', e.g.
+
+        echo /data/incoming/subject42.nii.gz | nc -U /tmp/images_register.sock
+
+    Parameters
+        socket_path : str: Path of the socket (replaced if it exists).
+        folder_path : str: Folder relative paths are resolved against.
+    """
+    def __init__(self, socket_path, folder_path):
+        self.socket_path = socket_path
+        self._requests = queue.Queue()
+        requests = self._requests
+
+        class Handler(socketserver.StreamRequestHandler):
+            def handle(self):
+                for line in self.rfile:
+                    path = line.decode().strip()
+                    if not path:
+                        continue
+                    image_path = path if isabs(path) else join(folder_path, path)
+                    if exists(image_path):
+                        requests.put((image_path, time.time()))
+                        self.wfile.write(f'queued {image_path}\n'.encode())
+                    else:
+                        self.wfile.write(f'error: {image_path} not found\n'.encode())
+
+        if exists(socket_path):
+            os.remove(socket_path)
+        self._server = socketserver.ThreadingUnixStreamServer(socket_path, Handler)
+        self._server.daemon_threads = True
+        threading.Thread(target=self._server.serve_forever, daemon=True).start()
+
+    def poll(self):
+        """
+        Returns:
+            list of (image_path, received) of the images queued since the last poll, where received is the time.time()
+            at which the request arrived.
+        """
+        requests = []
+        while True:
+            try:
+                requests.append(self._requests.get_nowait())
+            except queue.Empty:
+                return requests
+
+    def close(self):
+        self._server.shutdown()
+        self._server.server_close()
+        if exists(self.socket_path):
+            os.remove(self.socket_path)
+
+
+class LatencyTracker:
+    """
+    Per-image latencies of the service.
+
+    Attributes
+        latency : list of float: Time from the detection of each image (see ImageWatcher, SocketQueue) until its
+            outputs were written (seconds).
+        processing : list of float: Time from the submission of each registration until its outputs were written.
+    """
+    def __init__(self):
+        self.latency = []
+        self.processing = []
+
+    def add(self, latency, processing):
+        self.latency.append(latency)
+        self.processing.append(processing)
+
+    def to_dict(self):
+        return dict(images=len(self.latency), latency_seconds=latency_percentiles(self.latency),
+                    processing_seconds=latency_percentiles(self.processing))
+
+    def summary(self):
+        percentiles = latency_percentiles(self.latency)
+        return ', '.join(f'{key} {value:.2f} s' for key, value in percentiles.items() if key.startswith('p'))
+
+
+class WatchLoop:
+    """
+    Main loop of the watch mode: hands the images that arrive (see ImageWatcher and SocketQueue) to a registration
+    service (see registration_tools.RegistrationService), collects the registrations as they finish and tracks their
+    latencies, until Ctrl-C, SIGTERM (see stop_on_sigterm) or timeout seconds without new images, images settling
+    (see ImageWatcher) or registrations in progress. It then waits for the registrations in progress and closes the
+    service and the socket.
+
+    The service must be created with on_success=loop.completed, so that the latency of every image is recorded.
+
+    Parameters
+        watcher : ImageWatcher: Finds the images of the watched folder.
+        prepare : callable(image_path) -> the job to submit to the service, or None to skip the image.
+        sockets : SocketQueue: Queue of images submitted on a socket (None: the folder only).
+        on_completed : callable(image_path): Called after every successful registration, e.g. to journal it.
+        on_update : callable(): Called whenever registrations finish, e.g. to save the service report.
+        timeout : float: Seconds without activity after which the loop stops (0: never).
+
+    Attributes
+        latencies : LatencyTracker: Latencies of the completed images.
+    """
+    def __init__(self, watcher, prepare, sockets=None, on_completed=None, on_update=None, timeout=0):
+        self.watcher = watcher
+        self.prepare = prepare
+        self.sockets = sockets
+        self.on_completed = on_completed
+        self.on_update = on_update
+        self.timeout = timeout
+        self.latencies = LatencyTracker()
+        self._detected, self._submitted = {}, {}
+
+    def completed(self, image_path):
+        """
+        Records the latency of an image whose outputs were written (the on_success callback of the service).
+        """
+        now = time.time()
+        detected, submitted = self._detected.pop(image_path), self._submitted.pop(image_path)
+        self.latencies.add(now - detected, now - submitted)
+        print(f'Latency {now - detected:.2f} s; over {len(self.latencies.latency)} images: '
+              f'{self.latencies.summary()}', flush=True)
+        if self.on_completed is not None:
+            self.on_completed(image_path)
+
+    def _submit(self, service, image_path, detected):
+        if image_path in self._submitted:
+            return
+        self.watcher.seen.add(image_path)
+        job = self.prepare(image_path)
+        if job is None:
+            return
+        self._detected[image_path], self._submitted[image_path] = detected, time.time()
+        service.submit(job)
+
+    def _collect(self, service, timeout):
+        finished = service.collect(timeout=timeout)
+        for image_path in finished:
+            # Failed images have no latency; they may be queued again
+            self._detected.pop(image_path, None)
+            self._submitted.pop(image_path, None)
+        if finished and self.on_update is not None:
+            self.on_update()
+        return finished
+
+    def run(self, service):
+        """
+        Runs the loop until it is stopped, then closes the service and the socket.
+        """
+        stop_on_sigterm()
+        last_activity = time.perf_counter()
+        try:
+            while True:
+                arrivals = self.watcher.poll() + ([] if self.sockets is None else self.sockets.poll())
+                for image_path, detected in arrivals:
+                    self._submit(service, image_path, detected)
+                if service.n_pending:
+                    finished = self._collect(service, WATCH_POLL_SECONDS)
+                else:
+                    finished = []
+                    time.sleep(WATCH_POLL_SECONDS)
+                if arrivals or finished or service.n_pending or self.watcher.n_settling:
+                    last_activity = time.perf_counter()
+                elif self.timeout and time.perf_counter() - last_activity >= self.timeout:
+                    print(f'No new image for {self.timeout:g} s: stopping.')
+                    break
+        except KeyboardInterrupt:
+            print(f'Stopping: waiting for {service.n_pending} registrations in progress.', flush=True)
+        finally:
+            while service.n_pending:
+                self._collect(service, None)
+            service.close()
+            if self.sockets is not None:
+                self.sockets.close()
+        if self.on_update is not None:
+            self.on_update()
+
+
+def save_service_report(report_path, report):
+    """
+    Saves the service report (a JSON-serializable dict) atomically, so that it can be read while the service runs.
+    """
+    with atomic_output(report_path) as temporary_path:
+        with open(temporary_path, 'w') as file:
+            json.dump(report, file, indent=2)
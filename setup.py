@@ -64,7 +64,11 @@ setup(
     author='FNNDSC',
     author_email='arman.avasta@childrens.harvard.edu',
     url='https://github.com/FNNDSC/pl-images-register',
-    py_modules=['images_register'],
+    py_modules=['images_register', 'registration_tools', 'os_tools', 'visualization_tools',
+                'cache_tools', 'profiling_tools', 'io_tools', 'manifest_tools',
+                'journal_tools', 'initialization_tools', 'mask_tools', 'resource_tools',
+                'dicom_tools', 'group_tools', 'timeseries_tools',
+                'pairs_tools', 'store_tools', 'service_tools'],
     install_requires=['chris_plugin'],
     license='MIT',
     entry_points={
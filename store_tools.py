@@ -0,0 +1,154 @@
+"""
+Developed by Arman Avesta, MD, PhD
+FNNDSC | Boston Children's Hospital | Harvard Medical School
+
+This module contains the transform store: one NumPy .npz file that holds the transforms of every registration of a
+batch, indexed by moving image name, with the final metric value, iteration count and time of each registration.
+Downstream analyses (e.g. motion or alignment statistics over thousands of subjects) load every transform with one
+read instead of opening one small .mat file per image.
+
+The store holds one array per field (see STORE_ARRAYS), in the order of the names:
+
+    names : str (N,): Moving image names, relative to the folder of the moving images, without extension.
+    parameters : float64 (N, 6): Euler angles (radians) and translation (mm) of the fixed to moving transforms
+        (SimpleITK / ITK conventions, LPS+ coordinates).
+    centers : float64 (N, 3): Centers of rotation of the transforms (mm).
+    metrics : float64 (N,): Metric value of the last pyramid level (nan if the image was not registered by the run,
+        e.g. restored from the cache or a sibling).
+    iterations : int64 (N,): Optimizer iterations over all pyramid levels (0 if not registered by the run).
+    seconds : float64 (N,): Wall time of the registration and resampling (nan if not registered by the run).
+
+The store of the many-to-many mode (see pairs_tools) holds one row per pair and one more array:
+
+    fixed : str (N,): Fixed image names of the pairs (names then holds the moving image name of each pair).
+
+The arrays are stored uncompressed, so that each of them is read with np.load without decompression, and only the
+arrays that are accessed are read.
+"""
+
+# ----------------------------------------------- ENVIRONMENT SETUP ---------------------------------------------------
+# Project imports:
+from registration_tools import RegistrationRecord
+from io_tools import atomic_output
+from os_tools import subfiles_recursive
+
+# System imports:
+import SimpleITK as sitk
+import numpy as np
+from os.path import basename
+
+# Name of the transform store, saved next to the outputs:
+TRANSFORM_STORE_FILE = 'transforms.npz'
+
+# Arrays of the transform store:
+STORE_ARRAYS = ('names', 'parameters', 'centers', 'metrics', 'iterations', 'seconds')
+
+# Additional array of the store of the many-to-many mode:
+PAIR_STORE_ARRAY = 'fixed'
+
+# ---------------------------------------------- HELPER FUNCTIONS -----------------------------------------------------
+
+def read_transform_record(transform_matrix_path):
+    """
+    RegistrationRecord of a transform file saved by a previous run or restored from the cache: the transform only,
+    without metric value, iterations or time.
+    """
+    return RegistrationRecord.from_transform(sitk.Euler3DTransform(sitk.ReadTransform(transform_matrix_path)))
+
+
+def _store_arrays(records):
+    keys = sorted(records)
+    rows = [records[key] for key in keys]
+    pairs = any(isinstance(key, tuple) for key in keys)
+    names = [key[1] for key in keys] if pairs else keys
+    arrays = {PAIR_STORE_ARRAY: np.array([key[0] for key in keys], dtype=str)} if pairs else {}
+    return dict(arrays, names=np.array(names, dtype=str),
+                parameters=np.array([row.parameters for row in rows], dtype=np.float64).reshape(-1, 6),
+                centers=np.array([row.center for row in rows], dtype=np.float64).reshape(-1, 3),
+                metrics=np.array([row.metric for row in rows], dtype=np.float64),
+                iterations=np.array([row.iterations for row in rows], dtype=np.int64),
+                seconds=np.array([row.seconds for row in rows], dtype=np.float64))
+
+
+# ----------------------------------------------- MAIN FUNCTIONS ------------------------------------------------------
+
+def save_transform_store(store_path, records):
+    """
+    Saves the transform store (atomically, see io_tools.atomic_output).
+
+    Parameters
+        store_path : str: Path to the .npz file.
+        records : dict mapping each moving image name, or each (fixed image name, moving image name) pair of the
+            many-to-many mode, to its registration_tools.RegistrationRecord.
+    """
+    with atomic_output(store_path) as temporary_path:
+        with open(temporary_path, 'wb') as file:
+            np.savez(file, **_store_arrays(records))
+
+
+def load_transform_store(store_path):
+    """
+    Reads every array of a transform store.
+
+    Returns:
+        dict mapping each of STORE_ARRAYS (and PAIR_STORE_ARRAY, for a pair store) to its numpy array.
+    """
+    with np.load(store_path, allow_pickle=False) as store:
+        return {key: store[key] for key in STORE_ARRAYS + (PAIR_STORE_ARRAY,) if key in store.files}
+
+
+def load_transform_parameters(store_path, with_centers=False):
+    """
+    Fast loader of the transforms of a batch for downstream analysis: only the names and parameters (and centers)
+    of the store are read.
+
+    Parameters
+        with_centers : bool: Append the 3 center coordinates to the 6 parameters of each transform.
+
+    Returns:
+        (names, parameters): numpy arrays of the N moving image names (of shape (N, 2), fixed and moving image names,
+        for a pair store) and of the parameters, of shape (N, 6), or (N, 9) with_centers. A row and its center give
+        the transform back with timeseries_tools.euler_transform.
+    """
+    with np.load(store_path, allow_pickle=False) as store:
+        parameters = store['parameters']
+        if with_centers:
+            parameters = np.hstack([parameters, store['centers']])
+        names = store['names']
+        if PAIR_STORE_ARRAY in store.files:
+            names = np.stack([store[PAIR_STORE_ARRAY], names], axis=1)
+        return names, parameters
+
+
+def load_store_records(store_path):
+    """
+    Reads a transform store back into RegistrationRecords (without flags, which are in the batch report).
+
+    Returns:
+        dict mapping each moving image name (each (fixed image name, moving image name) pair, for a pair store) to
+        its RegistrationRecord.
+    """
+    store = load_transform_store(store_path)
+    names = [str(name) for name in store['names']]
+    if PAIR_STORE_ARRAY in store:
+        names = [(str(fixed), name) for fixed, name in zip(store[PAIR_STORE_ARRAY], names)]
+    rows = zip(names, *(store[key] for key in STORE_ARRAYS[1:]))
+    return {name: RegistrationRecord(tuple(parameters.tolist()), tuple(center.tolist()), float(metric),
+                                     int(iterations), float(seconds))
+            for name, parameters, center, metric, iterations, seconds in rows}
+
+
+def merge_transform_stores(root):
+    """
+    Merges the transform stores found anywhere below root, e.g. the stores of the shards of a batch, which hold
+    disjoint sets of moving images.
+
+    Returns:
+        dict mapping each moving image name to its RegistrationRecord (empty if no store was found).
+    """
+    records = {}
+    for store_path in subfiles_recursive(root, suffix=TRANSFORM_STORE_FILE):
+        if basename(store_path) != TRANSFORM_STORE_FILE:
+            continue
+        records.update(load_store_records(store_path))
+    return records
@@ -0,0 +1,24 @@
+"""
+Developed by Arman Avesta, MD, PhD
+FNNDSC | Boston Children's Hospital | Harvard Medical School
+
+Shared setup of the tests: the modules of the plugin are top-level modules of the repository, so the repository root
+is put on the import path. The number of threads of SimpleITK, which the resource plan of a run sets for the whole
+process, is restored after every test.
+"""
+
+# ----------------------------------------------- ENVIRONMENT SETUP ---------------------------------------------------
+# System imports:
+import SimpleITK as sitk
+import pytest
+import sys
+from os.path import dirname, abspath
+
+sys.path.insert(0, dirname(dirname(abspath(__file__))))
+
+
+@pytest.fixture(autouse=True)
+def itk_threads():
+    n_threads = sitk.ProcessObject.GetGlobalDefaultNumberOfThreads()
+    yield
+    sitk.ProcessObject.SetGlobalDefaultNumberOfThreads(n_threads)
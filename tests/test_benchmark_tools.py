@@ -0,0 +1,83 @@
+"""
+Developed by Arman Avesta, MD, PhD
+FNNDSC | Boston Children's Hospital | Harvard Medical School
+
+End-to-end tests of the registration and of the benchmark on the synthetic phantoms of benchmark_tools.
+"""
+
+# ----------------------------------------------- ENVIRONMENT SETUP ---------------------------------------------------
+# Project imports:
+import benchmark_tools
+from benchmark_tools import make_case, run_case, run_benchmark, transform_error
+from registration_tools import PRESETS, OPTIMIZERS
+
+# System imports:
+import SimpleITK as sitk
+import numpy as np
+import os
+import pytest
+
+# Phantom pair of the tests: small enough to register in about a second, and one that converges with every preset:
+SIZE = 64
+SEED = 1
+CASE = dict(max_rotation_deg=5.0, max_translation_mm=5.0, noise_fraction=0.01)
+
+# ------------------------------------------------------ TESTS --------------------------------------------------------
+
+def test_make_case(tmp_path):
+    fixed_path, moving_path, true_transform = make_case(SIZE, SEED, str(tmp_path), **CASE)
+    fixed, moving = sitk.ReadImage(fixed_path), sitk.ReadImage(moving_path)
+    assert fixed.GetSize() == moving.GetSize() == (SIZE,) * 3
+    assert fixed.GetSpacing() == moving.GetSpacing()
+    assert transform_error(true_transform.GetInverse(), true_transform, fixed)['error_mm_max'] < 1e-6
+    assert transform_error(sitk.Euler3DTransform(), true_transform, fixed)['error_mm_mean'] > 1.0
+
+
+def test_run_case_recovers_the_transform(tmp_path):
+    workdir = str(tmp_path)
+    fixed_path, moving_path, true_transform = make_case(SIZE, SEED, workdir, **CASE)
+    initial_error = transform_error(sitk.Euler3DTransform(), true_transform, sitk.ReadImage(fixed_path))
+
+    result = run_case(fixed_path, moving_path, true_transform, PRESETS['balanced'], workdir)
+    assert result['error_mm_mean'] < min(3.0, initial_error['error_mm_mean'] / 2)
+    assert {'read', 'optimize', 'resample', 'write', 'total'} <= set(result['seconds'])
+    assert result['levels'] and all(level['iterations'] > 0 for level in result['levels'])
+    # The outputs of the case are removed, the phantom pair is kept
+    assert sorted(os.listdir(workdir)) == sorted(os.path.basename(path) for path in (fixed_path, moving_path))
+
+
+@pytest.mark.parametrize('optimizer', OPTIMIZERS)
+def test_every_optimizer(tmp_path, optimizer):
+    # Phantoms this small are too coarse to compare the accuracy of the optimizers (see benchmark_tools.py for that)
+    workdir = str(tmp_path)
+    fixed_path, moving_path, true_transform = make_case(SIZE, SEED, workdir, **CASE)
+    result = run_case(fixed_path, moving_path, true_transform, PRESETS['balanced'].with_overrides(optimizer=optimizer),
+                      workdir)
+    assert np.isfinite(result['estimated_parameters']).all()
+    assert len(result['levels']) == 3 and all(level['stop_condition'] for level in result['levels'])
+
+
+def test_multi_start(tmp_path):
+    workdir = str(tmp_path)
+    fixed_path, moving_path, true_transform = make_case(SIZE, SEED, workdir, **CASE)
+    initial_error = transform_error(sitk.Euler3DTransform(), true_transform, sitk.ReadImage(fixed_path))
+    result = run_case(fixed_path, moving_path, true_transform, PRESETS['balanced'].with_overrides(multi_start=3),
+                      workdir)
+    assert result['error_mm_mean'] < initial_error['error_mm_mean']
+
+
+def test_benchmark_records_failed_cases(monkeypatch):
+    def run_case_failing_fast(fixed_path, moving_path, true_transform, parameters, workdir):
+        if parameters.shrink_factors == PRESETS['fast'].shrink_factors:
+            raise RuntimeError('optimizer diverged')
+        return run_case(fixed_path, moving_path, true_transform, parameters, workdir)
+
+    monkeypatch.setattr(benchmark_tools, 'run_case', run_case_failing_fast)
+    report = run_benchmark([32], 2, presets=('fast', 'balanced'), converged_mm=100.0)
+    failed = [case for case in report['cases'] if 'error' in case]
+    assert len(failed) == 2 and all(case['preset'] == 'fast' for case in failed)
+    assert 'optimizer diverged' in failed[0]['error']
+    assert report['summary']['fast']['32'] == dict(seconds_median={}, error_mm_median=None, error_deg_median=None,
+                                                  converged_fraction=0.0, failed=2)
+    assert report['summary']['balanced']['32']['failed'] == 0
+    assert report['summary']['balanced']['32']['converged_fraction'] == 1.0
@@ -0,0 +1,84 @@
+"""
+Developed by Arman Avesta, MD, PhD
+FNNDSC | Boston Children's Hospital | Harvard Medical School
+
+Tests of the result cache (cache_tools).
+"""
+
+# ----------------------------------------------- ENVIRONMENT SETUP ---------------------------------------------------
+# Project imports:
+import cache_tools
+from cache_tools import ResultCache, file_digest, registration_key, TRANSFORM_FILE, REGISTERED_IMAGE_FILE
+
+# System imports:
+import os
+import shutil
+from os.path import join, exists
+
+# ---------------------------------------------- HELPER FUNCTIONS -----------------------------------------------------
+
+def _write(path, n_bytes):
+    with open(path, 'wb') as file:
+        file.write(os.urandom(n_bytes))
+    return path
+
+
+# ------------------------------------------------------ TESTS --------------------------------------------------------
+
+def test_registration_key_depends_on_images_and_settings(tmp_path):
+    digest = file_digest(_write(tmp_path / 'image.nii', 100))
+    key = registration_key(digest, digest, dict(a=1, b=2))
+    assert key == registration_key(digest, digest, dict(b=2, a=1))
+    assert key != registration_key(digest, digest, dict(a=1, b=3))
+    assert key != registration_key(digest, file_digest(_write(tmp_path / 'other.nii', 100)), dict(a=1, b=2))
+
+
+def test_store_and_restore(tmp_path):
+    cache = ResultCache(str(tmp_path / 'cache'), max_bytes=1 << 20)
+    transform = _write(tmp_path / 'transform.mat', 10)
+    image = _write(tmp_path / 'registered.nii', 100)
+    assert cache.restore('a', str(tmp_path / 'out.mat')) is None
+
+    cache.store('a', transform, image)
+    cache.store('b', transform)
+    assert sorted(os.listdir(join(cache.cache_dir, 'a'))) == sorted([TRANSFORM_FILE, REGISTERED_IMAGE_FILE])
+    assert cache.restore('a', str(tmp_path / 'out_a.mat'), str(tmp_path / 'out_a.nii')) is True
+    assert cache.restore('b', str(tmp_path / 'out_b.mat'), str(tmp_path / 'out_b.nii')) is False
+    assert (tmp_path / 'out_a.nii').read_bytes() == image.read_bytes()
+    assert (tmp_path / 'out_b.mat').read_bytes() == transform.read_bytes()
+    assert not exists(tmp_path / 'out_b.nii')
+    assert (cache.hits, cache.misses) == (2, 1)
+    assert not [name for name in os.listdir(cache.cache_dir) if name.startswith('.')]
+
+
+def test_evicts_least_recently_used(tmp_path):
+    cache = ResultCache(str(tmp_path / 'cache'), max_bytes=250)
+    transform = _write(tmp_path / 'transform.mat', 100)
+    for age, key in enumerate(['a', 'b']):
+        cache.store(key, transform)
+        os.utime(join(cache.cache_dir, key), (age, age))
+    cache.store('c', transform)
+    assert sorted(os.listdir(cache.cache_dir)) == ['b', 'c']
+
+    # The entry just stored is kept even if it alone exceeds the limit
+    cache.store('d', _write(tmp_path / 'large.mat', 1000))
+    assert os.listdir(cache.cache_dir) == ['d']
+
+
+def test_entries_removed_by_a_concurrent_eviction(tmp_path, monkeypatch):
+    cache = ResultCache(str(tmp_path / 'cache'), max_bytes=150)
+    transform = _write(tmp_path / 'transform.mat', 100)
+    cache.store('a', transform)
+    cache.store('b', transform)
+    dir_size = cache_tools._dir_size
+
+    def removed_while_sized(path):
+        shutil.rmtree(path)
+        return dir_size(path)
+
+    monkeypatch.setattr(cache_tools, '_dir_size', removed_while_sized)
+    cache.evict()
+    assert os.listdir(cache.cache_dir) == []
+    assert cache.restore('b', str(tmp_path / 'out.mat')) is None
+    assert not exists(tmp_path / 'out.mat')
+
@@ -0,0 +1,90 @@
+"""
+Developed by Arman Avesta, MD, PhD
+FNNDSC | Boston Children's Hospital | Harvard Medical School
+
+Tests of the time budget and early stop of the registration (registration_tools.ConvergenceWatchdog).
+"""
+
+# ----------------------------------------------- ENVIRONMENT SETUP ---------------------------------------------------
+# Project imports:
+from registration_tools import ConvergenceWatchdog, RegistrationParameters, rigid_registration, PRESETS
+from benchmark_tools import make_case
+
+# System imports:
+import SimpleITK as sitk
+import time
+from os.path import join
+
+# ---------------------------------------------- HELPER FUNCTIONS -----------------------------------------------------
+
+class ScriptedOptimizer:
+    """
+    Stands in for the sitk.ImageRegistrationMethod observed by the watchdog: reports the metric values of a script,
+    one per iteration event, at position (i, 0) for the i-th event.
+    """
+    def __init__(self, values):
+        self.values = values
+        self.event = -1
+        self.stopped_at = None
+
+    def step(self, watchdog):
+        self.event += 1
+        watchdog.iteration(self)
+
+    def GetMetricValue(self):
+        return self.values[self.event]
+
+    def GetOptimizerPosition(self):
+        return (float(self.event), 0.0)
+
+    def StopRegistration(self):
+        self.stopped_at = self.event
+
+
+def _run_level(watchdog, values):
+    optimizer = ScriptedOptimizer(values)
+    transform = sitk.TranslationTransform(2, (-1.0, 0.0))
+    watchdog.start_level(transform)
+    for _ in values:
+        optimizer.step(watchdog)
+        if optimizer.stopped_at is not None:
+            break
+    return optimizer, transform, watchdog.finish_level(0, transform)
+
+
+# ------------------------------------------------------ TESTS --------------------------------------------------------
+
+def test_early_stop_keeps_the_best_position():
+    watchdog = ConvergenceWatchdog(RegistrationParameters(early_stop_iterations=3, early_stop_tolerance=0.01))
+    optimizer, transform, reason = _run_level(watchdog, [-1.0, -2.0, -2.005, -1.5, -2.001, -3.0])
+    assert optimizer.stopped_at == 4
+    assert reason.startswith('metric plateau')
+    # The best value (-2.005) was measured at the position of the event before it
+    assert transform.GetParameters() == (1.0, 0.0)
+    # A plateau is not a reason to flag the image
+    assert watchdog.flags == []
+
+
+def test_no_stop_while_improving():
+    watchdog = ConvergenceWatchdog(RegistrationParameters(early_stop_iterations=2))
+    optimizer, transform, reason = _run_level(watchdog, [-1.0, -2.0, -3.0, -4.0])
+    assert optimizer.stopped_at is None and reason is None
+    assert transform.GetParameters() == (-1.0, 0.0)
+
+
+def test_time_budget():
+    watchdog = ConvergenceWatchdog(RegistrationParameters(time_budget_seconds=0.01))
+    time.sleep(0.02)
+    optimizer, transform, reason = _run_level(watchdog, [-1.0, -2.0])
+    assert optimizer.stopped_at == 0
+    assert reason.startswith('time budget')
+    assert len(watchdog.flags) == 1 and 'pyramid level 1 of 3' in watchdog.flags[0]
+    assert watchdog.fork().deadline == watchdog.deadline
+
+
+def test_registration_out_of_time_is_flagged(tmp_path):
+    fixed_path, moving_path, _ = make_case(32, 0, str(tmp_path))
+    parameters = PRESETS['fast'].with_overrides(time_budget_seconds=1e-6)
+    record = rigid_registration(fixed_path, moving_path, None, join(str(tmp_path), 'transform.mat'), parameters)
+    assert record.flags and 'time budget' in record.flags[0]
+    assert isinstance(sitk.ReadTransform(join(str(tmp_path), 'transform.mat')), sitk.Transform)
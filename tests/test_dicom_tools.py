@@ -0,0 +1,130 @@
+"""
+Developed by Arman Avesta, MD, PhD
+FNNDSC | Boston Children's Hospital | Harvard Medical School
+
+Tests of the reading of DICOM series folders (dicom_tools).
+"""
+
+# ----------------------------------------------- ENVIRONMENT SETUP ---------------------------------------------------
+# Project imports:
+import dicom_tools
+from dicom_tools import series_geometry, read_dicom_series, sub_dicom_series, is_dicom_series, ras_affine
+from manifest_tools import read_header
+
+# System imports:
+import SimpleITK as sitk
+import nibabel as nib
+import numpy as np
+import os
+import pytest
+
+# Frame of reference of the series written by the tests:
+FRAME_OF_REFERENCE = '1.2.826.0.1.3680043.2.1125.1.42'
+
+# ---------------------------------------------- HELPER FUNCTIONS -----------------------------------------------------
+
+def _volume(shape=(10, 12, 14)):
+    """
+    int16 image (z, y, x = shape) with an oblique orientation, 0.8 x 0.9 mm pixels and 2.5 mm slices.
+    """
+    image = sitk.GetImageFromArray(np.arange(np.prod(shape), dtype=np.int16).reshape(shape) % 1000)
+    image.SetSpacing((0.8, 0.9, 2.5))
+    image.SetOrigin((-40.0, 12.5, 70.0))
+    rotation = sitk.Euler3DTransform()
+    rotation.SetRotation(0.2, 0.0, -0.1)
+    image.SetDirection(rotation.GetMatrix())
+    return image
+
+
+def write_series(folder, image, series_uid='1.2.3.4', gaps=None):
+    """
+    Writes image as a DICOM series, one file per slice. Files are named in reverse slice order, so that the reader
+    has to sort them by position. gaps optionally replaces the slice gaps (mm).
+    """
+    os.makedirs(folder, exist_ok=True)
+    direction = np.asarray(image.GetDirection()).reshape(3, 3)
+    n_slices = image.GetSize()[2]
+    offsets = np.concatenate([[0.0], np.cumsum(gaps)]) if gaps is not None else \
+        np.arange(n_slices) * image.GetSpacing()[2]
+    writer = sitk.ImageFileWriter()
+    writer.KeepOriginalImageUIDOn()
+    for index in range(n_slices):
+        # A one-slice 3D image keeps the orientation of the volume
+        slice_image = image[:, :, index:index + 1]
+        position = np.asarray(image.GetOrigin()) + direction[:, 2] * offsets[index]
+        slice_image.SetOrigin(position.tolist())
+        for tag, value in [('0008|0060', 'MR'), ('0020|000e', series_uid), ('0020|0052', FRAME_OF_REFERENCE),
+                           ('0020|0013', str(index + 1)),
+                           ('0020|0032', '\\'.join(f'{value:.6f}' for value in position)),
+                           ('0020|0037', '\\'.join(f'{value:.6f}' for value in direction[:, :2].T.ravel()))]:
+            slice_image.SetMetaData(tag, value)
+        writer.SetFileName(os.path.join(folder, f'slice{n_slices - index:03d}.dcm'))
+        writer.Execute(slice_image)
+    return folder
+
+
+# ------------------------------------------------------ TESTS --------------------------------------------------------
+
+def test_series_geometry(tmp_path):
+    image = _volume()
+    folder = write_series(str(tmp_path / 'series'), image)
+    geometry = series_geometry(folder)
+    assert geometry.error is None and geometry.n_series == 1
+    assert geometry.size == image.GetSize()
+    assert np.allclose(geometry.spacing, image.GetSpacing(), atol=1e-4)
+    assert np.allclose(geometry.origin, image.GetOrigin(), atol=1e-4)
+    assert np.allclose(geometry.direction, image.GetDirection(), atol=1e-4)
+    assert geometry.pixel_id == sitk.sitkInt16
+    assert geometry.frame_of_reference == FRAME_OF_REFERENCE
+
+
+@pytest.mark.parametrize('n_threads', [1, 3])
+def test_read_dicom_series(tmp_path, monkeypatch, n_threads):
+    # Runs of 4 slices, decoded by n_threads threads
+    monkeypatch.setattr(dicom_tools, 'DICOM_RUN_SLICES', 4)
+    monkeypatch.setattr(dicom_tools, 'available_cpus', lambda: n_threads)
+    image = _volume()
+    folder = write_series(str(tmp_path / 'series'), image)
+    decoded = read_dicom_series(folder)
+    assert np.array_equal(sitk.GetArrayViewFromImage(decoded), sitk.GetArrayViewFromImage(image))
+    assert np.allclose(decoded.GetOrigin(), image.GetOrigin(), atol=1e-4)
+    assert read_dicom_series(folder, sitk.sitkFloat32).GetPixelID() == sitk.sitkFloat32
+
+
+def test_invalid_series(tmp_path):
+    folder = write_series(str(tmp_path / 'irregular'), _volume(), gaps=[2.5] * 5 + [5.0] * 4)
+    assert series_geometry(folder).error.startswith('irregular slice spacing')
+    with pytest.raises(ValueError):
+        read_dicom_series(folder)
+    folder = write_series(str(tmp_path / 'duplicate'), _volume(), gaps=[2.5] * 4 + [0.0] + [2.5] * 4)
+    assert series_geometry(folder).error.startswith('several slices at the same position')
+    assert read_header(folder).error.startswith('invalid DICOM series')
+
+    os.makedirs(tmp_path / 'empty')
+    (tmp_path / 'empty' / 'notes.txt').write_text('not a DICOM file')
+    assert not is_dicom_series(str(tmp_path / 'empty'))
+
+
+def test_several_series_in_a_folder(tmp_path):
+    folder = str(tmp_path / 'series')
+    write_series(folder, _volume(), series_uid='1.2.3.4')
+    write_series(str(tmp_path / 'localizer'), _volume((2, 12, 14)), series_uid='1.2.3.5')
+    for name in os.listdir(tmp_path / 'localizer'):
+        os.rename(tmp_path / 'localizer' / name, os.path.join(folder, 'localizer_' + name))
+    geometry = series_geometry(folder)
+    assert geometry.n_series == 2 and geometry.size == (14, 12, 10)
+
+
+def test_headers_and_discovery(tmp_path):
+    image = _volume()
+    write_series(str(tmp_path / 'subject' / 't1'), image)
+    os.makedirs(tmp_path / 'subject' / 'notes')
+    assert sub_dicom_series(str(tmp_path)) == []
+    assert sub_dicom_series(str(tmp_path), complete_path=False, recursive=True) == [os.path.join('subject', 't1')]
+
+    header = read_header(str(tmp_path / 'subject' / 't1'))
+    assert header.valid and header.shape == (14, 12, 10) and header.dtype == 'int16'
+    sitk.WriteImage(image, str(tmp_path / 'image.nii.gz'))
+    assert np.allclose(header.affine, read_header(str(tmp_path / 'image.nii.gz')).affine, atol=1e-3)
+    assert np.allclose(ras_affine(image.GetOrigin(), image.GetSpacing(), image.GetDirection()),
+                       nib.load(str(tmp_path / 'image.nii.gz')).affine, atol=1e-4)
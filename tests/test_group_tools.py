@@ -0,0 +1,73 @@
+"""
+Developed by Arman Avesta, MD, PhD
+FNNDSC | Boston Children's Hospital | Harvard Medical School
+
+Tests of the grouping of sibling moving images (group_tools).
+"""
+
+# ----------------------------------------------- ENVIRONMENT SETUP ---------------------------------------------------
+# Project imports:
+from group_tools import find_siblings, load_sibling_groups, session_key
+from manifest_tools import ImageHeader
+
+# System imports:
+import json
+import pytest
+from os.path import join
+
+# Affines of two grids:
+GRID = (1.0, 0.0, 0.0, -90.0, 0.0, 1.0, 0.0, -120.0, 0.0, 0.0, 1.0, -70.0, 0.0, 0.0, 0.0, 1.0)
+OTHER_GRID = (2.0, 0.0, 0.0, -90.0, 0.0, 2.0, 0.0, -120.0, 0.0, 0.0, 2.0, -70.0, 0.0, 0.0, 0.0, 1.0)
+
+# ---------------------------------------------- HELPER FUNCTIONS -----------------------------------------------------
+
+def _manifest(*headers):
+    """
+    Manifest of images given as (path, shape, affine) or (path, shape, affine, frame_of_reference).
+    """
+    return {header[0]: ImageHeader(header[0], shape=header[1], affine=header[2],
+                                   frame_of_reference=header[3] if len(header) > 3 else '')
+            for header in headers}
+
+
+# ------------------------------------------------------ TESTS --------------------------------------------------------
+
+def test_siblings_of_one_session():
+    manifest = _manifest(('s1/t1.nii.gz', (10, 10, 10), GRID), ('s1/t2.nii.gz', (10, 10, 12), GRID),
+                         ('s1/flair.nii.gz', (10, 10, 10), GRID), ('s1/dwi.nii.gz', (10, 10, 10), OTHER_GRID),
+                         ('s1/bold.nii.gz', (10, 10, 10, 5), GRID))
+    assert find_siblings(manifest, manifest) == {}
+    # The image with the most voxels represents the group; the 4D image and the other grid are not grouped
+    assert find_siblings(manifest, manifest, match_affines=True) == {'s1/t1.nii.gz': 's1/t2.nii.gz',
+                                                                      's1/flair.nii.gz': 's1/t2.nii.gz'}
+    # Images that are not eligible are left out
+    assert find_siblings(manifest, ['s1/t1.nii.gz', 's1/flair.nii.gz'], match_affines=True) == \
+        {'s1/t1.nii.gz': 's1/flair.nii.gz'}
+
+
+def test_sessions_are_only_merged_on_request():
+    manifest = _manifest(('s1/t1.nii.gz', (10, 10, 10), GRID), ('s2/t1.nii.gz', (10, 10, 10), GRID),
+                         ('dicom/a', (10, 10, 10), GRID, '1.2.3'), ('dicom/b', (10, 10, 10), GRID, '1.2.3'))
+    assert session_key(manifest['dicom/a']) == ('frame_of_reference', '1.2.3')
+    assert session_key(manifest['s1/t1.nii.gz']) == ('folder', 's1')
+    assert find_siblings(manifest, manifest, match_affines=True) == {'dicom/b': 'dicom/a'}
+    assert find_siblings(manifest, manifest, match_affines=True, across_sessions=True) == \
+        {'dicom/b': 'dicom/a', 's1/t1.nii.gz': 'dicom/a', 's2/t1.nii.gz': 'dicom/a'}
+
+
+def test_declared_groups(tmp_path):
+    manifest = _manifest(('movers/s1/t1.nii.gz', (10, 10, 10), GRID), ('movers/s1/t2.nii.gz', (10, 10, 10), GRID),
+                         ('movers/s1/dwi.nii.gz', (10, 10, 10), OTHER_GRID))
+    groups_path = str(tmp_path / 'groups.json')
+    with open(groups_path, 'w') as file:
+        json.dump({'s1': ['s1/dwi.nii.gz', 's1/t1.nii.gz', 's1/missing.nii.gz']}, file)
+    declared = load_sibling_groups(groups_path, 'movers')
+    assert declared == [[join('movers', 's1', name) for name in ['dwi.nii.gz', 't1.nii.gz', 'missing.nii.gz']]]
+    # Declared groups come first: the image left alone is not grouped by affine
+    assert find_siblings(manifest, manifest, declared, match_affines=True) == \
+        {'movers/s1/t1.nii.gz': 'movers/s1/dwi.nii.gz'}
+
+    with open(groups_path, 'w') as file:
+        json.dump({'s1': 's1/t1.nii.gz'}, file)
+    with pytest.raises(ValueError):
+        load_sibling_groups(groups_path, 'movers')
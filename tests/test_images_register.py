@@ -0,0 +1,161 @@
+"""
+Developed by Arman Avesta, MD, PhD
+FNNDSC | Boston Children's Hospital | Harvard Medical School
+
+End-to-end tests of the images_register plugin on a small batch of synthetic phantoms.
+"""
+
+# ----------------------------------------------- ENVIRONMENT SETUP ---------------------------------------------------
+# Project imports:
+import os_tools
+import resource_tools
+from images_register import main, parser, parse_shard
+from manifest_tools import load_manifest, MANIFEST_FILE, BATCH_REPORT_FILE
+from benchmark_tools import make_case
+from pairs_tools import PAIR_TRANSFORMS_FILE, PAIR_METRICS_FILE
+from store_tools import load_transform_parameters, load_store_records, TRANSFORM_STORE_FILE
+from service_tools import SERVICE_REPORT_FILE
+
+# System imports:
+import SimpleITK as sitk
+import json
+import os
+import pytest
+import shutil
+import signal
+from os.path import join
+
+# Edge length (voxels) of the phantoms of the batch (small: only the plumbing of the plugin is tested here):
+SIZE = 32
+
+# ---------------------------------------------- HELPER FUNCTIONS -----------------------------------------------------
+
+def run(inputdir, outputdir, *arguments):
+    """
+    Runs the plugin as ChRIS would, on the batch of moving images of inputdir.
+    """
+    options = parser.parse_args(['--fixed_image', 'fixed.nii.gz', '--moving_images_folder', 'movers',
+                                 '--preset', 'fast', *arguments])
+    main(options, str(inputdir), str(outputdir))
+    return join(str(outputdir), 'movers')
+
+
+@pytest.fixture(scope='module')
+def inputdir(tmp_path_factory):
+    """
+    Input folder of the plugin: fixed.nii.gz and two moving images in movers/.
+    """
+    inputdir = tmp_path_factory.mktemp('inputs')
+    os.makedirs(inputdir / 'movers')
+    for seed, name in enumerate(['a', 'b']):
+        fixed_path, moving_path, _ = make_case(SIZE, seed, str(inputdir))
+        shutil.move(moving_path, inputdir / 'movers' / f'{name}.nii.gz')
+        shutil.move(fixed_path, inputdir / 'fixed.nii.gz')
+    return inputdir
+
+
+# ------------------------------------------------------ TESTS --------------------------------------------------------
+
+def test_transform_only_then_apply_transforms(inputdir, tmp_path):
+    transforms = run(inputdir, tmp_path / 'transforms', '--transform_only', '--transform_store')
+    assert os.path.isfile(join(transforms, 'a_transform.mat'))
+    assert not [name for name in os.listdir(transforms) if '_registered' in name]
+    # The transform store holds the transforms of the batch, indexed by image stem
+    records = load_store_records(join(transforms, TRANSFORM_STORE_FILE))
+    assert sorted(records) == ['a', 'b'] and all(record.iterations > 0 for record in records.values())
+    assert records['a'].transform().GetParameters() == \
+        sitk.Euler3DTransform(sitk.ReadTransform(join(transforms, 'a_transform.mat'))).GetParameters()
+
+    # The transforms of the first run are given to the second as inputs
+    shutil.copytree(inputdir, tmp_path / 'inputs')
+    shutil.copytree(transforms, tmp_path / 'inputs' / 'transforms')
+    registered = run(tmp_path / 'inputs', tmp_path / 'registered', '--apply_transforms', '--transforms_folder',
+                     'transforms')
+    assert sorted(name for name in os.listdir(registered) if '_registered' in name) == \
+        ['a_registered.nii.gz', 'b_registered.nii.gz']
+    assert sitk.ReadImage(join(registered, 'a_registered.nii.gz')).GetSize() == (SIZE,) * 3
+
+
+def test_parse_shard():
+    assert parse_shard('2/3') == (2, 3)
+    assert parse_shard('None') is None
+    for text in ('0/3', '4/3', '2', 'a/b'):
+        with pytest.raises(SystemExit):
+            parse_shard(text)
+
+
+def test_shards_then_merge(inputdir, tmp_path):
+    for index in (1, 2):
+        run(inputdir, tmp_path / 'shards' / f'shard{index}', '--shard', f'{index}/2', '--transform_only')
+    main(parser.parse_args(['--merge_shards']), str(tmp_path / 'shards'), str(tmp_path / 'merged'))
+
+    manifest, summary = load_manifest(str(tmp_path / 'merged' / MANIFEST_FILE))
+    assert sorted(os.path.basename(path) for path in manifest) == ['a.nii.gz', 'b.nii.gz']
+    with open(tmp_path / 'merged' / BATCH_REPORT_FILE) as file:
+        report = json.load(file)
+    assert (report['shards'], report['missing_shards'], report['images'], report['failed']) == \
+        (['1/2', '2/2'], [], 2, [])
+
+
+def test_resume(inputdir, tmp_path, capsys):
+    outputs = run(inputdir, tmp_path, '--transform_only')
+    transform_path = join(outputs, 'a_transform.mat')
+    modified = os.path.getmtime(transform_path)
+    os.remove(join(outputs, 'b_transform.mat'))
+    capsys.readouterr()
+
+    run(inputdir, tmp_path, '--transform_only', '--resume')
+    assert 'Resuming: 1 of 2 moving images are already complete.' in capsys.readouterr().out
+    assert os.path.getmtime(transform_path) == modified
+    assert os.path.isfile(join(outputs, 'b_transform.mat'))
+
+
+def test_siblings(inputdir, tmp_path):
+    # The phantoms share one grid and one folder: b is registered through its representative a
+    outputs = run(inputdir, tmp_path, '--group_siblings')
+    with open(join(outputs, 'a_transform.mat'), 'rb') as a, open(join(outputs, 'b_transform.mat'), 'rb') as b:
+        assert a.read() == b.read()
+    assert os.path.isfile(join(outputs, 'b_registered.nii.gz'))
+    with open(join(outputs, BATCH_REPORT_FILE)) as file:
+        assert list(json.load(file)['siblings'].values()) == [join(str(inputdir), 'movers', 'a.nii.gz')]
+
+
+def test_all_pairs(inputdir, tmp_path):
+    outputs = run(inputdir, tmp_path, '--all_pairs')
+    names, parameters = load_transform_parameters(join(outputs, PAIR_TRANSFORMS_FILE))
+    assert names.tolist() == [['a', 'b'], ['b', 'a']] and parameters.shape == (2, 6)
+    assert os.path.isfile(join(outputs, PAIR_METRICS_FILE))
+
+
+def test_watch(inputdir, tmp_path):
+    handler = signal.getsignal(signal.SIGTERM)
+    try:
+        outputs = run(inputdir, tmp_path, '--watch', '--watch_timeout', '1')
+    finally:
+        signal.signal(signal.SIGTERM, handler)
+    assert os.path.isfile(join(outputs, 'a_registered.nii.gz')) and os.path.isfile(join(outputs, 'b_transform.mat'))
+    with open(join(outputs, SERVICE_REPORT_FILE)) as file:
+        report = json.load(file)
+    assert report['images'] == 2 and report['failed'] == []
+
+
+def test_parallel_jobs(inputdir, tmp_path, monkeypatch):
+    shutil.copytree(inputdir, tmp_path / 'inputs')
+    with open(tmp_path / 'inputs' / 'movers' / 'broken.nii.gz', 'wb') as file:
+        file.write(b'not an image')
+
+    # One CPU for the serial run and two (even on a single CPU machine) for the two workers of the parallel run: one
+    # thread per registration in both. The broken image fails the batch, once the other images are done.
+    for outputs, jobs in [('serial', '1'), ('parallel', '2')]:
+        monkeypatch.setattr(os_tools, 'available_cpus', lambda: int(jobs))
+        monkeypatch.setattr(resource_tools, 'available_cpus', lambda: int(jobs))
+        with pytest.raises(SystemExit, match='1 of 3 registrations failed'):
+            run(tmp_path / 'inputs', tmp_path / outputs, '--transform_only', '--jobs', jobs)
+    serial, parallel = join(str(tmp_path / 'serial'), 'movers'), join(str(tmp_path / 'parallel'), 'movers')
+    for name in ['a_transform.mat', 'b_transform.mat']:
+        with open(join(serial, name), 'rb') as expected, open(join(parallel, name), 'rb') as transform:
+            assert transform.read() == expected.read()
+    with open(join(parallel, BATCH_REPORT_FILE)) as file:
+        report = json.load(file)
+    assert (report['resource_plan']['n_workers'], report['resource_plan']['threads_per_worker']) == (2, 1)
+    assert report['failed'] == [join(str(tmp_path / 'inputs'), 'movers', 'broken.nii.gz')]
@@ -0,0 +1,67 @@
+"""
+Developed by Arman Avesta, MD, PhD
+FNNDSC | Boston Children's Hospital | Harvard Medical School
+
+Tests of the coarse initialization (initialization_tools).
+"""
+
+# ----------------------------------------------- ENVIRONMENT SETUP ---------------------------------------------------
+# Project imports:
+from initialization_tools import coarse_image, edge_features, rotation_grid, fft_translation_search, \
+    coarse_initialization, COARSE_SPACING_MM
+from benchmark_tools import make_phantom
+
+# System imports:
+import SimpleITK as sitk
+import numpy as np
+import pytest
+
+# Edge length (voxels) of the phantom:
+SIZE = 64
+
+# ---------------------------------------------- HELPER FUNCTIONS -----------------------------------------------------
+
+@pytest.fixture(scope='module')
+def phantom():
+    return make_phantom(SIZE, np.random.default_rng(0))
+
+
+# ------------------------------------------------------ TESTS --------------------------------------------------------
+
+def test_coarse_image(phantom):
+    coarse = coarse_image(phantom)
+    assert coarse.GetPixelID() == sitk.sitkFloat32
+    assert coarse.GetSpacing() == (COARSE_SPACING_MM,) * 3
+    assert coarse.GetSize() == (SIZE // int(COARSE_SPACING_MM),) * 3
+
+
+def test_rotation_grid():
+    rotations = rotation_grid(10.0, steps=3)
+    assert len(rotations) == 27
+    assert any(np.allclose(rotation, np.eye(3)) for rotation in rotations)
+    assert len({tuple(np.round(rotation, 6).ravel()) for rotation in rotations}) == 27
+    assert all(np.allclose(rotation @ rotation.T, np.eye(3)) for rotation in rotations)
+
+
+def test_fft_translation_search_recovers_a_translation(phantom):
+    # Translation by whole coarse voxels of the image the moving image is sampled from
+    translation = (2 * COARSE_SPACING_MM, -3 * COARSE_SPACING_MM, COARSE_SPACING_MM)
+    moving = sitk.Resample(phantom, phantom, sitk.TranslationTransform(3, translation), sitk.sitkLinear, 0.0)
+    fixed_features, moving_features = edge_features(coarse_image(phantom)), edge_features(coarse_image(moving))
+    rotated = sitk.Euler3DTransform()
+    rotated.SetRotation(0.0, 0.0, 0.5)
+    (score, shift), (rotated_score, _) = fft_translation_search(fixed_features, moving_features,
+                                                                [sitk.Euler3DTransform(), rotated])
+    assert np.allclose(shift, translation)
+    assert rotated_score < score <= 1.0 + 1e-6
+
+
+@pytest.mark.parametrize('method', ['moments', 'search'])
+def test_coarse_initialization_keeps_the_center(phantom, method):
+    initial_transform = sitk.Euler3DTransform()
+    initial_transform.SetCenter(phantom.TransformContinuousIndexToPhysicalPoint([(SIZE - 1) / 2] * 3))
+    transform = coarse_initialization(coarse_image(phantom), phantom, initial_transform, method)
+    assert isinstance(transform, sitk.Euler3DTransform)
+    assert transform.GetCenter() == initial_transform.GetCenter()
+    # The moving image is the fixed image: no better candidate than the identity
+    assert np.abs(transform.GetTranslation()).max() <= COARSE_SPACING_MM
@@ -0,0 +1,87 @@
+"""
+Developed by Arman Avesta, MD, PhD
+FNNDSC | Boston Children's Hospital | Harvard Medical School
+
+Tests of the output encodings of the registered images (io_tools).
+"""
+
+# ----------------------------------------------- ENVIRONMENT SETUP ---------------------------------------------------
+# Project imports:
+import io_tools
+from io_tools import OutputFormat, write_image, cast_to_pixel_id, read_pixel_id, COMPRESSIONS
+
+# System imports:
+import SimpleITK as sitk
+import gzip
+import nibabel as nib
+import numpy as np
+import pytest
+
+# ---------------------------------------------- HELPER FUNCTIONS -----------------------------------------------------
+
+def _image(shape=(7, 9, 11), dtype=np.float32):
+    """
+    Image of random voxels with a non-trivial geometry (origin, spacing and an oblique direction).
+    """
+    array = (np.random.default_rng(0).standard_normal(shape) * 100).astype(dtype)
+    image = sitk.GetImageFromArray(array)
+    image.SetOrigin((-12.5, 30.0, 4.25))
+    image.SetSpacing((0.9, 1.1, 2.5))
+    rotation = sitk.Euler3DTransform()
+    rotation.SetRotation(0.1, -0.2, 0.3)
+    image.SetDirection(rotation.GetMatrix())
+    return image
+
+
+# ------------------------------------------------------ TESTS --------------------------------------------------------
+
+def test_cast_to_pixel_id_rounds_and_clips():
+    image = sitk.GetImageFromArray(np.array([[[-3.6, 0.4, 1.5, 254.6, 300.0]]], dtype=np.float32))
+    assert sitk.GetArrayViewFromImage(cast_to_pixel_id(image, sitk.sitkUInt8)).ravel().tolist() == \
+        [0, 0, 2, 255, 255]
+    assert sitk.GetArrayViewFromImage(cast_to_pixel_id(image, sitk.sitkInt16)).ravel().tolist() == \
+        [-4, 0, 2, 255, 300]
+    assert cast_to_pixel_id(image, sitk.sitkFloat32) is image
+
+
+@pytest.mark.parametrize('compression', COMPRESSIONS)
+def test_write_image_round_trip(compression, tmp_path, monkeypatch):
+    # Small blocks, so that the parallel gzip output is made of many gzip members
+    monkeypatch.setattr(io_tools, 'PARALLEL_GZIP_BLOCK_SIZE', 1000)
+    output_format = OutputFormat(compression=compression, compression_level=1, threads=2)
+    image = _image()
+    image_path = str(tmp_path / ('image' + output_format.extension))
+    write_image(image, image_path, output_format)
+
+    written = sitk.ReadImage(image_path)
+    assert np.array_equal(sitk.GetArrayViewFromImage(written), sitk.GetArrayViewFromImage(image))
+    assert np.allclose(written.GetOrigin(), image.GetOrigin(), atol=1e-4)
+    assert np.allclose(written.GetSpacing(), image.GetSpacing(), atol=1e-5)
+    assert np.allclose(written.GetDirection(), image.GetDirection(), atol=1e-5)
+    assert np.array_equal(np.asarray(nib.load(image_path).dataobj).T, sitk.GetArrayViewFromImage(image))
+    assert [path.name for path in tmp_path.iterdir()] == [f'image{output_format.extension}']
+
+
+def test_parallel_gzip_matches_the_nifti_of_simpleitk(tmp_path, monkeypatch):
+    monkeypatch.setattr(io_tools, 'PARALLEL_GZIP_BLOCK_SIZE', 1000)
+    image = _image(dtype=np.int16)
+    write_image(image, str(tmp_path / 'parallel.nii.gz'), OutputFormat(compression='parallel_gzip'))
+    write_image(image, str(tmp_path / 'plain.nii'), OutputFormat(compression='none'))
+    with gzip.open(tmp_path / 'parallel.nii.gz') as file:
+        parallel = file.read()
+    plain = (tmp_path / 'plain.nii').read_bytes()
+    assert len(parallel) == len(plain)
+    # Voxels are identical; the header only differs in float rounding of the affine
+    assert parallel[352:] == plain[352:]
+    assert np.allclose(nib.Nifti1Header(parallel[:348]).get_best_affine(),
+                       nib.Nifti1Header(plain[:348]).get_best_affine(), atol=1e-4)
+
+
+def test_moving_dtype(tmp_path):
+    image = _image()
+    output_format = OutputFormat(dtype='moving')
+    assert output_format.pixel_id(sitk.sitkInt16) == sitk.sitkInt16
+    assert OutputFormat().pixel_id(sitk.sitkInt16) == sitk.sitkFloat32
+    image_path = str(tmp_path / 'image.nii.gz')
+    write_image(image, image_path, output_format, sitk.sitkInt16)
+    assert read_pixel_id(image_path) == sitk.sitkInt16
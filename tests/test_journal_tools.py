@@ -0,0 +1,82 @@
+"""
+Developed by Arman Avesta, MD, PhD
+FNNDSC | Boston Children's Hospital | Harvard Medical School
+
+Tests of the completion journal (journal_tools) and of the atomic outputs (io_tools) --resume relies on.
+"""
+
+# ----------------------------------------------- ENVIRONMENT SETUP ---------------------------------------------------
+# Project imports:
+from journal_tools import CompletionJournal
+from io_tools import atomic_output, remove_partial_outputs, PARTIAL_PREFIX
+
+# System imports:
+import os
+import pytest
+
+# ------------------------------------------------------ TESTS --------------------------------------------------------
+
+def test_journal(tmp_path):
+    journal_path = str(tmp_path / 'completed.jsonl')
+    outputs = [str(tmp_path / 'a_registered.nii.gz'), str(tmp_path / 'a_transform.mat')]
+    for path in outputs:
+        open(path, 'w').close()
+    journal = CompletionJournal(journal_path)
+    journal.record('a.nii.gz', 'key1', outputs)
+    journal.record('b.nii.gz', 'key1', [None, outputs[1]])
+    journal.record('a.nii.gz', 'key2', outputs)
+
+    # A run killed while appending leaves a partial last line
+    with open(journal_path, 'a') as file:
+        file.write('{"moving_image": "c.nii.gz", "ke')
+    journal = CompletionJournal(journal_path)
+    assert sorted(journal.entries) == ['a.nii.gz', 'b.nii.gz']
+    assert journal.is_complete('a.nii.gz', 'key2', outputs)
+    assert not journal.is_complete('a.nii.gz', 'key1', outputs)
+    assert journal.is_complete('b.nii.gz', 'key1', [None, outputs[1]])
+    assert not journal.is_complete('c.nii.gz', 'key1', outputs)
+    os.remove(outputs[0])
+    assert not journal.is_complete('a.nii.gz', 'key2', outputs)
+
+
+def test_record_after_a_partial_line(tmp_path):
+    journal_path = str(tmp_path / 'completed.jsonl')
+    output_path = str(tmp_path / 'c_transform.mat')
+    open(output_path, 'w').close()
+    CompletionJournal(journal_path).record('b.nii.gz', 'key', [output_path])
+    with open(journal_path, 'a') as file:
+        file.write('{"moving_image": "b.nii.gz", "ke')
+
+    # The resumed run records its first completion on a line of its own
+    CompletionJournal(journal_path).record('c.nii.gz', 'key', [output_path])
+    journal = CompletionJournal(journal_path)
+    assert journal.is_complete('c.nii.gz', 'key', [output_path])
+    assert journal.is_complete('b.nii.gz', 'key', [output_path])
+    with open(journal_path) as file:
+        assert len(file.read().splitlines()) == 2
+
+
+def test_atomic_output(tmp_path):
+    path = tmp_path / 'transform.mat'
+    path.write_text('old')
+    with pytest.raises(RuntimeError):
+        with atomic_output(str(path)) as temporary_path:
+            with open(temporary_path, 'w') as file:
+                file.write('partial')
+            raise RuntimeError('killed')
+    assert path.read_text() == 'old'
+    assert os.listdir(tmp_path) == ['transform.mat']
+
+    with atomic_output(str(path)) as temporary_path:
+        with open(temporary_path, 'w') as file:
+            file.write('new')
+    assert path.read_text() == 'new'
+    assert os.listdir(tmp_path) == ['transform.mat']
+
+
+def test_remove_partial_outputs(tmp_path):
+    os.makedirs(tmp_path / 'sub')
+    (tmp_path / 'sub' / f'{PARTIAL_PREFIX}0123456789ab-image.nii.gz').write_text('partial')
+    (tmp_path / 'sub' / 'image.nii.gz').write_text('complete')
+    assert remove_partial_outputs(str(tmp_path)) == 1
+    assert os.listdir(tmp_path / 'sub') == ['image.nii.gz']
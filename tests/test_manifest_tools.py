@@ -0,0 +1,83 @@
+"""
+Developed by Arman Avesta, MD, PhD
+FNNDSC | Boston Children's Hospital | Harvard Medical School
+
+Tests of the input manifest (manifest_tools): validation of the images from their headers and scheduling.
+"""
+
+# ----------------------------------------------- ENVIRONMENT SETUP ---------------------------------------------------
+# Project imports:
+from manifest_tools import read_header, build_manifest, save_manifest, load_manifest, longest_first, split_shards
+
+# System imports:
+import nibabel as nib
+import numpy as np
+import pytest
+
+# ---------------------------------------------- HELPER FUNCTIONS -----------------------------------------------------
+
+def _nifti(path, shape, dtype=np.int16):
+    image = nib.Nifti1Image(np.zeros(shape, dtype=dtype), np.diag([1.5, 1.5, 2.0, 1.0]))
+    nib.save(image, str(path))
+    return str(path)
+
+
+# ------------------------------------------------------ TESTS --------------------------------------------------------
+
+def test_valid_headers(tmp_path):
+    header = read_header(_nifti(tmp_path / 'image.nii.gz', (4, 5, 6)))
+    assert header.valid and header.n_timepoints == 1
+    assert (header.shape, header.voxel_size, header.dtype) == ((4, 5, 6), (1.5, 1.5, 2.0), 'int16')
+    assert header.voxel_bytes == 4 * 5 * 6 * 2
+    assert header.affine[:4] == (1.5, 0.0, 0.0, 0.0)
+
+    header = read_header(_nifti(tmp_path / 'bold.nii', (4, 5, 6, 3), np.float32))
+    assert header.valid and header.n_timepoints == 3 and header.n_voxels == 360
+
+
+@pytest.mark.parametrize('shape, dtype, error', [
+    ((4, 5), np.int16, '2D image'),
+    ((4, 5, 6, 2, 2), np.int16, '5D image'),
+    ((4, 0, 6), np.int16, 'empty image'),
+    ((4, 5, 6), np.complex64, 'unsupported data type'),
+])
+def test_invalid_headers(tmp_path, shape, dtype, error):
+    header = read_header(_nifti(tmp_path / 'image.nii.gz', shape, dtype))
+    assert not header.valid and header.error.startswith(error)
+
+
+def test_unreadable_and_truncated_files(tmp_path):
+    (tmp_path / 'text.nii.gz').write_text('not a nifti')
+    assert read_header(str(tmp_path / 'text.nii.gz')).error.startswith('unreadable header')
+    path = _nifti(tmp_path / 'image.nii', (10, 10, 10))
+    with open(path, 'r+b') as file:
+        file.truncate(1000)
+    assert read_header(path).error.startswith('truncated file')
+
+
+def test_manifest_round_trip_and_scheduling(tmp_path):
+    paths = [_nifti(tmp_path / f'{name}.nii.gz', shape)
+             for name, shape in [('small', (4, 4, 4)), ('large', (8, 8, 8)), ('medium', (6, 6, 6))]]
+    (tmp_path / 'bad.nii.gz').write_text('not a nifti')
+    manifest = build_manifest(paths + [str(tmp_path / 'bad.nii.gz')])
+    assert list(manifest) == paths + [str(tmp_path / 'bad.nii.gz')]
+
+    save_manifest(manifest, str(tmp_path / 'manifest.json'), shard='1/2')
+    loaded, summary = load_manifest(str(tmp_path / 'manifest.json'))
+    assert loaded == manifest
+    assert (summary['images'], summary['invalid'], summary['shard']) == (4, 1, '1/2')
+
+    jobs = [(path, f'{path}.mat') for path in paths]
+    assert [job[0] for job in longest_first(jobs, manifest)] == [paths[1], paths[2], paths[0]]
+
+
+def test_split_shards():
+    sizes = {f'image{i:02d}.nii.gz': size for i, size in enumerate([50, 10, 40, 10, 30, 20, 20, 30, 40, 50])}
+    shards = split_shards(sizes, 3)
+    assert sorted(name for shard in shards for name in shard) == sorted(sizes)
+    totals = [sum(sizes[name] for name in shard) for shard in shards]
+    assert max(totals) - min(totals) <= max(sizes.values())
+    # The split depends on the names and sizes only, not on their order
+    assert split_shards(dict(reversed(list(sizes.items()))), 3) == shards
+    assert split_shards(sizes, 1) == [sorted(sizes, key=lambda name: (-sizes[name], name))]
+    assert split_shards({'a': 1}, 3) == [['a'], [], []]
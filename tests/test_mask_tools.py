@@ -0,0 +1,68 @@
+"""
+Developed by Arman Avesta, MD, PhD
+FNNDSC | Boston Children's Hospital | Harvard Medical School
+
+Tests of the foreground masks and of the crop of the images to them (mask_tools).
+"""
+
+# ----------------------------------------------- ENVIRONMENT SETUP ---------------------------------------------------
+# Project imports:
+from mask_tools import foreground_mask, read_mask, crop_to_mask, bounding_box, MASK_MARGIN_MM
+from benchmark_tools import make_phantom
+
+# System imports:
+import SimpleITK as sitk
+import numpy as np
+import pytest
+
+# Edge length (voxels) of the phantom, and of the field of view it is placed in:
+SIZE = 40
+FIELD_OF_VIEW = 100
+
+# ---------------------------------------------- HELPER FUNCTIONS -----------------------------------------------------
+
+@pytest.fixture(scope='module')
+def image():
+    """
+    Phantom head in a corner of a larger field of view of air.
+    """
+    field = sitk.Image([FIELD_OF_VIEW] * 3, sitk.sitkFloat32)
+    field.SetOrigin((-50.0, 20.0, 7.5))
+    head = make_phantom(SIZE, np.random.default_rng(0))
+    field[10:10 + SIZE, 50:50 + SIZE, 5:5 + SIZE] = head
+    return field
+
+
+# ------------------------------------------------------ TESTS --------------------------------------------------------
+
+def test_crop_to_the_foreground(image):
+    mask = foreground_mask(image)
+    assert mask.GetPixelID() == sitk.sitkUInt8
+    lower, upper = bounding_box(mask, image, margin_mm=0.0)
+    # The head fills its SIZE^3 cube except for the corners, within a voxel of the mask grid
+    assert np.all(np.abs(lower - [10, 50, 5]) <= 6) and np.all(np.abs(upper - [50, 90, 45]) <= 6)
+
+    cropped = crop_to_mask(image, mask)
+    assert all(n < FIELD_OF_VIEW for n in cropped.GetSize())
+    assert all(n <= SIZE + 2 * (MASK_MARGIN_MM + 6) for n in cropped.GetSize())
+    # Every voxel keeps its physical position
+    index = (5, 7, 9)
+    point = cropped.TransformIndexToPhysicalPoint(index)
+    assert cropped[index] == image[image.TransformPhysicalPointToIndex(point)]
+    assert np.isclose(sitk.GetArrayViewFromImage(cropped).sum(), sitk.GetArrayViewFromImage(image).sum())
+
+
+def test_empty_images(image):
+    empty = sitk.Image([20] * 3, sitk.sitkFloat32)
+    assert sitk.GetArrayViewFromImage(foreground_mask(empty)).all()
+    empty_mask = sitk.Image(image.GetSize(), sitk.sitkUInt8)
+    empty_mask.CopyInformation(image)
+    assert crop_to_mask(image, empty_mask) is image
+
+
+def test_read_mask(tmp_path):
+    labels = sitk.GetImageFromArray(np.array([[[0, 1, 2, -3, 0]]], dtype=np.int16))
+    sitk.WriteImage(labels, str(tmp_path / 'mask.nii.gz'))
+    mask = read_mask(str(tmp_path / 'mask.nii.gz'))
+    assert mask.GetPixelID() == sitk.sitkUInt8
+    assert sitk.GetArrayViewFromImage(mask).ravel().tolist() == [0, 1, 1, 1, 0]
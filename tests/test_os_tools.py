@@ -0,0 +1,43 @@
+"""
+Developed by Arman Avesta, MD, PhD
+FNNDSC | Boston Children's Hospital | Harvard Medical School
+
+Tests of the CPU budget of os_tools.
+"""
+
+# ----------------------------------------------- ENVIRONMENT SETUP ---------------------------------------------------
+# Project imports:
+import os_tools
+from os_tools import split_cpu_budget, reserve_cpus
+
+# System imports:
+import pytest
+
+# ------------------------------------------------------ TESTS --------------------------------------------------------
+
+@pytest.mark.parametrize('n_jobs, n_cpus, expected', [
+    (1, 8, (1, 8)),
+    (2, 8, (2, 4)),
+    (3, 8, (3, 2)),
+    (16, 8, (8, 1)),
+    (0, 8, (8, 1)),
+    (-1, 4, (4, 1)),
+    (4, 0, (1, 1)),
+])
+def test_split_cpu_budget(n_jobs, n_cpus, expected):
+    n_workers, threads_per_worker = split_cpu_budget(n_jobs, n_cpus)
+    assert (n_workers, threads_per_worker) == expected
+    assert n_workers * threads_per_worker <= max(1, n_cpus)
+
+
+def test_split_cpu_budget_leaves_reserved_cpus(monkeypatch):
+    monkeypatch.setattr(os_tools, 'available_cpus', lambda: 8)
+    monkeypatch.setattr(os_tools, '_reserved_cpus', 0)
+    assert split_cpu_budget(0) == (8, 1)
+    reserve_cpus(2)
+    assert split_cpu_budget(0) == (6, 1)
+    assert split_cpu_budget(1) == (1, 6)
+    # An explicit budget is not reduced
+    assert split_cpu_budget(0, 8) == (8, 1)
+    reserve_cpus(20)
+    assert split_cpu_budget(0) == (1, 1)
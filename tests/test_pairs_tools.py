@@ -0,0 +1,88 @@
+"""
+Developed by Arman Avesta, MD, PhD
+FNNDSC | Boston Children's Hospital | Harvard Medical School
+
+Tests of the many-to-many registration mode (pairs_tools).
+"""
+
+# ----------------------------------------------- ENVIRONMENT SETUP ---------------------------------------------------
+# Project imports:
+from pairs_tools import pair_tiles, register_pairs, save_pair_results, PreparedImageCache
+from registration_tools import PRESETS
+from store_tools import load_store_records
+from benchmark_tools import make_case
+
+# System imports:
+import csv
+import numpy as np
+import pytest
+import shutil
+from os.path import join
+
+# Edge length (voxels) of the phantoms (small: only the plumbing of the mode is tested here):
+SIZE = 32
+
+# ---------------------------------------------- HELPER FUNCTIONS -----------------------------------------------------
+
+@pytest.fixture(scope='module')
+def image_paths(tmp_path_factory):
+    """
+    Three phantoms of one subject: the fixed image of a case and the moving images of two cases.
+    """
+    folder = tmp_path_factory.mktemp('images')
+    paths = []
+    for seed in range(2):
+        fixed_path, moving_path, _ = make_case(SIZE, seed, str(folder))
+        paths.append(str(shutil.move(moving_path, folder / f'moving{seed}.nii.gz')))
+    return [fixed_path] + paths
+
+
+# ------------------------------------------------------ TESTS --------------------------------------------------------
+
+@pytest.mark.parametrize('n_fixed, n_moving, n_workers, cache_images, shape', [
+    (3, 3, 1, None, [(3, 3)]),
+    (3, 3, 2, None, [(2, 3), (1, 3)]),
+    (2, 5, 1, 3, [(2, 2), (2, 2), (2, 1)]),
+    (0, 3, 1, None, []),
+])
+def test_pair_tiles(n_fixed, n_moving, n_workers, cache_images, shape):
+    fixed_paths = [f'f{index}' for index in range(n_fixed)]
+    moving_paths = [f'm{index}' for index in range(n_moving)]
+    tiles = pair_tiles(fixed_paths, moving_paths, n_workers, cache_images)
+    assert [(len(fixed), len(moving)) for fixed, moving in tiles] == shape
+    pairs = [(fixed, moving) for fixed_block, moving_block in tiles for fixed in fixed_block for moving in moving_block]
+    assert sorted(pairs) == sorted((fixed, moving) for fixed in fixed_paths for moving in moving_paths)
+
+
+def test_prepared_image_cache(image_paths):
+    cache = PreparedImageCache(PRESETS['fast'], max_bytes=1)
+    first = cache.get(image_paths[0], as_fixed=True)
+    assert cache.get(image_paths[0], as_fixed=True) is first and cache.hits == 1
+    # A missing role is prepared together with the cached one
+    both = cache.get(image_paths[0], as_moving=True)
+    assert both.has_roles(True, True) and cache.preparations == 2
+    # Over the bound, only the image just requested is kept
+    cache.get(image_paths[1], as_moving=True)
+    assert list(cache.entries) == [image_paths[1]]
+
+
+def test_register_all_pairs(image_paths, tmp_path):
+    missing_path = str(tmp_path / 'missing.nii.gz')
+    records, failures, preparations = register_pairs(image_paths + [missing_path], image_paths,
+                                                     PRESETS['fast'])
+    assert len(records) == 6 and all(fixed != moving for fixed, moving in records)
+    assert sorted(failures) == [(missing_path, moving) for moving in image_paths]
+    # One tile: each image is prepared once for both of its roles
+    assert preparations == 3
+    assert all(np.all(np.isfinite(record.parameters)) for record in records.values())
+
+    names = {path: f'image{index}' for index, path in enumerate(image_paths + [missing_path])}
+    store_path, metrics_path = str(tmp_path / 'pairs.npz'), str(tmp_path / 'pairs.csv')
+    save_pair_results(records, failures, store_path, metrics_path, names)
+    assert load_store_records(store_path) == {(names[fixed], names[moving]): record
+                                              for (fixed, moving), record in records.items()}
+    with open(metrics_path, newline='') as file:
+        rows = list(csv.reader(file))
+    assert rows[0] == ['fixed \\ moving', 'image0', 'image1', 'image2']
+    assert rows[1][1] == '' and float(rows[1][2]) == records[image_paths[0], image_paths[1]].metric
+    assert rows[-1] == ['image3', '', '', '']
@@ -0,0 +1,55 @@
+"""
+Developed by Arman Avesta, MD, PhD
+FNNDSC | Boston Children's Hospital | Harvard Medical School
+
+Tests of the instrumentation hooks (profiling_tools).
+"""
+
+# ----------------------------------------------- ENVIRONMENT SETUP ---------------------------------------------------
+# Project imports:
+from profiling_tools import TimingProfiler, ConvergenceRecorder, profile_path_for
+
+# System imports:
+import json
+import math
+import time
+
+# ------------------------------------------------------ TESTS --------------------------------------------------------
+
+def test_profile_path_for():
+    assert profile_path_for('/out/t1_transform.mat') == '/out/t1_profile.json'
+    assert profile_path_for('/out/t1.mat') == '/out/t1.mat.profile.json'
+
+
+def test_timing_profiler(tmp_path):
+    profile_path = tmp_path / 'profile.json'
+    profiler = TimingProfiler(output_path=str(profile_path))
+    for _ in range(2):
+        with profiler.stage('read'):
+            time.sleep(0.01)
+    profiler.level_started(0, 4, 2.0)
+    for iteration in range(3):
+        profiler.iteration(0, iteration, -0.5 - iteration)
+    profiler.level_finished(0, 3, -2.5, 'converged')
+    profiler.finish()
+
+    profile = json.loads(profile_path.read_text())
+    assert profile['stages']['read']['wall_seconds'] >= 0.02
+    assert profile['total']['wall_seconds'] == profile['stages']['read']['wall_seconds']
+    level, = profile['levels']
+    assert (level['shrink_factor'], level['iterations'], level['metric_value']) == (4, 3, -2.5)
+    assert [entry['iteration'] for entry in level['metric_trace']] == [0, 1, 2]
+
+
+def test_convergence_recorder_passes_events_on():
+    profiler = TimingProfiler(record_iterations=False)
+    recorder = ConvergenceRecorder(profiler)
+    assert math.isnan(recorder.metric)
+    with recorder.stage('optimize'):
+        for level, iterations in enumerate([5, 7]):
+            recorder.level_started(level, 2 - level, 1.0)
+            recorder.iteration(level, 0, -1.0)
+            recorder.level_finished(level, iterations, -1.0 - level, 'converged')
+    assert (recorder.metric, recorder.iterations) == (-2.0, 12)
+    assert 'optimize' in profiler.stages
+    assert [level['metric_trace'] for level in profiler.levels] == [[], []]
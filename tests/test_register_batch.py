@@ -0,0 +1,98 @@
+"""
+Developed by Arman Avesta, MD, PhD
+FNNDSC | Boston Children's Hospital | Harvard Medical School
+
+Tests of the batch registration of registration_tools on synthetic phantoms, in-process and in a pool of worker
+processes sharing the fixed image context.
+"""
+
+# ----------------------------------------------- ENVIRONMENT SETUP ---------------------------------------------------
+# Project imports:
+import os_tools
+from registration_tools import register_batch, FixedImageContext, PRESETS
+from benchmark_tools import make_case
+
+# System imports:
+import SimpleITK as sitk
+import numpy as np
+import os
+import pytest
+from multiprocessing import shared_memory
+from os.path import join
+
+# Edge length (voxels) of the phantoms:
+SIZE = 32
+
+# ---------------------------------------------- HELPER FUNCTIONS -----------------------------------------------------
+
+def _batch(workdir, output_folder, n_images=3):
+    """
+    Phantom batch: (fixed_image_path, jobs) with one job per moving image, plus one job whose moving image is missing.
+    """
+    os.makedirs(output_folder)
+    jobs = []
+    for seed in range(n_images):
+        fixed_path, moving_path, _ = make_case(SIZE, seed, workdir)
+        jobs.append((moving_path, join(output_folder, f'{seed}_registered.nii.gz'),
+                     join(output_folder, f'{seed}_transform.mat')))
+    jobs.append((join(workdir, 'missing.nii.gz'), join(output_folder, 'missing_registered.nii.gz'),
+                 join(output_folder, 'missing_transform.mat')))
+    return fixed_path, jobs
+
+
+# ------------------------------------------------------ TESTS --------------------------------------------------------
+
+def test_pipelined_batch_matches_sequential_batch(tmp_path):
+    fixed_path, jobs = _batch(str(tmp_path), str(tmp_path / 'outputs'))
+    results = {}
+    for prefetch in (0, 2):
+        records, completed = {}, []
+        failures = register_batch(fixed_path, jobs, PRESETS['fast'], prefetch=prefetch, on_success=completed.append,
+                                  on_result=records.__setitem__)
+        assert list(failures) == [jobs[-1][0]]
+        assert sorted(completed) == sorted(records) == sorted(job[0] for job in jobs[:-1])
+        assert all(os.path.isfile(path) for job in jobs[:-1] for path in job[1:])
+        results[prefetch] = records
+
+    for moving_image_path, record in results[0].items():
+        assert np.allclose(record.parameters, results[2][moving_image_path].parameters)
+
+
+def test_fixed_image_context_through_shared_memory(tmp_path):
+    fixed_path, _, _ = make_case(SIZE, 0, str(tmp_path))
+    context = FixedImageContext.from_path(fixed_path, PRESETS['balanced'].with_overrides(foreground_mask='otsu'))
+    assert context.mask is not None
+    descriptor, blocks = context.to_shared_memory()
+    shared = FixedImageContext.from_shared_memory(descriptor)
+    for block in blocks:
+        block.close()
+        block.unlink()
+
+    assert shared.grid == context.grid and shared.parameters == context.parameters
+    images = [(context.image, shared.image), (context.mask, shared.mask)] + list(zip(context.levels, shared.levels))
+    assert len(shared.levels) == len(context.levels)
+    for original, copy in images:
+        assert copy.GetPixelID() == original.GetPixelID()
+        assert (copy.GetSpacing(), copy.GetOrigin(), copy.GetDirection()) == \
+            (original.GetSpacing(), original.GetOrigin(), original.GetDirection())
+        assert np.array_equal(sitk.GetArrayViewFromImage(copy), sitk.GetArrayViewFromImage(original))
+    # The rebuilt context owns its voxels: the segments are gone once unlinked
+    for image_descriptor in descriptor['images']:
+        with pytest.raises(FileNotFoundError):
+            shared_memory.SharedMemory(name=image_descriptor['name'])
+
+
+def test_worker_pool_matches_in_process_batch(tmp_path, monkeypatch):
+    # Two workers even on a single CPU machine, with one thread per registration as in-process
+    monkeypatch.setattr(os_tools, 'available_cpus', lambda: 2)
+    sitk.ProcessObject.SetGlobalDefaultNumberOfThreads(1)
+    fixed_path, jobs = _batch(str(tmp_path), str(tmp_path / 'outputs'))
+    transforms = {}
+    for n_jobs in (1, 2):
+        failures = register_batch(fixed_path, jobs, PRESETS['fast'], n_jobs=n_jobs)
+        assert list(failures) == [jobs[-1][0]]
+        transforms[n_jobs] = []
+        for job in jobs[:-1]:
+            with open(job[2], 'rb') as file:
+                transforms[n_jobs].append(file.read())
+    assert transforms[1] == transforms[2]
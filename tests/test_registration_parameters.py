@@ -0,0 +1,53 @@
+"""
+Developed by Arman Avesta, MD, PhD
+FNNDSC | Boston Children's Hospital | Harvard Medical School
+
+Tests of the registration parameters, the presets and their command line overrides.
+"""
+
+# ----------------------------------------------- ENVIRONMENT SETUP ---------------------------------------------------
+# Project imports:
+from registration_tools import RegistrationParameters, PRESETS
+from images_register import parser, registration_parameters
+
+# System imports:
+import pytest
+
+# ------------------------------------------------------ TESTS --------------------------------------------------------
+
+def test_balanced_preset_is_the_default():
+    assert PRESETS['balanced'] == RegistrationParameters()
+
+
+def test_equal_settings_have_equal_dicts():
+    parameters = RegistrationParameters(shrink_factors=[4.0, 2.0], smoothing_sigmas=(2, 1))
+    assert parameters.shrink_factors == (4, 2)
+    assert parameters.to_dict() == RegistrationParameters(shrink_factors=(4, 2), smoothing_sigmas=(2.0, 1.0)).to_dict()
+
+
+def test_with_overrides_skips_none():
+    parameters = PRESETS['fast'].with_overrides(iterations=10, histogram_bins=None)
+    assert parameters.iterations == 10
+    assert parameters.histogram_bins == PRESETS['fast'].histogram_bins
+
+
+@pytest.mark.parametrize('settings', [
+    dict(shrink_factors=(4, 2, 1), smoothing_sigmas=(2, 1)),
+    dict(final_interpolator='cubic'),
+    dict(working_shrink=0),
+    dict(optimizer='newton'),
+])
+def test_invalid_parameters(settings):
+    with pytest.raises(AssertionError):
+        RegistrationParameters(**settings)
+
+
+def test_command_line_overrides():
+    options = parser.parse_args(['--preset', 'fast', '--shrink_factors', '8,4,2', '--smoothing_sigmas', '3,2,1',
+                                 '--iterations', '20'])
+    parameters = registration_parameters(options)
+    assert parameters.shrink_factors == (8, 4, 2)
+    assert parameters.smoothing_sigmas == (3.0, 2.0, 1.0)
+    assert parameters.iterations == 20
+    assert parameters.histogram_bins == PRESETS['fast'].histogram_bins
+    assert registration_parameters(parser.parse_args([])) == PRESETS['balanced']
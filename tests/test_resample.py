@@ -0,0 +1,65 @@
+"""
+Developed by Arman Avesta, MD, PhD
+FNNDSC | Boston Children's Hospital | Harvard Medical School
+
+Tests of the resampling and of the working images of the memory-lean mode (registration_tools).
+"""
+
+# ----------------------------------------------- ENVIRONMENT SETUP ---------------------------------------------------
+# Project imports:
+from registration_tools import resample, working_image, image_grid
+from benchmark_tools import make_phantom
+
+# System imports:
+import SimpleITK as sitk
+import numpy as np
+import pytest
+
+# Edge length (voxels) of the phantom:
+SIZE = 40
+
+# ---------------------------------------------- HELPER FUNCTIONS -----------------------------------------------------
+
+@pytest.fixture(scope='module')
+def phantom():
+    return sitk.Cast(sitk.RescaleIntensity(make_phantom(SIZE, np.random.default_rng(0)), 0, 1000), sitk.sitkInt16)
+
+
+def _transform(phantom):
+    transform = sitk.Euler3DTransform()
+    transform.SetCenter(phantom.TransformContinuousIndexToPhysicalPoint([(SIZE - 1) / 2] * 3))
+    transform.SetRotation(0.1, -0.05, 0.2)
+    transform.SetTranslation((3.0, -2.0, 4.5))
+    return transform
+
+
+# ------------------------------------------------------ TESTS --------------------------------------------------------
+
+@pytest.mark.parametrize('interpolator', ['linear', 'bspline'])
+@pytest.mark.parametrize('slab_size', [1, 7, 16])
+def test_slab_resampling_matches_whole_volume(phantom, interpolator, slab_size):
+    transform = _transform(phantom)
+    whole = resample(phantom, phantom, transform, interpolator)
+    slabs = resample(phantom, image_grid(phantom), transform, interpolator, slab_size=slab_size)
+    assert slabs.GetSize() == whole.GetSize() and slabs.GetOrigin() == whole.GetOrigin()
+    difference = np.abs(sitk.GetArrayViewFromImage(slabs) - sitk.GetArrayViewFromImage(whole))
+    assert difference.max() <= 0.1
+
+
+def test_slab_resampling_in_the_moving_pixel_type(phantom):
+    transform = _transform(phantom)
+    slabs = resample(phantom, phantom, transform, 'linear', slab_size=8, pixel_id=sitk.sitkInt16)
+    assert slabs.GetPixelID() == sitk.sitkInt16
+    whole = resample(phantom, phantom, transform, 'linear', pixel_id=sitk.sitkInt16)
+    assert np.abs(sitk.GetArrayViewFromImage(slabs).astype(int) - sitk.GetArrayViewFromImage(whole)).max() <= 1
+
+
+def test_working_image(phantom):
+    working = working_image(phantom, 2)
+    assert working.GetPixelID() == sitk.sitkFloat32
+    assert working.GetSize() == (SIZE // 2,) * 3
+    assert np.allclose(working.GetSpacing(), [2 * spacing for spacing in phantom.GetSpacing()])
+    # Block averages keep the mean intensity
+    assert np.isclose(sitk.GetArrayViewFromImage(working).mean(), sitk.GetArrayViewFromImage(phantom).mean(),
+                      rtol=1e-3)
+    assert working_image(phantom, 1).GetSize() == phantom.GetSize()
@@ -0,0 +1,114 @@
+"""
+Developed by Arman Avesta, MD, PhD
+FNNDSC | Boston Children's Hospital | Harvard Medical School
+
+Tests of the cgroup limits (os_tools) and of the resource plan of a batch (resource_tools).
+"""
+
+# ----------------------------------------------- ENVIRONMENT SETUP ---------------------------------------------------
+# Project imports:
+import os_tools
+import resource_tools
+from os_tools import cgroup_cpu_limit, cgroup_memory_limit
+from resource_tools import plan_resources, job_bytes, PROCESS_BYTES
+from manifest_tools import ImageHeader
+from registration_tools import RegistrationParameters
+
+# System imports:
+import os
+import pytest
+from os.path import join
+
+GIB = 2 ** 30
+
+# ---------------------------------------------- HELPER FUNCTIONS -----------------------------------------------------
+
+def _cgroups(monkeypatch, root, proc_self_cgroup, files):
+    """
+    Fake cgroup file system: root replaces /sys/fs/cgroup, proc_self_cgroup the content of /proc/self/cgroup, and
+    files maps paths relative to root to their content.
+    """
+    for path, content in files.items():
+        os.makedirs(os.path.dirname(join(root, path)), exist_ok=True)
+        with open(join(root, path), 'w') as file:
+            file.write(content + '\n')
+    read_cgroup_file = os_tools._read_cgroup_file
+    monkeypatch.setattr(os_tools, 'CGROUP_ROOT', str(root))
+    monkeypatch.setattr(os_tools, '_read_cgroup_file',
+                        lambda path: proc_self_cgroup if path == '/proc/self/cgroup' else read_cgroup_file(path))
+
+
+def _header(path, edge, dtype='int16', itemsize=2):
+    return ImageHeader(path, shape=(edge,) * 3, voxel_size=(1.0,) * 3, dtype=dtype, voxel_bytes=edge ** 3 * itemsize)
+
+
+@pytest.fixture
+def machine(monkeypatch):
+    """
+    Sets the CPUs and memory the planner sees: machine(n_cpus, memory_bytes).
+    """
+    def set_limits(n_cpus, memory):
+        monkeypatch.setattr(resource_tools, 'available_cpus', lambda: n_cpus)
+        monkeypatch.setattr(resource_tools, 'available_memory', lambda: memory)
+        monkeypatch.setattr(resource_tools, 'cgroup_cpu_limit', lambda: None)
+    return set_limits
+
+
+# ------------------------------------------------------ TESTS --------------------------------------------------------
+
+def test_cgroup_v2_limits(tmp_path, monkeypatch):
+    _cgroups(monkeypatch, tmp_path, '0::/kubepods/pod1\n', {
+        'cpu.max': 'max 100000',
+        'kubepods/cpu.max': '400000 100000',
+        'kubepods/pod1/cpu.max': '150000 100000',
+        'kubepods/pod1/memory.max': str(3 * GIB),
+        'kubepods/memory.max': 'max',
+    })
+    assert cgroup_cpu_limit() == 1.5
+    assert cgroup_memory_limit() == 3 * GIB
+
+
+def test_cgroup_v1_limits(tmp_path, monkeypatch):
+    _cgroups(monkeypatch, tmp_path, '5:memory:/docker/abc\n4:cpu,cpuacct:/docker/abc\n', {
+        'cpu/docker/abc/cpu.cfs_quota_us': '250000',
+        'cpu/docker/abc/cpu.cfs_period_us': '100000',
+        'cpu/cpu.cfs_quota_us': '-1',
+        'cpu/cpu.cfs_period_us': '100000',
+        'memory/docker/abc/memory.limit_in_bytes': str(2 ** 63 - 4096),
+    })
+    assert cgroup_cpu_limit() == 2.5
+    assert cgroup_memory_limit() is None
+
+
+def test_no_cgroup(tmp_path, monkeypatch):
+    _cgroups(monkeypatch, tmp_path, '', {})
+    assert cgroup_cpu_limit() is None and cgroup_memory_limit() is None
+
+
+def test_plan_without_memory_limit(machine):
+    machine(8, None)
+    fixed = _header('fixed.nii.gz', 128)
+    moving = {f'{i}.nii.gz': _header(f'{i}.nii.gz', 128) for i in range(4)}
+    plan, serial, refused = plan_resources(fixed, moving, RegistrationParameters(), n_jobs=0)
+    assert (plan.n_workers, plan.threads_per_worker, serial, refused) == (4, 2, [], {})
+
+    plan, _, _ = plan_resources(fixed, moving, RegistrationParameters(), n_jobs=0, helper_processes=2)
+    assert (plan.n_workers, plan.threads_per_worker, plan.registration_cpus) == (4, 1, 6)
+
+
+def test_plan_within_memory_limit(machine):
+    fixed = _header('fixed.nii.gz', 256)
+    moving = {f'{i}.nii.gz': _header(f'{i}.nii.gz', 256) for i in range(8)}
+    moving['large.nii.gz'] = _header('large.nii.gz', 384)
+    moving['huge.nii.gz'] = _header('huge.nii.gz', 1024)
+    parameters = RegistrationParameters()
+    per_job = job_bytes(moving['0.nii.gz'], fixed, parameters)
+    worker = PROCESS_BYTES + resource_tools.context_bytes(fixed, parameters)
+    # Memory for the parent and 3 workers of the median image, but not for a 4th
+    machine(8, int((worker + 3 * (worker + per_job)) / resource_tools.MEMORY_HEADROOM) + 1)
+
+    plan, serial, refused = plan_resources(fixed, moving, parameters, n_jobs=0)
+    assert plan.n_workers == 3 and plan.threads_per_worker == 2
+    assert list(refused) == ['huge.nii.gz'] and plan.refused == 1
+    assert serial == ['large.nii.gz'] and plan.serial == 1
+    assert '--low_memory' in refused['huge.nii.gz']
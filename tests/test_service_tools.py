@@ -0,0 +1,156 @@
+"""
+Developed by Arman Avesta, MD, PhD
+FNNDSC | Boston Children's Hospital | Harvard Medical School
+
+Tests of the building blocks of the watch mode (service_tools): the folder watcher, the socket queue, the latency
+statistics and the main loop.
+"""
+
+# ----------------------------------------------- ENVIRONMENT SETUP ---------------------------------------------------
+# Project imports:
+import service_tools
+from service_tools import ImageWatcher, SocketQueue, WatchLoop, latency_percentiles, save_service_report
+
+# System imports:
+import json
+import os
+import pytest
+import signal
+import socket
+import time
+from os.path import join, exists
+
+# ---------------------------------------------- HELPER FUNCTIONS -----------------------------------------------------
+
+def _list_images(folder):
+    return sorted(name for name in os.listdir(folder) if name.endswith('.nii.gz') or os.path.isdir(join(folder, name)))
+
+
+def _write(path, text, age=0.0):
+    """
+    Writes a file whose modification time is age seconds in the past.
+    """
+    with open(path, 'w') as file:
+        file.write(text)
+    modified = time.time() - age
+    os.utime(path, (modified, modified))
+
+
+@pytest.fixture
+def sigterm_handler():
+    """
+    Restores the SIGTERM handler of the test process, which WatchLoop.run replaces.
+    """
+    handler = signal.getsignal(signal.SIGTERM)
+    yield
+    signal.signal(signal.SIGTERM, handler)
+
+
+class FakeService:
+    """
+    Stand-in for registration_tools.RegistrationService: every submitted image is done at the next collect.
+    """
+    def __init__(self, on_success):
+        self.on_success = on_success
+        self.submitted = []
+        self._pending = []
+        self.closed = False
+
+    @property
+    def n_pending(self):
+        return len(self._pending)
+
+    def submit(self, job):
+        self.submitted.append(job)
+        self._pending.append(job)
+
+    def collect(self, timeout=None):
+        finished, self._pending = self._pending, []
+        for image_path in finished:
+            self.on_success(image_path)
+        return finished
+
+    def close(self):
+        self.closed = True
+
+
+# ------------------------------------------------------ TESTS --------------------------------------------------------
+
+def test_latency_percentiles():
+    assert latency_percentiles([]) == {}
+    summary = latency_percentiles(list(range(1, 101)))
+    assert summary == pytest.approx(dict(p50=50.5, p90=90.1, p99=99.01, mean=50.5, max=100.0))
+
+
+def test_image_watcher_waits_until_images_settle(tmp_path):
+    watcher = ImageWatcher(str(tmp_path), _list_images, settle_seconds=10.0)
+    _write(tmp_path / 'old.nii.gz', 'old', age=60.0)
+    _write(tmp_path / 'new.nii.gz', 'new')
+    os.makedirs(tmp_path / 'series')
+    _write(tmp_path / 'series' / 'slice1.dcm', 'slice', age=60.0)
+
+    # An image is only ready once it was seen unchanged by two polls
+    assert watcher.poll() == []
+    ready = watcher.poll()
+    assert [path for path, _ in ready] == [str(tmp_path / 'old.nii.gz'), str(tmp_path / 'series')]
+    # An image that was reported is not reported again, even if it changes
+    _write(tmp_path / 'series' / 'slice2.dcm', 'slice', age=60.0)
+    assert watcher.poll() == []
+
+    # A recent image is ready once settled, with the time at which it was first seen
+    detected = watcher._changing[str(tmp_path / 'new.nii.gz')][1]
+    os.utime(tmp_path / 'new.nii.gz', (time.time() - 60.0, time.time() - 60.0))
+    assert watcher.poll() == []
+    assert watcher.poll() == [(str(tmp_path / 'new.nii.gz'), detected)]
+
+    _write(tmp_path / 'gone.nii.gz', 'gone')
+    watcher.poll()
+    os.remove(tmp_path / 'gone.nii.gz')
+    watcher.poll()
+    assert str(tmp_path / 'gone.nii.gz') not in watcher._changing
+
+
+def test_socket_queue(tmp_path):
+    _write(tmp_path / 'a.nii.gz', 'a')
+    socket_path = str(tmp_path / 'queue.sock')
+    sockets = SocketQueue(socket_path, str(tmp_path))
+    try:
+        with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as client:
+            client.connect(socket_path)
+            client.sendall(f'a.nii.gz\n\n{tmp_path / "missing.nii.gz"}\n'.encode())
+            client.shutdown(socket.SHUT_WR)
+            answers = client.makefile().read().splitlines()
+        assert answers == [f'queued {tmp_path / "a.nii.gz"}', f'error: {tmp_path / "missing.nii.gz"} not found']
+        assert [path for path, _ in sockets.poll()] == [str(tmp_path / 'a.nii.gz')]
+        assert sockets.poll() == []
+    finally:
+        sockets.close()
+    assert not exists(socket_path)
+
+
+def test_watch_loop(tmp_path, monkeypatch, sigterm_handler):
+    monkeypatch.setattr(service_tools, 'WATCH_POLL_SECONDS', 0.01)
+    for name in ['a.nii.gz', 'b.nii.gz', 'skipped.nii.gz']:
+        _write(tmp_path / name, name, age=60.0)
+    completed, updates = [], []
+    watcher = ImageWatcher(str(tmp_path), _list_images, settle_seconds=0.0)
+    loop = WatchLoop(watcher, lambda path: None if 'skipped' in path else path, on_completed=completed.append,
+                     on_update=lambda: updates.append(len(completed)), timeout=0.2)
+    service = FakeService(loop.completed)
+    loop.run(service)
+
+    assert service.closed and completed == [str(tmp_path / 'a.nii.gz'), str(tmp_path / 'b.nii.gz')]
+    assert service.submitted == completed and updates[-1] == 2
+    report = loop.latencies.to_dict()
+    assert report['images'] == 2 and report['latency_seconds']['max'] >= report['processing_seconds']['max']
+
+    save_service_report(join(str(tmp_path), 'report.json'), report)
+    with open(join(str(tmp_path), 'report.json')) as file:
+        assert json.load(file) == report
+
+    # Images still settling keep the loop running beyond the timeout
+    _write(tmp_path / 'c.nii.gz', 'c')
+    watcher.settle_seconds = 0.5
+    loop.timeout = 0.1
+    loop.run(service)
+    assert completed[-1] == str(tmp_path / 'c.nii.gz')
@@ -0,0 +1,79 @@
+"""
+Developed by Arman Avesta, MD, PhD
+FNNDSC | Boston Children's Hospital | Harvard Medical School
+
+Tests of the transform store of a batch (store_tools).
+"""
+
+# ----------------------------------------------- ENVIRONMENT SETUP ---------------------------------------------------
+# Project imports:
+from store_tools import save_transform_store, load_transform_store, load_transform_parameters, load_store_records, \
+    merge_transform_stores, read_transform_record, TRANSFORM_STORE_FILE, STORE_ARRAYS, PAIR_STORE_ARRAY
+from registration_tools import RegistrationRecord
+
+# System imports:
+import SimpleITK as sitk
+import math
+import numpy as np
+import os
+
+# ---------------------------------------------- HELPER FUNCTIONS -----------------------------------------------------
+
+def _record(seed):
+    rng = np.random.default_rng(seed)
+    return RegistrationRecord(tuple(rng.normal(size=6).tolist()), tuple(rng.normal(size=3).tolist()),
+                              metric=-0.5 - seed, iterations=10 * seed, seconds=1.5 * seed)
+
+
+# ------------------------------------------------------ TESTS --------------------------------------------------------
+
+def test_store_round_trip(tmp_path):
+    store_path = str(tmp_path / TRANSFORM_STORE_FILE)
+    records = {'s2/t1': _record(2), 's1/t1': _record(1)}
+    save_transform_store(store_path, records)
+    assert load_store_records(store_path) == records
+
+    store = load_transform_store(store_path)
+    assert tuple(store) == STORE_ARRAYS and store['names'].tolist() == ['s1/t1', 's2/t1']
+    names, parameters = load_transform_parameters(store_path, with_centers=True)
+    assert names.tolist() == ['s1/t1', 's2/t1']
+    assert np.array_equal(parameters, [records[name].parameters + records[name].center for name in names])
+
+
+def test_empty_store_and_restored_records(tmp_path):
+    store_path = str(tmp_path / TRANSFORM_STORE_FILE)
+    save_transform_store(store_path, {})
+    names, parameters = load_transform_parameters(store_path)
+    assert names.shape == (0,) and parameters.shape == (0, 6)
+
+    # A transform restored from a file has no metric, iterations or time
+    transform = sitk.Euler3DTransform((1.0, 2.0, 3.0), 0.1, -0.2, 0.3, (4.0, 5.0, 6.0))
+    sitk.WriteTransform(transform, str(tmp_path / 'a_transform.mat'))
+    record = read_transform_record(str(tmp_path / 'a_transform.mat'))
+    assert np.allclose(record.parameters, transform.GetParameters()) and record.center == (1.0, 2.0, 3.0)
+    save_transform_store(store_path, {'a': record})
+    restored = load_store_records(store_path)['a']
+    assert math.isnan(restored.metric) and math.isnan(restored.seconds) and restored.iterations == 0
+
+
+def test_pair_store(tmp_path):
+    store_path = str(tmp_path / 'pairwise_transforms.npz')
+    records = {('t0', 't1'): _record(1), ('t1', 't0'): _record(2)}
+    save_transform_store(store_path, records)
+    assert PAIR_STORE_ARRAY in load_transform_store(store_path)
+    assert load_store_records(store_path) == records
+    names, _ = load_transform_parameters(store_path)
+    assert names.tolist() == [['t0', 't1'], ['t1', 't0']]
+
+
+def test_merge_shards(tmp_path):
+    for shard, names in enumerate([['a', 'b'], ['c']]):
+        os.makedirs(tmp_path / f'shard{shard}')
+        save_transform_store(str(tmp_path / f'shard{shard}' / TRANSFORM_STORE_FILE),
+                             {name: _record(index) for index, name in enumerate(names)})
+    # Other stores (e.g. of the many-to-many mode) are not merged
+    save_transform_store(str(tmp_path / 'shard0' / 'pairwise_transforms.npz'), {('a', 'b'): _record(3)})
+    merged = merge_transform_stores(str(tmp_path))
+    assert sorted(merged) == ['a', 'b', 'c'] and merged['c'] == _record(0)
+    os.makedirs(tmp_path / 'empty')
+    assert merge_transform_stores(str(tmp_path / 'empty')) == {}
@@ -0,0 +1,91 @@
+"""
+Developed by Arman Avesta, MD, PhD
+FNNDSC | Boston Children's Hospital | Harvard Medical School
+
+Tests of the 4D image helpers (timeseries_tools) and of the registration of a 4D moving image.
+"""
+
+# ----------------------------------------------- ENVIRONMENT SETUP ---------------------------------------------------
+# Project imports:
+from timeseries_tools import timepoint_count, is_timeseries, timepoint_runs, read_timepoint, timepoint_grid, \
+    timeseries_image, save_motion, read_motion, MOTION_SUFFIX
+from registration_tools import register_batch, image_grid, PRESETS
+from benchmark_tools import make_phantom
+
+# System imports:
+import SimpleITK as sitk
+import numpy as np
+import pytest
+from os.path import join
+
+# Edge length (voxels) and number of timepoints of the 4D phantom:
+SIZE = 32
+TIMEPOINTS = 3
+
+# ---------------------------------------------- HELPER FUNCTIONS -----------------------------------------------------
+
+@pytest.fixture
+def timeseries_path(tmp_path):
+    """
+    4D phantom whose timepoints are the 3D phantom (saved next to it as fixed.nii.gz) scaled by 1, 2, 3, ...
+    """
+    phantom = make_phantom(SIZE, np.random.default_rng(0))
+    phantom.SetOrigin((-10.0, 5.0, 2.0))
+    sitk.WriteImage(phantom, str(tmp_path / 'fixed.nii.gz'))
+    array = sitk.GetArrayFromImage(phantom)
+    image = timeseries_image(np.stack([array * (t + 1) for t in range(TIMEPOINTS)]), image_grid(phantom), 2.5)
+    path = str(tmp_path / 'bold.nii.gz')
+    sitk.WriteImage(image, path)
+    return path
+
+
+# ------------------------------------------------------ TESTS --------------------------------------------------------
+
+@pytest.mark.parametrize('n_timepoints, n_runs, expected', [
+    (10, 3, [(0, 3), (3, 7), (7, 10)]),
+    (2, 4, [(0, 1), (1, 2)]),
+    (5, 0, [(0, 5)]),
+])
+def test_timepoint_runs(n_timepoints, n_runs, expected):
+    assert timepoint_runs(n_timepoints, n_runs) == expected
+
+
+def test_read_timepoint(timeseries_path, tmp_path):
+    fixed = sitk.ReadImage(str(tmp_path / 'fixed.nii.gz'))
+    assert timepoint_count(timeseries_path) == TIMEPOINTS
+    assert is_timeseries(timeseries_path) and not is_timeseries(str(tmp_path / 'fixed.nii.gz'))
+    assert timepoint_grid(timeseries_path) == image_grid(fixed)
+    timepoint = read_timepoint(timeseries_path, 1)
+    assert np.allclose(sitk.GetArrayViewFromImage(timepoint), 2 * sitk.GetArrayViewFromImage(fixed))
+
+
+def test_unreadable_image_is_not_a_timeseries(tmp_path):
+    assert not is_timeseries(str(tmp_path / 'missing.nii.gz'))
+    (tmp_path / 'corrupt.nii.gz').write_bytes(b'not an image')
+    assert not is_timeseries(str(tmp_path / 'corrupt.nii.gz'))
+
+
+def test_motion_round_trip(tmp_path):
+    transforms = []
+    for timepoint in range(TIMEPOINTS):
+        transform = sitk.Euler3DTransform()
+        transform.SetCenter((1.0, 2.0, 3.0))
+        transform.SetParameters((0.01 * timepoint, -0.02, 0.03, 1.0, timepoint / 3, -2.0))
+        transforms.append(transform)
+    motion_path = str(tmp_path / ('bold' + MOTION_SUFFIX))
+    save_motion(motion_path, transforms)
+    for saved, read in zip(transforms, read_motion(motion_path)):
+        assert read.GetParameters() == saved.GetParameters()
+        assert read.GetCenter() == saved.GetCenter()
+
+
+def test_register_timeseries(timeseries_path, tmp_path):
+    motion_path = join(str(tmp_path), 'bold' + MOTION_SUFFIX)
+    registered_path = join(str(tmp_path), 'bold_registered.nii.gz')
+    failures = register_batch(str(tmp_path / 'fixed.nii.gz'), [(timeseries_path, registered_path, motion_path)],
+                              PRESETS['fast'])
+    assert not failures
+    transforms = read_motion(motion_path)
+    assert len(transforms) == TIMEPOINTS
+    assert all(np.isfinite(transform.GetParameters()).all() for transform in transforms)
+    assert sitk.ReadImage(registered_path).GetSize() == (SIZE,) * 3 + (TIMEPOINTS,)
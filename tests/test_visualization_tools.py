@@ -0,0 +1,68 @@
+"""
+Developed by Arman Avesta, MD, PhD
+FNNDSC | Boston Children's Hospital | Harvard Medical School
+
+Tests of the mid-slices and quality control montages of visualization_tools.
+"""
+
+# ----------------------------------------------- ENVIRONMENT SETUP ---------------------------------------------------
+# Project imports:
+from visualization_tools import reorient_nifti, mid_plane, mid_slices, qc_montage, qc_path_for, QCRenderer
+
+# System imports:
+import nibabel as nib
+import numpy as np
+import os
+import pytest
+
+# ---------------------------------------------- HELPER FUNCTIONS -----------------------------------------------------
+
+def _nifti(affine, shape=(9, 10, 11)):
+    data = np.random.default_rng(0).normal(size=shape).astype(np.float32)
+    return nib.Nifti1Image(data, affine)
+
+
+# A scaled RAS+ affine, and a PIL+ one (axes permuted and flipped):
+AFFINES = [np.diag([1.0, 2.0, 3.0, 1.0]),
+           np.array([[0, 0, -1.5, 10], [-1.0, 0, 0, 20], [0, -2.0, 0, 30], [0, 0, 0, 1]])]
+
+# ------------------------------------------------------ TESTS --------------------------------------------------------
+
+@pytest.mark.parametrize('affine', AFFINES)
+def test_mid_plane_matches_the_reoriented_volume(affine):
+    nifti = _nifti(affine)
+    volume = reorient_nifti(nifti).get_fdata()
+    for axis in range(3):
+        expected = np.take(volume, volume.shape[axis] // 2, axis=axis)
+        assert np.allclose(mid_plane(nifti, axis), expected)
+
+
+def test_mid_slices_aspect_ratios():
+    slices = mid_slices(_nifti(AFFINES[0]))
+    assert [aspect_ratio for _, aspect_ratio in slices.values()] == [2.0, 3.0, 1.5]
+
+
+def test_qc_montage(tmp_path):
+    for name, affine in zip(['fixed', 'moving'], AFFINES):
+        nib.save(_nifti(affine), str(tmp_path / f'{name}.nii.gz'))
+    registered_path = str(tmp_path / 'moving_registered.nii.gz')
+    nib.save(_nifti(AFFINES[0]), registered_path)
+    assert qc_path_for(registered_path) == str(tmp_path / 'moving_qc.png')
+
+    qc_montage(str(tmp_path / 'fixed.nii.gz'), str(tmp_path / 'moving.nii.gz'), registered_path,
+               qc_path_for(registered_path))
+    with open(qc_path_for(registered_path), 'rb') as file:
+        assert file.read(8) == b'\x89PNG\r\n\x1a\n'
+
+
+def test_qc_renderer_reports_failures(tmp_path):
+    fixed_path = str(tmp_path / 'fixed.nii.gz')
+    nib.save(_nifti(AFFINES[0]), fixed_path)
+    for name in ['good', 'good_registered']:
+        nib.save(_nifti(AFFINES[0]), str(tmp_path / f'{name}.nii.gz'))
+    renderer = QCRenderer(fixed_path, n_workers=1)
+    renderer.submit(str(tmp_path / 'good.nii.gz'), str(tmp_path / 'good_registered.nii.gz'))
+    renderer.submit(str(tmp_path / 'missing.nii.gz'), str(tmp_path / 'missing_registered.nii.gz'))
+    failures = renderer.close()
+    assert list(failures) == [str(tmp_path / 'missing.nii.gz')]
+    assert os.path.isfile(tmp_path / 'good_qc.png') and not os.path.exists(tmp_path / 'missing_qc.png')
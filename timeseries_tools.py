@@ -0,0 +1,188 @@
+"""
+Developed by Arman Avesta, MD, PhD
+FNNDSC | Boston Children's Hospital | Harvard Medical School
+
+This module contains the input and output of 4D moving images (fMRI, DWI, dynamic PET series): reading one
+timepoint at a time, splitting the timepoints into runs of consecutive timepoints for the workers, the shared memory
+the workers assemble the registered 4D image in, and the motion parameter file that stacks the transform of every
+timepoint (instead of one transform file per timepoint).
+
+The registration of the timepoints is in registration_tools.register_timeseries.
+"""
+
+# ----------------------------------------------- ENVIRONMENT SETUP ---------------------------------------------------
+# Project imports:
+from io_tools import atomic_output
+
+# System imports:
+import SimpleITK as sitk
+import numpy as np
+import os
+from multiprocessing import shared_memory
+
+# The stacked transforms of a 4D moving image are saved as <moving image name>_motion.tsv instead of
+# <moving image name>_transform.mat:
+MOTION_SUFFIX = '_motion.tsv'
+
+# Columns of the motion parameter file: Euler angles (radians) and translation (mm) of the fixed to moving transform
+# of each timepoint (SimpleITK / ITK conventions, LPS+ coordinates), and its center of rotation:
+MOTION_COLUMNS = ('timepoint', 'rotation_x', 'rotation_y', 'rotation_z', 'translation_x', 'translation_y',
+                  'translation_z', 'center_x', 'center_y', 'center_z')
+
+# ---------------------------------------------- HELPER FUNCTIONS -----------------------------------------------------
+
+def _image_reader(image_path):
+    reader = sitk.ImageFileReader()
+    reader.SetFileName(image_path)
+    reader.ReadImageInformation()
+    return reader
+
+
+def timepoint_count(image_path):
+    """
+    Number of timepoints of an image, from its header (1 for 3D images and DICOM series folders).
+    """
+    if os.path.isdir(image_path):
+        return 1
+    reader = _image_reader(image_path)
+    return reader.GetSize()[3] if reader.GetDimension() > 3 else 1
+
+
+def is_timeseries(image_path):
+    """
+    Whether an image is 4D. An image whose header cannot be read is not: its registration fails like that of any
+    unreadable 3D image, and is reported with the other failures of the batch.
+    """
+    try:
+        return timepoint_count(image_path) > 1
+    except RuntimeError:
+        return False
+
+
+def timepoint_runs(n_timepoints, n_runs):
+    """
+    Splits the timepoints into n_runs runs of consecutive timepoints of (almost) equal length.
+
+    Returns:
+        list of (first, stop) timepoint ranges.
+    """
+    n_runs = max(1, min(n_runs, n_timepoints))
+    bounds = np.linspace(0, n_timepoints, n_runs + 1).round().astype(int)
+    return [(int(first), int(stop)) for first, stop in zip(bounds[:-1], bounds[1:])]
+
+
+def create_shared_array(shape, dtype):
+    """
+    Allocates a numpy array in a new shared memory block, for worker processes to fill in.
+
+    Returns:
+        (descriptor, block): descriptor is picklable and is passed to attach_shared_array; block is the SharedMemory
+        object, which the caller must close() and unlink() when done.
+    """
+    dtype = np.dtype(dtype)
+    block = shared_memory.SharedMemory(create=True, size=max(1, int(np.prod(shape)) * dtype.itemsize))
+    return dict(name=block.name, shape=tuple(shape), dtype=dtype.str), block
+
+
+def attach_shared_array(descriptor):
+    """
+    Attaches the array of a shared memory block created by create_shared_array.
+
+    Returns:
+        (array, block): the block must be closed once the array is no longer used.
+    """
+    block = shared_memory.SharedMemory(name=descriptor['name'])
+    return np.ndarray(descriptor['shape'], dtype=np.dtype(descriptor['dtype']), buffer=block.buf), block
+
+
+# ----------------------------------------------- MAIN FUNCTIONS ------------------------------------------------------
+
+def read_timepoint(image_path, timepoint, pixel_id=None):
+    """
+    Reads one timepoint of a 4D image as a 3D image with the spatial geometry of the 4D image. Only that timepoint
+    is decoded (compressed files are still decompressed up to it).
+
+    Parameters
+        pixel_id : int: Pixel type of the image (default: that of the file).
+    """
+    reader = _image_reader(image_path)
+    size = list(reader.GetSize())
+    reader.SetExtractIndex([0, 0, 0, timepoint] + [0] * (len(size) - 4))
+    reader.SetExtractSize(size[:3] + [0] * (len(size) - 3))
+    if pixel_id is not None:
+        reader.SetOutputPixelType(pixel_id)
+    return reader.Execute()
+
+
+def timepoint_grid(image_path):
+    """
+    Spatial sampling grid (see registration_tools.image_grid) of the timepoints of a 4D image, from its header.
+    """
+    reader = _image_reader(image_path)
+    dimension = reader.GetDimension()
+    direction = np.asarray(reader.GetDirection()).reshape(dimension, dimension)[:3, :3]
+    return dict(size=reader.GetSize()[:3], origin=reader.GetOrigin()[:3], spacing=reader.GetSpacing()[:3],
+                direction=tuple(direction.ravel().tolist()))
+
+
+def timepoint_spacing(image_path):
+    """
+    Time between timepoints (the fourth voxel size) of a 4D image.
+    """
+    return _image_reader(image_path).GetSpacing()[3]
+
+
+def timeseries_image(array, grid, time_spacing=1.0):
+    """
+    4D image of stacked 3D timepoints sampled on grid (see registration_tools.image_grid).
+
+    Parameters
+        array : numpy array of shape (timepoints, z, y, x).
+        grid : dict: Spatial sampling grid of every timepoint.
+        time_spacing : float: Time between timepoints.
+
+    Returns:
+        sitk.Image
+    """
+    image = sitk.GetImageFromArray(array, isVector=False)
+    direction = np.eye(4)
+    direction[:3, :3] = np.asarray(grid['direction']).reshape(3, 3)
+    image.SetOrigin(tuple(grid['origin']) + (0.0,))
+    image.SetSpacing(tuple(grid['spacing']) + (time_spacing,))
+    image.SetDirection(direction.ravel().tolist())
+    return image
+
+
+def euler_transform(row):
+    """
+    sitk.Euler3DTransform from a row of the 6 parameters (angles, translation) and 3 center coordinates.
+    """
+    transform = sitk.Euler3DTransform()
+    transform.SetCenter([float(value) for value in row[6:9]])
+    transform.SetParameters([float(value) for value in row[:6]])
+    return transform
+
+
+def save_motion(motion_path, transforms):
+    """
+    Saves the transforms of the timepoints (sitk.Euler3DTransform, in timepoint order) as a tab-separated motion
+    parameter file with one row per timepoint (see MOTION_COLUMNS), atomically.
+    """
+    rows = [[timepoint, *transform.GetParameters(), *transform.GetCenter()]
+            for timepoint, transform in enumerate(transforms)]
+    with atomic_output(motion_path) as temporary_path:
+        with open(temporary_path, 'w') as file:
+            file.write('\t'.join(MOTION_COLUMNS) + '\n')
+            for timepoint, *values in rows:
+                file.write('\t'.join([str(timepoint)] + [repr(float(value)) for value in values]) + '\n')
+
+
+def read_motion(motion_path):
+    """
+    Reads a motion parameter file saved by save_motion.
+
+    Returns:
+        list of sitk.Euler3DTransform, in timepoint order.
+    """
+    table = np.loadtxt(motion_path, delimiter='\t', skiprows=1, ndmin=2)
+    return [euler_transform(row[1:]) for row in table[np.argsort(table[:, 0], kind='stable')]]
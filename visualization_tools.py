@@ -2,22 +2,54 @@
 Developed by Arman Avesta, MD, PhD
 FNNDSC | Boston Children's Hospital | Harvard Medical School
 
-This module contains image re-orientation and visualization functions.
+This module contains image re-orientation and visualization functions, including the quality control (QC) montages
+of a batch: PNG images of the mid-slices of the fixed, moving and registered images and of their overlay, rendered
+headless (matplotlib Agg, without pyplot) by background processes while the registration goes on. Only the three
+mid-planes of each NIfTI image are kept, sliced through the proxy of nibabel (dataobj), so that no volume is loaded
+in memory.
 """
 
 # ----------------------------------------------- ENVIRONMENT SETUP ---------------------------------------------------
 # Project imports:
-
+from dicom_tools import read_dicom_series, ras_affine
+from io_tools import atomic_output
 
 # System imports:
+import SimpleITK as sitk
 import nibabel as nib
+import numpy as np
+import os
+import sys
+import traceback
 import matplotlib.pyplot as plt
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor, wait
+from matplotlib.figure import Figure
 
 # Print configs:
 # np.set_printoptions(precision=1, suppress=True)
 
+# Size (inches) and resolution of each panel of a QC montage:
+QC_PANEL_INCHES = 3.0
+QC_DPI = 100
+
+# Display range of each slice of a QC montage (percentiles of its intensities):
+QC_PERCENTILES = (1, 99)
+
+# Number of background processes rendering QC montages (the resource plan leaves them one CPU each, see
+# resource_tools.plan_resources):
+QC_WORKERS = 2
+
 # ---------------------------------------------- HELPER FUNCTIONS -----------------------------------------------------
 
+def _las_orientation(affine):
+    """
+    Orientation of the array axes of an image with respect to LAS+ (see reorient_nifti).
+    """
+    orientation = nib.io_orientation(affine)
+    orientation[orientation[:, 0] == 0, 1] = - orientation[orientation[:, 0] == 0, 1]
+    return orientation
+
 def reorient_nifti(nifti):
     """
     Re-orients NIfTI to LAS+ system = standard radiology system.
@@ -60,55 +92,196 @@ def reorient_nifti(nifti):
     return nifti.as_reoriented(orientation_transform)
     ################################################################################
     """
-    orientation = nib.io_orientation(nifti.affine)
-    orientation[orientation[:, 0] == 0, 1] = - orientation[orientation[:, 0] == 0, 1]
-    return nifti.as_reoriented(orientation)
+    return nifti.as_reoriented(_las_orientation(nifti.affine))
+
+
+
+def mid_plane(nifti, axis):
+    """
+    Mid-slice of a 3D image across LAS+ axis `axis` (0: sagittal, 1: coronal, 2: axial), as
+    reorient_nifti(nifti).get_fdata() would hold it, but sliced from nifti.dataobj: only this plane is kept in memory,
+    and neither the volume nor a float64 copy of it is made. An uncompressed image is read from disk plane by plane;
+    a .nii.gz file is still decompressed up to the end of the plane, since gzip streams cannot be seeked into.
+
+    Returns:
+        2D float32 array, indexed by the two other LAS+ axes in increasing order.
+    """
+    orientation = _las_orientation(nifti.affine)
+    shape = nifti.shape
+    source = int(np.flatnonzero(orientation[:, 0] == axis)[0])
+    size = shape[source]
+    slicer = [slice(None)] * 3 + [0] * (len(shape) - 3)
+    slicer[source] = size // 2 if orientation[source, 1] > 0 else size - 1 - size // 2
+    plane = np.asarray(nifti.dataobj[tuple(slicer)], dtype=np.float32)
+
+    remaining = [array_axis for array_axis in range(3) if array_axis != source]
+    for plane_axis, array_axis in enumerate(remaining):
+        if orientation[array_axis, 1] < 0:
+            plane = np.flip(plane, plane_axis)
+    if orientation[remaining[0], 0] > orientation[remaining[1], 0]:
+        plane = plane.T
+    return plane
+
+
+def mid_slices(nifti):
+    """
+    Mid-slices of a 3D image in LAS+ (see mid_plane) with the aspect ratio each one is displayed with.
+
+    Returns:
+        dict mapping 'axial', 'coronal' and 'sagittal' to (plane, aspect_ratio).
+    """
+    orientation = _las_orientation(nifti.affine)
+    zooms = nifti.header.get_zooms()
+    voxsize = [float(zooms[int(np.flatnonzero(orientation[:, 0] == axis)[0])]) for axis in range(3)]
+    return dict(axial=(mid_plane(nifti, 2), voxsize[1] / voxsize[0]),
+                coronal=(mid_plane(nifti, 1), voxsize[2] / voxsize[0]),
+                sagittal=(mid_plane(nifti, 0), voxsize[2] / voxsize[1]))
+
+
+def load_image(image_path):
+    """
+    nibabel image of a NIfTI file (the voxel data stays on disk until it is sliced) or of a DICOM series folder
+    (decoded, see dicom_tools).
+    """
+    if not os.path.isdir(image_path):
+        return nib.load(image_path)
+    image = read_dicom_series(image_path)
+    return nib.Nifti1Image(sitk.GetArrayFromImage(image).transpose(2, 1, 0),
+                           ras_affine(image.GetOrigin(), image.GetSpacing(), image.GetDirection()))
+
+
+def _display_range(plane):
+    low, high = np.percentile(plane, QC_PERCENTILES) if plane.size else (0.0, 1.0)
+    return float(low), float(high) if high > low else float(low) + 1.0
+
+
+def _normalized(plane):
+    low, high = _display_range(plane)
+    return np.clip((plane - low) / (high - low), 0.0, 1.0)
+
+
+def qc_path_for(registered_image_path):
+    """
+    Path of the QC montage saved next to a registered image:
+    <moving image name>_registered.nii(.gz) --> <moving image name>_qc.png
+    """
+    for suffix in ('_registered.nii.gz', '_registered.nii'):
+        if registered_image_path.endswith(suffix):
+            return registered_image_path[:-len(suffix)] + '_qc.png'
+    return registered_image_path + '.qc.png'
 
 
+# ----------------------------------------------- MAIN FUNCTIONS ------------------------------------------------------
 
 def imgshow(nifti):
     """
-    This function shows a nifti image in LAS+ system.
+    This function shows a nifti image in LAS+ system. Only the displayed planes of a 3D image are read.
     """
     kwargs = dict(cmap='gray', origin='lower')
     ndim = nifti.ndim
     assert ndim in (2, 3), f'image shape: {nifti.shape}; imshow can only show 2D and 3D images.'
 
     if ndim == 2:
-        img = nifti.get_fdata()
+        img = np.asarray(nifti.dataobj, dtype=np.float32)
         plt.imshow(img.T, **kwargs)
         plt.show()
 
     elif ndim == 3:
-        nifti = reorient_nifti(nifti)
-        img = nifti.get_fdata()
-        voxsize = tuple(float(dim) for dim in nifti.header.get_zooms())
-
-        midaxial = img.shape[2] // 2
-        midcoronal = img.shape[1] // 2
-        midsagittal = img.shape[0] // 2
-        axial_aspect_ratio = voxsize[1] / voxsize[0]
-        coronal_aspect_ratio = voxsize[2] / voxsize[0]
-        sagittal_aspect_ratio = voxsize[2] / voxsize[1]
-
-        axial = plt.subplot(1, 3, 1)
-        plt.imshow(img[:, :, midaxial].T, **kwargs)
-        axial.set_aspect(axial_aspect_ratio)
-        axial.set_title('axial')
-
-        coronal = plt.subplot(1, 3, 2)
-        plt.imshow(img[:, midcoronal, :].T, **kwargs)
-        coronal.set_aspect(coronal_aspect_ratio)
-        coronal.set_title('coronal')
-
-        sagittal = plt.subplot(1, 3, 3)
-        plt.imshow(img[midsagittal, :, :].T, **kwargs)
-        sagittal.set_aspect(sagittal_aspect_ratio)
-        sagittal.set_title('sagittal')
-
+        for column, (title, (plane, aspect_ratio)) in enumerate(mid_slices(nifti).items(), start=1):
+            axes = plt.subplot(1, 3, column)
+            plt.imshow(plane.T, **kwargs)
+            axes.set_aspect(aspect_ratio)
+            axes.set_title(title)
         plt.show()
 
 
+def qc_montage(fixed_image_path, moving_image_path, registered_image_path, output_path, title=None):
+    """
+    Saves a PNG montage of the axial, coronal and sagittal mid-slices of the fixed, moving and registered images,
+    and of the overlay of the fixed (magenta) and registered (green) images, which shows aligned structures in gray
+    and misaligned ones in color. The figure is rendered by the Agg backend without pyplot, so it needs no display
+    and keeps no global state. The montage is written atomically.
+    """
+    rows = dict(fixed=mid_slices(load_image(fixed_image_path)), moving=mid_slices(load_image(moving_image_path)),
+                registered=mid_slices(load_image(registered_image_path)))
+    figure = Figure(figsize=(3 * QC_PANEL_INCHES, 4 * QC_PANEL_INCHES), dpi=QC_DPI)
+    axes = figure.subplots(4, 3)
+    for row, (name, slices) in enumerate(rows.items()):
+        for column, (view, (plane, aspect_ratio)) in enumerate(slices.items()):
+            low, high = _display_range(plane)
+            axes[row, column].imshow(plane.T, cmap='gray', origin='lower', vmin=low, vmax=high,
+                                     aspect=aspect_ratio, interpolation='nearest')
+            axes[0, column].set_title(view)
+        axes[row, 0].set_ylabel(name)
+    for column, view in enumerate(rows['fixed']):
+        (fixed, aspect_ratio), (registered, _) = rows['fixed'][view], rows['registered'][view]
+        if fixed.shape == registered.shape:
+            fixed, registered = _normalized(fixed), _normalized(registered)
+            axes[3, column].imshow(np.stack([fixed, registered, fixed], axis=-1).transpose(1, 0, 2),
+                                   origin='lower', aspect=aspect_ratio, interpolation='nearest')
+    axes[3, 0].set_ylabel('overlay')
+    for axis in axes.flat:
+        axis.set_xticks([])
+        axis.set_yticks([])
+    figure.suptitle(title or os.path.basename(output_path))
+    figure.tight_layout()
+    with atomic_output(output_path) as temporary_path:
+        figure.savefig(temporary_path, format='png')
+
+
+def _safe_qc_montage(*args):
+    try:
+        qc_montage(*args)
+        return None
+    except Exception:
+        return traceback.format_exc()
+
+
+class QCRenderer:
+    """
+    Renders the QC montages of a batch in a pool of background processes (see qc_montage), so that rendering
+    overlaps with the registrations. A montage that cannot be rendered is reported, and never fails the batch.
+
+    The processes are spawned (not forked) and started when the renderer is created: montages are submitted from the
+    writer thread of the pipeline, and forking a process that runs other threads can deadlock the child. Create the
+    renderer in the main thread.
+
+    Parameters
+        fixed_image_path : str: Path to the fixed image of the batch.
+        n_workers : int: Number of rendering processes.
+    """
+    def __init__(self, fixed_image_path, n_workers=QC_WORKERS):
+        self.fixed_image_path = fixed_image_path
+        self._pool = ProcessPoolExecutor(max_workers=n_workers, mp_context=multiprocessing.get_context('spawn'))
+        self._futures = {}
+        # Start the workers now rather than from the thread of the first montage
+        wait([self._pool.submit(os.getpid) for _ in range(n_workers)])
+
+    def submit(self, moving_image_path, registered_image_path):
+        """
+        Queues the montage of one registered image, saved next to it (see qc_path_for).
+        """
+        future = self._pool.submit(_safe_qc_montage, self.fixed_image_path, moving_image_path,
+                                   registered_image_path, qc_path_for(registered_image_path),
+                                   os.path.basename(moving_image_path.rstrip(os.sep)))
+        self._futures[future] = moving_image_path
+
+    def close(self):
+        """
+        Waits for every queued montage and shuts the pool down.
+
+        Returns:
+            failures : dict mapping moving_image_path to the formatted traceback of every montage that failed.
+        """
+        failures = {}
+        for future, moving_image_path in self._futures.items():
+            error = future.result()
+            if error is not None:
+                failures[moving_image_path] = error
+                print(f'QC montage of {moving_image_path} failed:\n{error}', file=sys.stderr)
+        self._pool.shutdown()
+        return failures
+
 
 # -------------------------------------------------- CODE TESTING -----------------------------------------------------
 